@@ -1,4 +1,11 @@
+import re
+from datetime import timedelta
+
 from django.contrib import admin
+from django.db.models import Sum
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
 from .models import (
     Order,
     OrderItem,
@@ -6,13 +13,64 @@ from .models import (
     Payment,
     Address,
     Coupon,
-    UserProfile
+    UserProfile,
+    OutboxMessage,
+    Refund,
+    Task,
+    DailySales,
+    ItemSales,
+    CategorySales,
+    CouponUsage,
+    ArchivedOrder,
+    ArchivedOrderLine,
 )
+from .exports import export_response
+from .pagination import EstimatedCountPaginator
+from .refunds import process_refunds_task
+
+
+REF_CODE_RE = re.compile(r'^[a-z0-9]{24}$')
+
+
+def username_prefix(prefix, field='user__username'):
+    # a range instead of LIKE 'prefix%', so the unique index on username
+    # is used whatever the collation of the database
+    return {f'{field}__gte': prefix, f'{field}__lt': prefix + '\uffff'}
+
+
+def queue_refunds(modeladmin, request, refunds):
+    # the provider calls run in the task worker, not in the admin request
+    refunds.update(accepted=True)
+    refund_ids = list(refunds.filter(status='P').values_list('pk', flat=True))
+    if refund_ids:
+        process_refunds_task.delay(refund_ids)
+    modeladmin.message_user(request,
+        f'Queued {len(refund_ids)} refunds, the task worker processes them.')
+
 
 
 def make_refund_accepted(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
-make_refund_accepted.short_description = 'Update orders to refund granted'
+    # accept the refund requests of the orders and refund their charges,
+    # refund_granted is set once the provider refunded the charge
+    queue_refunds(modeladmin, request, Refund.objects.filter(order__in=queryset))
+make_refund_accepted.short_description = 'Accept refund requests of the orders'
+
+
+
+def process_accepted_refunds(modeladmin, request, queryset):
+    queue_refunds(modeladmin, request, queryset)
+process_accepted_refunds.short_description = 'Accept and refund the requests'
+
+
+
+def export_orders_csv(modeladmin, request, queryset):
+    return export_response(queryset, 'csv')
+export_orders_csv.short_description = 'Export as CSV'
+
+
+def export_orders_ndjson(modeladmin, request, queryset):
+    return export_response(queryset, 'ndjson')
+export_orders_ndjson.short_description = 'Export as NDJSON'
 
 
 
@@ -46,12 +104,97 @@ class OrderAdmin(admin.ModelAdmin):
         'refund_granted',
     ]
 
+    # __str__ of the order, addresses and payment is the username
+    list_select_related = [
+        'user',
+        'shipping_address__user',
+        'billing_address__user',
+        'payment__user',
+        'coupon',
+    ]
+
+    # searched with get_search_results below
     search_fields = [
-        'user__username',
         'ref_code',
+        'user__username',
     ]
 
-    actions = [make_refund_accepted]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    actions = [
+        make_refund_accepted,
+        export_orders_csv,
+        export_orders_ndjson,
+    ]
+
+    def get_search_results(self, request, queryset, search_term):
+        # only index backed lookups, no icontains over the whole table
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if REF_CODE_RE.match(term):
+            return queryset.filter(ref_code=term), False
+        return queryset.filter(**username_prefix(term)), False
+
+
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = [
+        'topic',
+        'created_at',
+        'processed_at',
+        'attempts',
+    ]
+
+    list_filter = [
+        'topic',
+    ]
+
+
+
+class RefundAdmin(admin.ModelAdmin):
+    list_display = [
+        'order',
+        'email',
+        'accepted',
+        'status',
+        'attempts',
+        'processed_at',
+    ]
+
+    list_filter = [
+        'accepted',
+        'status',
+    ]
+
+    actions = [process_accepted_refunds]
+
+
+
+def retry_tasks(modeladmin, request, queryset):
+    queryset.exclude(status='R').update(status='Q', attempts=0,
+        run_at=timezone.now(), last_error='')
+retry_tasks.short_description = 'Queue the tasks again'
+
+
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = [
+        'name',
+        'status',
+        'run_at',
+        'attempts',
+        'max_attempts',
+        'locked_by',
+    ]
+
+    list_filter = [
+        'status',
+        'name',
+    ]
+
+    actions = [retry_tasks]
 
 
 
@@ -72,13 +215,165 @@ class AddressAdmin(admin.ModelAdmin):
         'country',
     ]
 
+    list_select_related = [
+        'user',
+    ]
+
+    # searched with get_search_results below
     search_fields = [
         'user__username',
-        'street_address',
-        'apartment_address',
-        'zip',
     ]
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        return queryset.filter(**username_prefix(term)), False
+
+
+
+class RollupAdmin(admin.ModelAdmin):
+    """Rollups are written by core.rollups only."""
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+
+class DailySalesAdmin(RollupAdmin):
+    list_display = [
+        'date',
+        'orders',
+        'units',
+        'get_revenue',
+    ]
+
+    date_hierarchy = 'date'
+    ordering = ['-date']
+    dashboard_days = 30
+
+    def get_urls(self):
+        return [
+            path('dashboard/', self.admin_site.admin_view(self.dashboard_view),
+                name='core_sales_dashboard'),
+        ] + super().get_urls()
+
+    def dashboard_view(self, request):
+        # reads the rollup tables only, never the orders
+        since = timezone.localdate() - timedelta(days=self.dashboard_days)
+        daily_sales = DailySales.objects.filter(date__gt=since).order_by('-date')
+        totals = daily_sales.aggregate(orders=Sum('orders'),
+            units=Sum('units'), revenue_cents=Sum('revenue_cents'))
+        totals['revenue'] = (totals['revenue_cents'] or 0) / 100
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Sales',
+            days=self.dashboard_days,
+            daily_sales=daily_sales,
+            totals=totals,
+            item_sales=ItemSales.objects.select_related('item')
+                .order_by('-revenue_cents')[:20],
+            category_sales=CategorySales.objects.order_by('-revenue_cents'),
+            coupon_usage=CouponUsage.objects.select_related('coupon')
+                .order_by('-orders')[:20],
+        )
+        return TemplateResponse(request, 'admin/sales_dashboard.html', context)
+
+
+
+class ItemSalesAdmin(RollupAdmin):
+    list_display = [
+        'item',
+        'orders',
+        'units',
+        'get_revenue',
+    ]
+
+    list_select_related = ['item']
+    ordering = ['-revenue_cents']
+
+
+
+class CategorySalesAdmin(RollupAdmin):
+    list_display = [
+        'category',
+        'orders',
+        'units',
+        'get_revenue',
+    ]
+
+    ordering = ['-revenue_cents']
+
+
+
+class CouponUsageAdmin(RollupAdmin):
+    list_display = [
+        'coupon',
+        'orders',
+        'get_discount',
+        'get_revenue',
+    ]
+
+    list_select_related = ['coupon']
+    ordering = ['-orders']
+
+
+
+class ArchivedOrderLineInline(admin.TabularInline):
+    model = ArchivedOrderLine
+    extra = 0
+    can_delete = False
+    readonly_fields = [
+        'item',
+        'title',
+        'category',
+        'quantity',
+        'line_cents',
+    ]
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = [
+        'ref_code',
+        'user',
+        'paid_at',
+        'total_cents',
+        'being_delivered',
+        'received',
+    ]
+
+    list_select_related = ['user']
+    inlines = [ArchivedOrderLineInline]
+
+    search_fields = [
+        'ref_code',
+    ]
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        return queryset.filter(ref_code=term), False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 
 
 admin.site.register(Item)
@@ -88,3 +383,11 @@ admin.site.register(Payment)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Coupon)
 admin.site.register(UserProfile)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
+admin.site.register(Refund, RefundAdmin)
+admin.site.register(Task, TaskAdmin)
+admin.site.register(DailySales, DailySalesAdmin)
+admin.site.register(ItemSales, ItemSalesAdmin)
+admin.site.register(CategorySales, CategorySalesAdmin)
+admin.site.register(CouponUsage, CouponUsageAdmin)
+admin.site.register(ArchivedOrder, ArchivedOrderAdmin)
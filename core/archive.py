@@ -0,0 +1,158 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import get_cart_count_key
+from .inventory import _release
+from .models import (
+    User,
+    Order,
+    OrderItem,
+    StockReservation,
+    CartSnapshot,
+    ArchivedOrder,
+    ArchivedOrderLine,
+)
+
+
+def get_cutoff(days):
+    return timezone.now() - timedelta(days=days)
+
+
+def reap_carts(before=None, batch_size=500):
+    """
+    Delete one batch of carts untouched since before (CART_ABANDON_AFTER
+    days ago by default) with their lines, putting their reserved stock
+    back on sale. Returns how many carts were deleted.
+    """
+    before = before or get_cutoff(settings.CART_ABANDON_AFTER)
+    candidates = list(Order.objects.filter(ordered=False,
+        updated_at__lt=before).order_by('updated_at')
+        .values_list('user_id', flat=True)[:batch_size])
+    if not candidates:
+        return 0
+
+    with transaction.atomic():
+        # the cart service creates carts under the user row lock and
+        # changes them under the cart row lock, so a cart being changed
+        # right now is either waited for or skipped
+        user_ids = list(User.objects.select_for_update()
+            .filter(pk__in=candidates).order_by('pk')
+            .values_list('pk', flat=True))
+        # the cart rows are locked too, the cart service locks only them
+        # once the cart exists, and a cart changed meanwhile is skipped
+        order_ids = list(Order.objects.select_for_update().filter(
+            user_id__in=user_ids, ordered=False, updated_at__lt=before)
+            .values_list('pk', flat=True))
+
+        _release(list(StockReservation.objects.select_for_update().filter(
+            order_id__in=order_ids, committed=False)))
+        OrderItem.objects.filter(order__in=order_ids, ordered=False).delete()
+        Order.objects.filter(pk__in=order_ids).delete()
+
+    cache.delete_many([get_cart_count_key(user_id) for user_id in user_ids])
+    return len(order_ids)
+
+
+def reap_orphan_lines(batch_size=500):
+    """
+    Delete one batch of unpaid lines that belong to no order, returns how
+    many were deleted. Lines are created and added to their cart in one
+    transaction, so nothing reaches these anymore.
+    """
+    ids = list(OrderItem.objects.filter(ordered=False, order__isnull=True)
+        .order_by('pk').values_list('pk', flat=True)[:batch_size])
+    OrderItem.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def reap_cart_snapshots(before=None, batch_size=500):
+    """
+    Delete one batch of the CacheCartStore snapshots not written since
+    before, returns how many were deleted.
+    """
+    before = before or get_cutoff(settings.CART_ABANDON_AFTER)
+    ids = list(CartSnapshot.objects.filter(updated_at__lt=before)
+        .order_by('updated_at').values_list('pk', flat=True)[:batch_size])
+    CartSnapshot.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def get_archived_order(order):
+    return ArchivedOrder(
+        id=order.pk,
+        user_id=order.user_id,
+        ref_code=order.ref_code,
+        start_date=order.start_date,
+        ordered_date=order.ordered_date,
+        paid_at=order.payment.timestamp if order.payment_id else None,
+        shipping_address_id=order.shipping_address_id,
+        billing_address_id=order.billing_address_id,
+        payment_id=order.payment_id,
+        coupon_id=order.coupon_id,
+        being_delivered=order.being_delivered,
+        received=order.received,
+        subtotal_cents=order.subtotal_cents,
+        total_cents=order.total_cents,
+    )
+
+
+def get_archived_lines(order):
+    return [
+        ArchivedOrderLine(
+            order_id=order.pk,
+            item_id=order_item.item_id,
+            title=order_item.item.title,
+            category=order_item.item.category,
+            quantity=order_item.quantity,
+            line_cents=order_item.get_line_cents(),
+        )
+        for order_item in order.items.all()
+    ]
+
+
+def archive_orders(before=None, batch_size=500):
+    """
+    Move one batch of paid orders not changed since before
+    (ORDER_ARCHIVE_AFTER days ago by default) to the archive tables. Orders with a refund request
+    stay where the refund process can find them. Returns how many orders
+    were archived.
+    """
+    before = before or get_cutoff(settings.ORDER_ARCHIVE_AFTER)
+
+    with transaction.atomic():
+        orders = list(Order.objects.select_for_update(of=('self',))
+            .filter(ordered=True, updated_at__lt=before,
+                refund_requested=False, refund__isnull=True)
+            .select_related('payment')
+            .prefetch_related('items__item')
+            .order_by('updated_at')[:batch_size])
+        if not orders:
+            return 0
+
+        order_ids = [order.pk for order in orders]
+        ArchivedOrder.objects.bulk_create(
+            [get_archived_order(order) for order in orders])
+        ArchivedOrderLine.objects.bulk_create(
+            [line for order in orders for line in get_archived_lines(order)],
+            batch_size=500)
+
+        OrderItem.objects.filter(order__in=order_ids).delete()
+        Order.objects.filter(pk__in=order_ids).delete()
+
+    return len(orders)
+
+
+def iter_archived_orders(chunk_size=500):
+    """Archived orders with their lines, loaded one chunk per query."""
+    last_id = 0
+    while True:
+        orders = list(ArchivedOrder.objects.filter(pk__gt=last_id)
+            .prefetch_related('lines').order_by('pk')[:chunk_size])
+        yield from orders
+        if len(orders) < chunk_size:
+            return
+        last_id = orders[-1].pk
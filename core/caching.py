@@ -0,0 +1,94 @@
+import hashlib
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .search import get_search_terms
+
+
+CATALOG_VERSION_KEY = 'catalog:version'
+LISTING_HITS_KEY = 'catalog:listing:hits'
+LISTING_MISSES_KEY = 'catalog:listing:misses'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, 1, None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    # every cached listing embeds the version in its key, so bumping it
+    # invalidates all of them at once
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOG_VERSION_KEY, 1, None)
+        cache.incr(CATALOG_VERSION_KEY)
+
+
+def catalog_changed_receiver(sender, instance, *args, **kwargs):
+    # after the commit, a listing rendered before it would otherwise be
+    # cached under the new version
+    transaction.on_commit(bump_catalog_version)
+
+
+def get_listing_cache_key(category, q, page):
+    normalized = '|'.join([
+        (category or '').upper(),
+        ' '.join(get_search_terms(q)),
+        str(page or ''),
+    ])
+    digest = hashlib.md5(normalized.encode()).hexdigest()
+    return f'catalog:listing:{get_catalog_version()}:{digest}'
+
+
+def get_cached_listing(key):
+    listing = cache.get(key)
+    # only a sample of the lookups is counted, the ratio stays the same
+    # without two cache writes per request
+    if random.random() < settings.LISTING_STATS_SAMPLE_RATE:
+        counter = LISTING_MISSES_KEY if listing is None else LISTING_HITS_KEY
+        if not cache.add(counter, 1, None):
+            cache.incr(counter)
+    return listing
+
+
+def set_cached_listing(key, listing):
+    cache.set(key, listing, settings.LISTING_CACHE_TIMEOUT)
+
+
+def get_listing_cache_stats():
+    return {
+        'version': get_catalog_version(),
+        'hits': cache.get(LISTING_HITS_KEY, 0),
+        'misses': cache.get(LISTING_MISSES_KEY, 0),
+    }
+
+
+def get_cart_count_key(user_id):
+    return f'cart:count:{user_id}'
+
+
+def count_cart_items(user):
+    # number of lines in the active cart, asked from the cart store
+    from .cart import count_items
+    return count_items(user)
+
+
+def get_cart_item_count(user):
+    key = get_cart_count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = count_cart_items(user)
+        cache.set(key, count, settings.CART_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def set_cart_item_count(user, count):
+    cache.set(get_cart_count_key(user.pk), count,
+        settings.CART_COUNT_CACHE_TIMEOUT)
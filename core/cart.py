@@ -0,0 +1,465 @@
+import json
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .caching import set_cart_item_count
+from .models import User, Order, OrderItem, Item, CartSnapshot, to_cents
+from .tasks import task
+
+
+# status is one of: 'added', 'updated', 'removed', 'not_in_cart', 'no_order'
+CartUpdate = namedtuple('CartUpdate', ['status', 'order', 'order_item', 'count'])
+
+
+
+class CartBusy(Exception):
+    """The cart of the user stayed locked for CART_LOCK_TIMEOUT seconds."""
+
+
+
+class DatabaseCartStore:
+    """The active cart is the unpaid order of the user."""
+
+    def _lock_cart(self, user):
+        """
+        Serialize the cart mutations of one user by locking their cart row.
+        Before the first cart exists there is no such row, and creating one
+        is serialized on the user row instead.
+        """
+        carts = Order.objects.select_for_update(of=('self',)) \
+            .select_related('coupon').filter(user=user, ordered=False)
+        order = carts.first()
+        if order is None:
+            User.objects.select_for_update().only('pk').get(pk=user.pk)
+            # created by a concurrent request in the meantime
+            order = carts.first()
+        return order
+
+    def _get_order_item(self, order, item):
+        return order.items.select_related('item').filter(item=item).first()
+
+    def _remove_line(self, order_item):
+        # the line goes with its order item, nothing is left behind
+        OrderItem.objects.filter(pk=order_item.pk).delete()
+        order_item.quantity = 0
+
+    def _finish(self, user, status, order, order_item):
+        count = 0
+        if order is not None:
+            # totals and line count in one aggregate
+            count = order.update_totals()
+        transaction.on_commit(lambda: set_cart_item_count(user, count))
+        return CartUpdate(status, order, order_item, count)
+
+    def add_item(self, user, item):
+        """
+        Add one unit of item to the active cart of user, creating the cart
+        when needed.
+        """
+        with transaction.atomic():
+            order = self._lock_cart(user)
+
+            if order is None:
+                order = Order.objects.create(user=user,
+                    ordered_date=timezone.now())
+                order_item = None
+            else:
+                order_item = self._get_order_item(order, item)
+
+            if order_item is not None:
+                OrderItem.objects.filter(pk=order_item.pk).update(
+                    quantity=F('quantity') + 1)
+                # the row is locked through the cart, no need to read it back
+                order_item.quantity += 1
+                return self._finish(user, 'updated', order, order_item)
+
+            order_item = OrderItem.objects.create(item=item, user=user)
+            order.items.add(order_item)
+            return self._finish(user, 'added', order, order_item)
+
+    def remove_item(self, user, item):
+        """
+        Remove the whole line of item from the active cart of user.
+        """
+        with transaction.atomic():
+            order = self._lock_cart(user)
+            if order is None:
+                return self._finish(user, 'no_order', None, None)
+
+            order_item = self._get_order_item(order, item)
+            if order_item is None:
+                return self._finish(user, 'not_in_cart', order, None)
+
+            self._remove_line(order_item)
+            return self._finish(user, 'removed', order, order_item)
+
+    def remove_single_item(self, user, item):
+        """
+        Remove one unit of item from the active cart of user, the line is
+        removed with its last unit.
+        """
+        with transaction.atomic():
+            order = self._lock_cart(user)
+            if order is None:
+                return self._finish(user, 'no_order', None, None)
+
+            order_item = self._get_order_item(order, item)
+            if order_item is None:
+                return self._finish(user, 'not_in_cart', order, None)
+
+            if order_item.quantity > 1:
+                OrderItem.objects.filter(pk=order_item.pk).update(
+                    quantity=F('quantity') - 1)
+                order_item.quantity -= 1
+                return self._finish(user, 'updated', order, order_item)
+
+            self._remove_line(order_item)
+            return self._finish(user, 'removed', order, order_item)
+
+    def count_items(self, user):
+        # number of lines in the active cart, in one query
+        return Order.items.through.objects.filter(
+            order__user=user, order__ordered=False).count()
+
+    def get_cart(self, user):
+        order = Order.objects.with_items().filter(user=user,
+            ordered=False).first()
+        if order is not None:
+            order.refresh_totals()
+        return order
+
+    def get_order(self, user, with_items=False):
+        queryset = Order.objects.with_items() if with_items else Order.objects.all()
+        return queryset.get(user=user, ordered=False)
+
+    def clear(self, user):
+        # the paid order is not the active cart anymore
+        pass
+
+
+
+def get_unit_cents(item):
+    # same price as Order.get_subtotal_cents
+    return to_cents(item.discount_price or item.price)
+
+
+def get_cart_key(user_id):
+    return f'cart:{user_id}'
+
+
+
+class CartLines:
+    def __init__(self, order_items):
+        self.order_items = order_items
+
+    def all(self):
+        return self.order_items
+
+    def count(self):
+        return len(self.order_items)
+
+
+
+class CachedCart:
+    """
+    The part of Order the cart views and templates use, for a cart that
+    only exists in the cache.
+    """
+    pk = None
+    coupon = None
+    coupon_id = None
+
+    def __init__(self, subtotal_cents, order_items=()):
+        self.subtotal_cents = subtotal_cents
+        self.total_cents = subtotal_cents
+        self.items = CartLines(list(order_items))
+
+    def get_total(self):
+        return self.total_cents / 100
+
+
+
+class CacheCartStore:
+    """
+    The active cart is one cached record per user:
+    {'v': version, 'm': version last copied to the order,
+     'lines': [[item id, quantity, unit price in cents], ...]}.
+
+    Changes are written behind to CartSnapshot by the flush_cart task, at
+    most once per CART_FLUSH_DELAY seconds per user, and the snapshot is
+    read when the cache lost the record. The Order and OrderItem rows are
+    only written when the user goes to checkout (get_order).
+    """
+
+    @contextmanager
+    def _lock(self, user):
+        # serializes the read-modify-write of the record, a lock left by a
+        # crashed process expires after CART_LOCK_TIMEOUT
+        key = f'cart:lock:{user.pk}'
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + settings.CART_LOCK_TIMEOUT
+        while not cache.add(key, token, settings.CART_LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                raise CartBusy()
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            if cache.get(key) == token:
+                cache.delete(key)
+
+    def _load(self, user):
+        record = cache.get(get_cart_key(user.pk))
+        if record is None:
+            snapshot = CartSnapshot.objects.filter(user=user).first()
+            if snapshot is None:
+                return None
+            record = json.loads(snapshot.data)
+            cache.set(get_cart_key(user.pk), record, settings.CART_CACHE_TIMEOUT)
+        return record
+
+    def _find_line(self, record, item):
+        for line in record['lines']:
+            if line[0] == item.pk:
+                return line
+        return None
+
+    def _get_cached_cart(self, record):
+        # totals at the prices the lines were added with
+        return CachedCart(sum(quantity * unit_cents
+            for item_id, quantity, unit_cents in record['lines']))
+
+    def _save(self, user, record, status, item, quantity):
+        record['v'] += 1
+        cache.set(get_cart_key(user.pk), record, settings.CART_CACHE_TIMEOUT)
+
+        # one pending flush per user, it writes the latest record
+        if cache.add(f'cart:flush:{user.pk}', 1, settings.CART_FLUSH_DELAY):
+            flush_cart.schedule(timezone.now() +
+                timedelta(seconds=settings.CART_FLUSH_DELAY), user.pk)
+
+        count = len(record['lines'])
+        set_cart_item_count(user, count)
+        order_item = OrderItem(user=user, item=item, quantity=quantity)
+        return CartUpdate(status, self._get_cached_cart(record), order_item,
+            count)
+
+    def add_item(self, user, item):
+        with self._lock(user):
+            record = self._load(user) or {'v': 0, 'm': 0, 'lines': []}
+            line = self._find_line(record, item)
+            if line is None:
+                line = [item.pk, 1, get_unit_cents(item)]
+                record['lines'].append(line)
+                status = 'added'
+            else:
+                line[1] += 1
+                line[2] = get_unit_cents(item)
+                status = 'updated'
+            return self._save(user, record, status, item, line[1])
+
+    def remove_item(self, user, item):
+        with self._lock(user):
+            record = self._load(user)
+            if record is None:
+                return CartUpdate('no_order', None, None, 0)
+
+            line = self._find_line(record, item)
+            if line is None:
+                return CartUpdate('not_in_cart', self._get_cached_cart(record),
+                    None, len(record['lines']))
+
+            record['lines'].remove(line)
+            return self._save(user, record, 'removed', item, 0)
+
+    def remove_single_item(self, user, item):
+        with self._lock(user):
+            record = self._load(user)
+            if record is None:
+                return CartUpdate('no_order', None, None, 0)
+
+            line = self._find_line(record, item)
+            if line is None:
+                return CartUpdate('not_in_cart', self._get_cached_cart(record),
+                    None, len(record['lines']))
+
+            if line[1] > 1:
+                line[1] -= 1
+                return self._save(user, record, 'updated', item, line[1])
+
+            record['lines'].remove(line)
+            return self._save(user, record, 'removed', item, 0)
+
+    def count_items(self, user):
+        record = self._load(user)
+        return len(record['lines']) if record else 0
+
+    def get_cart(self, user):
+        record = self._load(user)
+        if record is None:
+            return None
+
+        # current prices, items removed from the catalog are left out
+        items = Item.objects.in_bulk([line[0] for line in record['lines']])
+        order_items = [
+            OrderItem(user=user, item=items[item_id], quantity=quantity)
+            for item_id, quantity, unit_cents in record['lines']
+            if item_id in items
+        ]
+        subtotal = sum(to_cents(order_item.get_final_price())
+            for order_item in order_items)
+        return CachedCart(subtotal, order_items)
+
+    def _materialize(self, user, force=False):
+        """Make the unpaid order of user match the cached cart."""
+        with self._lock(user):
+            record = self._load(user)
+            if record is None or (record['m'] == record['v'] and not force):
+                return
+
+            wanted = {item_id: quantity
+                for item_id, quantity, unit_cents in record['lines']}
+            existing_items = set(Item.objects.filter(pk__in=wanted)
+                .values_list('pk', flat=True))
+
+            with transaction.atomic():
+                User.objects.select_for_update().only('pk').get(pk=user.pk)
+                order = Order.objects.filter(user=user, ordered=False).first()
+                if order is None and wanted:
+                    order = Order.objects.create(user=user,
+                        ordered_date=timezone.now())
+
+                if order is not None:
+                    lines = {order_item.item_id: order_item
+                        for order_item in order.items.all()}
+                    stale = [order_item for item_id, order_item in lines.items()
+                        if item_id not in wanted]
+                    if stale:
+                        order.items.remove(*stale)
+                        OrderItem.objects.filter(
+                            pk__in=[order_item.pk for order_item in stale]).delete()
+
+                    for item_id, quantity in wanted.items():
+                        order_item = lines.get(item_id)
+                        if item_id not in existing_items or (order_item is not None
+                                and order_item.quantity == quantity):
+                            continue
+                        # looked up in the order, so a materialization that
+                        # runs again never adds a line twice
+                        order.items.update_or_create(item_id=item_id,
+                            defaults={'user': user, 'quantity': quantity})
+                    order.update_totals()
+
+            record['m'] = record['v']
+            cache.set(get_cart_key(user.pk), record, settings.CART_CACHE_TIMEOUT)
+
+    def get_order(self, user, with_items=False):
+        queryset = Order.objects.with_items() if with_items else Order.objects.all()
+        self._materialize(user)
+        try:
+            return queryset.get(user=user, ordered=False)
+        except Order.DoesNotExist:
+            # the order was deleted since, e.g. by reap_carts
+            self._materialize(user, force=True)
+            return queryset.get(user=user, ordered=False)
+
+    def clear(self, user):
+        try:
+            with self._lock(user):
+                self._delete(user)
+        except CartBusy:
+            # the order is paid either way, only a cart change racing
+            # with the payment could be lost
+            self._delete(user)
+        set_cart_item_count(user, 0)
+
+    def _delete(self, user):
+        cache.delete(get_cart_key(user.pk))
+        CartSnapshot.objects.filter(user=user).delete()
+
+
+
+@task
+def flush_cart(user_id):
+    """Write the cached cart of the user to its CartSnapshot."""
+    record = cache.get(get_cart_key(user_id))
+    if record is None:
+        # cleared, or evicted and then the snapshot is all there is
+        return
+
+    data = json.dumps(record)
+    updated = CartSnapshot.objects.filter(user_id=user_id,
+        version__lt=record['v']).update(data=data, version=record['v'],
+            updated_at=timezone.now())
+    if not updated:
+        try:
+            with transaction.atomic():
+                CartSnapshot.objects.create(user_id=user_id, data=data,
+                    version=record['v'])
+        except IntegrityError:
+            # the snapshot is already as new
+            pass
+
+
+
+_stores = {}
+
+
+def get_cart_store():
+    path = settings.CART_STORE
+    if path not in _stores:
+        _stores[path] = import_string(path)()
+    return _stores[path]
+
+
+def add_item(user, item):
+    """
+    Add one unit of item to the active cart of user, creating the cart
+    when needed.
+    """
+    return get_cart_store().add_item(user, item)
+
+
+def remove_item(user, item):
+    """Remove the whole line of item from the active cart of user."""
+    return get_cart_store().remove_item(user, item)
+
+
+def remove_single_item(user, item):
+    """
+    Remove one unit of item from the active cart of user, the line is
+    removed with its last unit.
+    """
+    return get_cart_store().remove_single_item(user, item)
+
+
+def count_items(user):
+    return get_cart_store().count_items(user)
+
+
+def get_cart(user):
+    """The active cart of user for display, None when there is none."""
+    return get_cart_store().get_cart(user)
+
+
+def get_order(user, with_items=False):
+    """
+    The unpaid order holding the active cart of user, for checkout and
+    payment. Raises Order.DoesNotExist when there is none.
+    """
+    return get_cart_store().get_order(user, with_items)
+
+
+def clear(user):
+    """Called once the active order was paid."""
+    get_cart_store().clear(user)
@@ -0,0 +1,158 @@
+import hashlib
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+COUPON_VERSION_KEY = 'coupons:version'
+COUPON_FILTER_KEY = 'coupons:filter:{version}'
+COUPON_KEY = 'coupons:code:{version}:{code}'
+
+# cached marker for codes that passed the bloom filter but do not exist
+MISSING = 'missing'
+
+
+
+class BloomFilter:
+    """
+    Compact set of the valid coupon codes. "Not in the filter" is always
+    right, "in the filter" is wrong with probability false_positive_rate.
+    """
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits or bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        capacity = max(capacity, 1)
+        size = max(64, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hashes)
+
+    def _positions(self, value):
+        # double hashing, two 64 bit halves of one sha256
+        digest = hashlib.sha256(value.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(value))
+
+
+
+def get_coupon_version():
+    version = cache.get(COUPON_VERSION_KEY)
+    if version is None:
+        cache.add(COUPON_VERSION_KEY, 1, None)
+        version = cache.get(COUPON_VERSION_KEY, 1)
+    return version
+
+
+def bump_coupon_version():
+    # a new version makes every process rebuild its filter and drops the
+    # cached lookups
+    try:
+        cache.incr(COUPON_VERSION_KEY)
+    except ValueError:
+        cache.add(COUPON_VERSION_KEY, 1, None)
+        cache.incr(COUPON_VERSION_KEY)
+
+
+def coupons_changed_receiver(sender, instance, *args, **kwargs):
+    # after the commit, a filter built before it would otherwise be
+    # shared under the new version
+    transaction.on_commit(bump_coupon_version)
+
+
+def build_filter():
+    from .models import Coupon
+
+    codes = list(Coupon.objects.values_list('code', flat=True))
+    bloom = BloomFilter.for_capacity(len(codes),
+        settings.COUPON_FILTER_FALSE_POSITIVE_RATE)
+    for code in codes:
+        bloom.add(code)
+    return bloom
+
+
+# (version, filter) of this process
+_local_filter = (None, None)
+
+
+def get_filter(version):
+    global _local_filter
+    local_version, bloom = _local_filter
+    if local_version == version:
+        return bloom
+
+    key = COUPON_FILTER_KEY.format(version=version)
+    shared = cache.get(key)
+    if shared is not None:
+        bloom = BloomFilter(*shared)
+    else:
+        bloom = build_filter()
+        cache.set(key, (bloom.size, bloom.hashes, bytes(bloom.bits)), None)
+
+    _local_filter = (version, bloom)
+    return bloom
+
+
+def lookup_coupon(code):
+    """
+    The coupon with this code, None when it does not exist. Codes that
+    are not in the bloom filter are rejected without any query.
+    """
+    from .models import Coupon
+
+    version = get_coupon_version()
+    if code not in get_filter(version):
+        return None
+
+    key = COUPON_KEY.format(version=version,
+        code=hashlib.md5(code.encode()).hexdigest())
+    cached = cache.get(key)
+    if cached == MISSING:
+        return None
+    if cached is not None:
+        pk, amount = cached
+        return Coupon(pk=pk, code=code, amount=amount)
+
+    coupon = Coupon.objects.filter(code=code).first()
+    if coupon is None:
+        cache.set(key, MISSING, settings.COUPON_CACHE_TIMEOUT)
+    else:
+        cache.set(key, (coupon.pk, coupon.amount), settings.COUPON_CACHE_TIMEOUT)
+    return coupon
+
+
+def get_attempt_keys(request):
+    keys = [f"coupons:attempts:ip:{request.META.get('REMOTE_ADDR')}"]
+    if request.user.is_authenticated:
+        keys.append(f'coupons:attempts:user:{request.user.pk}')
+    return keys
+
+
+def is_throttled(request):
+    return any(
+        cache.get(key, 0) >= settings.COUPON_ATTEMPT_LIMIT
+        for key in get_attempt_keys(request)
+    )
+
+
+def record_failed_attempt(request):
+    for key in get_attempt_keys(request):
+        if not cache.add(key, 1, settings.COUPON_ATTEMPT_WINDOW):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, 1, settings.COUPON_ATTEMPT_WINDOW)
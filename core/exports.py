@@ -0,0 +1,229 @@
+import csv
+import heapq
+import json
+
+from django.conf import settings
+from django.db.models import Prefetch, Q
+from django.http import StreamingHttpResponse
+
+from .models import Order, OrderItem, ArchivedOrder, ArchivedOrderLine
+
+
+CSV_FIELDS = [
+    'order_id',
+    'ref_code',
+    'username',
+    'start_date',
+    'ordered_date',
+    'ordered',
+    'being_delivered',
+    'received',
+    'refund_requested',
+    'refund_granted',
+    'coupon',
+    'subtotal',
+    'total',
+    'payment_id',
+    'stripe_charge_id',
+    'payment_amount',
+    'payment_timestamp',
+    'item_id',
+    'item_slug',
+    'item_title',
+    'quantity',
+    'line_total',
+]
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_chunks(queryset, since=None, after_id=None, until=None,
+        chunk_size=None):
+    # keyset iteration by (start_date, id), one chunk per query
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    queryset = queryset.order_by('start_date', 'id')
+    if until is not None:
+        queryset = queryset.filter(start_date__lt=until)
+
+    while True:
+        chunk = queryset
+        if since is not None and after_id is not None:
+            chunk = chunk.filter(Q(start_date__gt=since) |
+                Q(start_date=since, id__gt=after_id))
+        elif since is not None:
+            chunk = chunk.filter(start_date__gte=since)
+
+        orders = list(chunk[:chunk_size])
+        yield from orders
+        if len(orders) < chunk_size:
+            return
+        since, after_id = orders[-1].start_date, orders[-1].pk
+
+
+def iter_orders(queryset=None, **kwargs):
+    """
+    Orders by (start_date, id) with their user, payment, coupon and items,
+    loaded one chunk per query. Only one chunk is held in memory, and an
+    interrupted export resumes from the start_date and id of the last
+    order written.
+    """
+    queryset = Order.objects.all() if queryset is None else queryset
+    return iter_chunks(queryset.select_related('user', 'payment', 'coupon')
+        .prefetch_related(Prefetch('items',
+            queryset=OrderItem.objects.select_related('item'))), **kwargs)
+
+
+def iter_all_orders(queryset=None, **kwargs):
+    """
+    The orders of iter_orders and the archived orders merged by
+    (start_date, id). An archived order keeps the id it had, so the two
+    resume from the same position.
+    """
+    archived = iter_chunks(ArchivedOrder.objects
+        .select_related('user', 'payment', 'coupon')
+        .prefetch_related(Prefetch('lines',
+            queryset=ArchivedOrderLine.objects.select_related('item'))),
+        **kwargs)
+    return heapq.merge(iter_orders(queryset, **kwargs), archived,
+        key=lambda order: (order.start_date, order.pk))
+
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+
+def get_order_record(order):
+    if isinstance(order, ArchivedOrder):
+        return get_archived_order_record(order)
+
+    payment = order.payment
+    return {
+        'order_id': order.pk,
+        'ref_code': order.ref_code,
+        'username': order.user.username,
+        'start_date': isoformat(order.start_date),
+        'ordered_date': isoformat(order.ordered_date),
+        'ordered': order.ordered,
+        'being_delivered': order.being_delivered,
+        'received': order.received,
+        'refund_requested': order.refund_requested,
+        'refund_granted': order.refund_granted,
+        'coupon': order.coupon.code if order.coupon else None,
+        'subtotal': order.subtotal_cents / 100,
+        'total': order.total_cents / 100,
+        'payment': {
+            'id': payment.pk,
+            'stripe_charge_id': payment.stripe_charge_id,
+            'amount': payment.amount,
+            'timestamp': isoformat(payment.timestamp),
+        } if payment else None,
+        'items': [
+            {
+                'id': order_item.item_id,
+                'slug': order_item.item.slug,
+                'title': order_item.item.title,
+                'quantity': order_item.quantity,
+                'line_total': order_item.get_line_cents() / 100,
+            }
+            for order_item in order.items.all()
+        ],
+    }
+
+
+def get_archived_order_record(order):
+    payment = order.payment
+    return {
+        'order_id': order.pk,
+        'ref_code': order.ref_code,
+        'username': order.user.username,
+        'start_date': isoformat(order.start_date),
+        'ordered_date': isoformat(order.ordered_date),
+        # only paid orders without a refund are archived
+        'ordered': True,
+        'being_delivered': order.being_delivered,
+        'received': order.received,
+        'refund_requested': False,
+        'refund_granted': False,
+        'coupon': order.coupon.code if order.coupon else None,
+        'subtotal': order.subtotal_cents / 100,
+        'total': order.total_cents / 100,
+        'payment': {
+            'id': payment.pk,
+            'stripe_charge_id': payment.stripe_charge_id,
+            'amount': payment.amount,
+            'timestamp': isoformat(payment.timestamp),
+        } if payment else None,
+        'items': [
+            {
+                'id': line.item_id,
+                # the item may have been deleted since
+                'slug': line.item.slug if line.item else None,
+                'title': line.title,
+                'quantity': line.quantity,
+                'line_total': line.line_cents / 100,
+            }
+            for line in order.lines.all()
+        ],
+    }
+
+
+def get_csv_rows(record):
+    # one row per order line, orders without lines get one row
+    order = {key: value for key, value in record.items()
+        if key not in ('payment', 'items')}
+    payment = record['payment'] or {}
+    order.update({
+        'payment_id': payment.get('id'),
+        'stripe_charge_id': payment.get('stripe_charge_id'),
+        'payment_amount': payment.get('amount'),
+        'payment_timestamp': payment.get('timestamp'),
+    })
+
+    for item in record['items'] or [{}]:
+        yield dict(order,
+            item_id=item.get('id'),
+            item_slug=item.get('slug'),
+            item_title=item.get('title'),
+            quantity=item.get('quantity'),
+            line_total=item.get('line_total'),
+        )
+
+
+
+class Echo:
+    """File-like object for csv.writer, returns the line it is given."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(orders):
+    writer = csv.DictWriter(Echo(), fieldnames=CSV_FIELDS)
+    yield writer.writeheader()
+    for order in orders:
+        for row in get_csv_rows(get_order_record(order)):
+            yield writer.writerow(row)
+
+
+def stream_ndjson(orders):
+    for order in orders:
+        yield json.dumps(get_order_record(order)) + '\n'
+
+
+def stream_orders(format, orders):
+    if format == 'csv':
+        return stream_csv(orders)
+    if format == 'ndjson':
+        return stream_ndjson(orders)
+    raise ValueError(f'Unknown export format {format}')
+
+
+def export_response(queryset, format, **kwargs):
+    response = StreamingHttpResponse(
+        stream_orders(format, iter_orders(queryset, **kwargs)),
+        content_type=CONTENT_TYPES[format])
+    response['Content-Disposition'] = f'attachment; filename="orders.{format}"'
+    return response
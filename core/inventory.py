@@ -0,0 +1,158 @@
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import StockShard, StockReservation
+
+
+class OutOfStock(Exception):
+    def __init__(self, item):
+        super().__init__(f'{item} is out of stock')
+        self.item = item
+
+
+
+def set_stock(item, quantity, shards=None):
+    """
+    Spread quantity over the stock shards of item, the units currently
+    reserved stay reserved. Items without shards are not tracked and can
+    always be bought.
+    """
+    shards = shards or settings.STOCK_SHARDS
+    per_shard, extra = divmod(quantity, shards)
+    available = [per_shard + (1 if i < extra else 0) for i in range(shards)]
+
+    with transaction.atomic():
+        existing = dict(StockShard.objects.select_for_update().filter(
+            item=item).order_by('shard').values_list('shard', 'pk'))
+
+        # reservations point at the shards, so the rows are updated in
+        # place and shards beyond the new count are only emptied
+        for shard, pk in existing.items():
+            StockShard.objects.filter(pk=pk).update(
+                available=available[shard] if shard < shards else 0)
+        StockShard.objects.bulk_create([
+            StockShard(item=item, shard=i, available=available[i])
+            for i in range(shards) if i not in existing
+        ])
+
+
+def get_available(item):
+    """Units left of item, None when its stock is not tracked."""
+    return StockShard.objects.filter(item=item).aggregate(
+        available=Sum('available'))['available']
+
+
+def _reserve_from_one_shard(shard_ids, quantity):
+    # a random starting shard spreads concurrent buyers over the rows,
+    # each attempt is a single conditional UPDATE
+    shard_ids = list(shard_ids)
+    random.shuffle(shard_ids)
+    for pk in shard_ids:
+        updated = StockShard.objects.filter(pk=pk,
+            available__gte=quantity).update(available=F('available') - quantity)
+        if updated:
+            return [(pk, quantity)]
+    return None
+
+
+def _reserve_from_many_shards(item, quantity):
+    # no single shard is big enough, gather the units under row locks
+    taken = []
+    remaining = quantity
+    shards = StockShard.objects.select_for_update().filter(item=item,
+        available__gt=0).order_by('shard')
+
+    for shard in shards:
+        take = min(shard.available, remaining)
+        StockShard.objects.filter(pk=shard.pk).update(
+            available=F('available') - take)
+        taken.append((shard.pk, take))
+        remaining -= take
+        if not remaining:
+            return taken
+    return None
+
+
+def reserve(order, item, quantity, expires_at, shard_ids=None):
+    if shard_ids is None:
+        shard_ids = list(StockShard.objects.filter(item=item)
+            .values_list('pk', flat=True))
+    if not shard_ids:
+        return []
+
+    with transaction.atomic():
+        taken = _reserve_from_one_shard(shard_ids, quantity) or \
+            _reserve_from_many_shards(item, quantity)
+        if taken is None:
+            raise OutOfStock(item)
+
+        return StockReservation.objects.bulk_create([
+            StockReservation(order=order, shard_id=pk, quantity=take,
+                expires_at=expires_at)
+            for pk, take in taken
+        ])
+
+
+def _release(reservations):
+    for reservation in reservations:
+        StockShard.objects.filter(pk=reservation.shard_id).update(
+            available=F('available') + reservation.quantity)
+    StockReservation.objects.filter(
+        pk__in=[reservation.pk for reservation in reservations]).delete()
+
+
+def release_order(order):
+    with transaction.atomic():
+        _release(list(StockReservation.objects.select_for_update().filter(
+            order=order, committed=False)))
+
+
+def reserve_order(order):
+    """
+    Reserve every line of the order for STOCK_RESERVATION_TIMEOUT seconds,
+    replacing its earlier reservations. Raises OutOfStock and keeps
+    nothing reserved when a line cannot be served.
+    """
+    expires_at = timezone.now() + timedelta(
+        seconds=settings.STOCK_RESERVATION_TIMEOUT)
+
+    with transaction.atomic():
+        release_order(order)
+
+        order_items = list(order.items.select_related('item'))
+        shard_ids = defaultdict(list)
+        for item_id, pk in StockShard.objects.filter(
+                item__in=[order_item.item_id for order_item in order_items]
+                ).values_list('item_id', 'pk'):
+            shard_ids[item_id].append(pk)
+
+        # untracked items have no shards and need no reservation
+        for order_item in order_items:
+            if shard_ids[order_item.item_id]:
+                reserve(order, order_item.item, order_item.quantity,
+                    expires_at, shard_ids[order_item.item_id])
+
+
+def commit_order(order):
+    """The order was paid, its reserved units are sold."""
+    StockReservation.objects.filter(order=order, committed=False).update(
+        committed=True)
+
+
+def release_expired(batch_size=500):
+    """
+    Put the units of abandoned checkouts back on sale, returns how many
+    reservations were released.
+    """
+    with transaction.atomic():
+        reservations = list(StockReservation.objects.select_for_update().filter(
+            committed=False, expires_at__lt=timezone.now()
+        ).order_by('expires_at')[:batch_size])
+        _release(reservations)
+    return len(reservations)
@@ -0,0 +1,77 @@
+import base64
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .tasks import task
+
+
+@task
+def send_email(subject, body, from_email, to, cc, bcc, reply_to, headers,
+        alternatives, attachments=(), content_subtype='plain'):
+    message = EmailMultiAlternatives(subject, body, from_email, to, bcc,
+        cc=cc, reply_to=reply_to, headers=headers,
+        connection=get_connection(settings.TASK_EMAIL_BACKEND))
+    message.content_subtype = content_subtype
+    for content, mimetype in alternatives:
+        message.attach_alternative(content, mimetype)
+    for filename, content, mimetype, encoded in attachments:
+        if encoded:
+            content = base64.b64decode(content)
+        message.attach(filename, content, mimetype)
+    message.send()
+
+
+def serialize_attachment(attachment):
+    """
+    [filename, content, mimetype, encoded] of an attachment, binary
+    content is base64 encoded so the task arguments stay json.
+    """
+    if isinstance(attachment, MIMEBase):
+        raise ValueError('MIMEBase attachments cannot be queued, attach '
+            '(filename, content, mimetype) instead')
+
+    filename, content, mimetype = attachment
+    if isinstance(content, bytes):
+        return [filename, base64.b64encode(content).decode('ascii'),
+            mimetype, True]
+    return [filename, content, mimetype, False]
+
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """
+    Queues every message as a task, the run_tasks worker sends it with
+    TASK_EMAIL_BACKEND. Attachments must be (filename, content, mimetype),
+    a message with a MIMEBase attachment is rejected.
+    """
+
+    def send_messages(self, email_messages):
+        sent = 0
+        for message in email_messages:
+            try:
+                attachments = [serialize_attachment(attachment)
+                    for attachment in message.attachments]
+            except ValueError:
+                if not self.fail_silently:
+                    raise
+                continue
+
+            send_email.delay(
+                str(message.subject),
+                str(message.body),
+                message.from_email,
+                list(message.to),
+                list(message.cc),
+                list(message.bcc),
+                list(message.reply_to),
+                dict(message.extra_headers),
+                [list(alternative) for alternative in
+                    getattr(message, 'alternatives', [])],
+                attachments=attachments,
+                content_subtype=message.content_subtype,
+            )
+            sent += 1
+        return sent
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Move old paid orders to the archive tables, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+            help='Age of the orders to archive, defaults to ORDER_ARCHIVE_AFTER')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        before = None
+        if options['days'] is not None:
+            before = timezone.now() - timedelta(days=options['days'])
+
+        total = 0
+        while True:
+            count = archive_orders(before, options['batch_size'])
+            total += count
+            if count < options['batch_size']:
+                break
+        self.stdout.write(f'Archived {total} orders.')
@@ -0,0 +1,83 @@
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.utils import timezone
+
+from core.inventory import set_stock, reserve, get_available, OutOfStock
+from core.models import User, Item, Order
+
+
+class Command(BaseCommand):
+    help = 'Measure reservation throughput of N concurrent buyers of one item'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=32)
+        parser.add_argument('--stock', type=int, default=2000)
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 8],
+            help='Shard counts to compare')
+
+    def handle(self, *args, **options):
+        # unique names, so runs never collide with each other or with
+        # what a crashed run left behind
+        name = f'stock-benchmark-{uuid.uuid4().hex[:8]}'
+        user = User.objects.create_user(name)
+        item = None
+        try:
+            item = Item.objects.create(title='Stock benchmark', price=1,
+                category='S', label='P', slug=name, description='', image='')
+            orders = [
+                Order.objects.create(user=user, ordered_date=timezone.now())
+                for _ in range(options['buyers'])
+            ]
+            for shards in options['shards']:
+                self.run(item, orders, options['stock'], shards)
+        finally:
+            # shards, reservations and orders go with them
+            if item is not None:
+                item.delete()
+            user.delete()
+
+    def run(self, item, orders, stock, shards):
+        set_stock(item, stock, shards)
+        expires_at = timezone.now() + timedelta(hours=1)
+        counts = [0] * len(orders)
+        retries = [0] * len(orders)
+        barrier = threading.Barrier(len(orders))
+
+        def buyer(i):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        reserve(orders[i], item, 1, expires_at)
+                        counts[i] += 1
+                    except OutOfStock:
+                        return
+                    except OperationalError:
+                        # database level lock contention (sqlite)
+                        retries[i] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buyer, args=(i,))
+            for i in range(len(orders))]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        sold = sum(counts)
+        left = get_available(item)
+        self.stdout.write(
+            f'{shards} shard(s), {len(orders)} buyers: {sold} reservations '
+            f'in {elapsed:.2f}s ({sold / elapsed:.0f}/s), '
+            f'{sum(retries)} lock retries, {left} left'
+        )
+        if sold + left != stock:
+            self.stderr.write(self.style.ERROR('Stock count mismatch!'))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.outbox import drain
+
+
+class Command(BaseCommand):
+    help = 'Process the post-payment work queued in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=5,
+            help='Seconds to sleep when the outbox is empty')
+        parser.add_argument('--once', action='store_true',
+            help='Drain the pending messages and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            count = drain(options['batch_size'])
+            if count:
+                self.stdout.write(f'Processed {count} messages.')
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,78 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import dateparse, timezone
+
+from core.exports import iter_all_orders, stream_orders
+
+
+def parse_date(value):
+    """An aware datetime, dates and naive times are in the current timezone."""
+    try:
+        date = dateparse.parse_datetime(value)
+        if date is None:
+            day = dateparse.parse_date(value)
+            date = datetime.combine(day, time.min) if day else None
+    except ValueError:
+        date = None
+    if date is None:
+        raise CommandError(f'Invalid date {value}, use ISO 8601')
+
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream orders with their items and payment as CSV or NDJSON, '
+        'ordered by start date, the archived orders included. An '
+        'interrupted export is resumed with the --since and --after-id '
+        'printed on stderr.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--since', type=parse_date,
+            help='First start_date to export (ISO 8601)')
+        parser.add_argument('--after-id', type=int,
+            help='Skip the orders of --since up to this id')
+        parser.add_argument('--until', type=parse_date,
+            help='Export orders started before this date')
+        parser.add_argument('--ordered', action='store_true',
+            help='Only paid orders, archived orders are all paid')
+        parser.add_argument('--output', help='Defaults to stdout')
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        from core.models import Order
+
+        queryset = Order.objects.all()
+        if options['ordered']:
+            queryset = queryset.filter(ordered=True)
+
+        self.last = None
+        orders = self.track(iter_all_orders(queryset,
+            since=options['since'], after_id=options['after_id'],
+            until=options['until'], chunk_size=options['chunk_size']))
+
+        output = open(options['output'], 'w', newline='', encoding='utf-8') \
+            if options['output'] else None
+        try:
+            for chunk in stream_orders(options['format'], orders):
+                if output is None:
+                    self.stdout.write(chunk, ending='')
+                else:
+                    output.write(chunk)
+        finally:
+            if output is not None:
+                output.close()
+            if self.last is not None:
+                self.stderr.write(f'Last order: --since '
+                    f'{self.last.start_date.isoformat()} --after-id {self.last.pk}')
+
+    def track(self, orders):
+        for order in orders:
+            yield order
+            self.last = order
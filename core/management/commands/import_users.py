@@ -0,0 +1,220 @@
+import csv
+import json
+import time
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.models import User, UserProfile, Address, get_address_hash
+
+
+USER_FIELDS = ['email', 'first_name', 'last_name']
+ADDRESS_FIELDS = ['street_address', 'apartment_address', 'country', 'zip']
+
+
+def read_jsonl(f):
+    """Yields (line number, record or the error of the line)."""
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, f'invalid json: {e}'
+            continue
+        if not isinstance(record, dict):
+            yield number, 'not a json object'
+            continue
+        yield number, record
+
+
+def read_csv(f):
+    """
+    One user per row. Optional shipping_<field> and billing_<field>
+    columns (street_address, apartment_address, country, zip) become the
+    default addresses of the user.
+    """
+    reader = csv.DictReader(f)
+    for row in reader:
+        addresses = []
+        for prefix, address_type in (('shipping_', 'S'), ('billing_', 'B')):
+            address = {field: row.pop(prefix + field, '') for field in ADDRESS_FIELDS}
+            if address['street_address']:
+                address.update(address_type=address_type, default=True)
+                addresses.append(address)
+        row['addresses'] = addresses
+        yield reader.line_num, row
+
+
+def is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def validate_text(values, model, field):
+    """The value of field must fit the column of model, when given."""
+    value = values.get(field)
+    if value is None or value == '':
+        return
+    if not isinstance(value, str):
+        raise ValidationError(f'{field} is not a string')
+    max_length = model._meta.get_field(field).max_length
+    if len(value) > max_length:
+        raise ValidationError(
+            f'{field} is longer than {max_length} characters')
+
+
+def validate(record):
+    """Raises ValidationError with what is wrong with the record."""
+    username = record.get('username')
+    if not isinstance(username, str) or not username.strip():
+        raise ValidationError('username is missing')
+    User.username_validator(username)
+    validate_text(record, User, 'username')
+    for field in USER_FIELDS:
+        validate_text(record, User, field)
+    validate_text(record, UserProfile, 'stripe_customer_id')
+
+    # a plain text password would be stored as a broken hash
+    password = record.get('password')
+    if password:
+        if not isinstance(password, str):
+            raise ValidationError('password is not a Django password hash')
+        try:
+            identify_hasher(password)
+        except ValueError:
+            raise ValidationError('password is not a Django password hash')
+        validate_text(record, User, 'password')
+
+    addresses = record.get('addresses') or []
+    if not isinstance(addresses, list):
+        raise ValidationError('addresses is not a list')
+    for address in addresses:
+        if not isinstance(address, dict):
+            raise ValidationError('address is not an object')
+        if address.get('address_type') not in ('S', 'B'):
+            raise ValidationError('address_type must be S or B')
+        if not address.get('street_address'):
+            raise ValidationError('address without street_address')
+        for field in ADDRESS_FIELDS:
+            validate_text(address, Address, field)
+
+
+class Command(BaseCommand):
+    help = (
+        'Import users with their profiles and addresses from a CSV or JSONL '
+        'file using bulk inserts. Passwords must be Django password hashes, '
+        'users without one get an unusable password. Existing usernames are '
+        'skipped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+            help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if format not in ('csv', 'jsonl'):
+            raise CommandError('Unknown format, use --format csv or jsonl')
+
+        # hashing the same unusable password once is enough
+        self.unusable_password = make_password(None)
+        self.created = self.skipped = self.invalid = 0
+        self.start = time.perf_counter()
+
+        with open(path, newline='', encoding='utf-8') as f:
+            records = read_csv(f) if format == 'csv' else read_jsonl(f)
+
+            batch = []
+            for number, record in records:
+                error = record if isinstance(record, str) else None
+                if error is None:
+                    try:
+                        validate(record)
+                    except ValidationError as e:
+                        error = '; '.join(e.messages)
+                if error is not None:
+                    self.invalid += 1
+                    self.stderr.write(f'line {number}: {error}')
+                    continue
+
+                batch.append(record)
+                if len(batch) >= options['batch_size']:
+                    self.import_batch(batch)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.created} users, skipped {self.skipped}, '
+            f'{self.invalid} invalid lines '
+            f'in {elapsed:.1f}s ({self.created / elapsed:.0f} users/s).'))
+
+    def import_batch(self, records):
+        usernames = [record['username'] for record in records]
+        existing = set(User.objects.filter(username__in=usernames)
+            .values_list('username', flat=True))
+
+        new_records = []
+        for record in records:
+            if record['username'] in existing:
+                self.skipped += 1
+            else:
+                # also drops duplicates within the file
+                existing.add(record['username'])
+                new_records.append(record)
+
+        if not new_records:
+            return
+
+        with transaction.atomic():
+            # bulk_create skips post_save, so userprofile_receiver does not
+            # run and the profiles are inserted in bulk below
+            User.objects.bulk_create([
+                User(
+                    username=record['username'],
+                    password=record.get('password') or self.unusable_password,
+                    **{field: record.get(field) or '' for field in USER_FIELDS}
+                )
+                for record in new_records
+            ])
+
+            # not every database returns the new primary keys
+            user_ids = dict(User.objects.filter(
+                username__in=[record['username'] for record in new_records]
+            ).values_list('username', 'pk'))
+
+            profiles = []
+            addresses = []
+            for record in new_records:
+                user_id = user_ids[record['username']]
+                profiles.append(UserProfile(
+                    user_id=user_id,
+                    stripe_customer_id=record.get('stripe_customer_id') or None,
+                    one_click_purchasing=is_true(
+                        record.get('one_click_purchasing', False)),
+                ))
+
+                for address in record.get('addresses') or []:
+                    values = {field: address.get(field) or '' for field in ADDRESS_FIELDS}
+                    addresses.append(Address(
+                        user_id=user_id,
+                        address_type=address['address_type'],
+                        default=is_true(address.get('default', False)),
+                        # save() is bypassed, so the hash is set here
+                        content_hash=get_address_hash(*values.values()),
+                        **values
+                    ))
+
+            UserProfile.objects.bulk_create(profiles)
+            Address.objects.bulk_create(addresses)
+
+        self.created += len(new_records)
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(f'{self.created} users ({self.created / elapsed:.0f}/s)')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core.caching import get_listing_cache_stats
+
+
+class Command(BaseCommand):
+    help = (
+        'Show the hit/miss counters of the item listing cache, only '
+        'LISTING_STATS_SAMPLE_RATE of the lookups are counted'
+    )
+
+    def handle(self, *args, **options):
+        stats = get_listing_cache_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / total * 100 if total else 0
+
+        self.stdout.write(f"catalog version: {stats['version']}")
+        self.stdout.write(f"hits: {stats['hits']}")
+        self.stdout.write(f"misses: {stats['misses']}")
+        self.stdout.write(f'hit ratio: {ratio:.1f}%')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Refund
+from core.refunds import process_refunds
+
+
+class Command(BaseCommand):
+    help = 'Refund the charges of the accepted refund requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--workers', type=int,
+            help='Provider calls in flight, defaults to REFUND_WORKERS')
+        parser.add_argument('--retry-failed', action='store_true',
+            help='Process the failed refunds again')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            Refund.objects.filter(accepted=True, status='F').update(status='P')
+
+        refunded, failed = process_refunds(batch_size=options['batch_size'],
+            workers=options['workers'])
+        self.stdout.write(f'Refunded {refunded}, failed {failed}.')
@@ -0,0 +1,35 @@
+from datetime import timedelta
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.archive import reap_carts, reap_cart_snapshots, reap_orphan_lines
+
+
+class Command(BaseCommand):
+    help = 'Delete the carts nobody touched for a while and orphaned cart lines, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+            help='Age of the carts to delete, defaults to CART_ABANDON_AFTER')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        before = None
+        if options['days'] is not None:
+            before = timezone.now() - timedelta(days=options['days'])
+
+        reapers = [
+            ('carts', partial(reap_carts, before)),
+            ('cart snapshots', partial(reap_cart_snapshots, before)),
+            ('orphaned cart lines', reap_orphan_lines),
+        ]
+        for name, reap in reapers:
+            total = 0
+            while True:
+                count = reap(batch_size=options['batch_size'])
+                total += count
+                if count < options['batch_size']:
+                    break
+            self.stdout.write(f'Deleted {total} {name}.')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from core.archive import iter_archived_orders
+from core.exports import iter_orders
+from core.models import Order
+from core.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the sales rollups from all paid and archived orders. Stop drain_outbox '
+        'while it runs, rollup updates it makes during the rebuild are '
+        'overwritten.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        count = rebuild(
+            iter_orders(Order.objects.filter(ordered=True), chunk_size=chunk_size),
+            iter_archived_orders(chunk_size or 500),
+        )
+        self.stdout.write(f'Rolled up {count} orders.')
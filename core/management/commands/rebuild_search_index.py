@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import Item
+from core.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of the items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of items indexed per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        items = Item.objects.only('pk', 'title', 'description') \
+            .order_by('pk').iterator(chunk_size=batch_size)
+
+        with transaction.atomic():
+            count = get_search_backend().rebuild(items, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} items.'))
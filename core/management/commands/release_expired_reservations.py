@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.inventory import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Put the stock held by abandoned checkouts back on sale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = release_expired(options['batch_size'])
+            total += count
+            if count < options['batch_size']:
+                break
+        self.stdout.write(f'Released {total} reservations.')
@@ -0,0 +1,37 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from core import tasks
+
+
+class Command(BaseCommand):
+    help = 'Run the queued background tasks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+            help='Tasks run in parallel')
+        parser.add_argument('--interval', type=float, default=1,
+            help='Seconds to sleep when no task is due')
+        parser.add_argument('--once', action='store_true',
+            help='Run the due tasks and exit')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+
+        with ThreadPoolExecutor(max_workers=workers,
+                thread_name_prefix='tasks') as executor:
+            while True:
+                tasks.requeue_stale()
+                batch = tasks.claim(workers)
+
+                if batch:
+                    # wait for the batch so no more than workers tasks
+                    # are locked by this process
+                    list(executor.map(tasks.run, batch))
+                    self.stdout.write(f'Ran {len(batch)} tasks.')
+                elif options['once']:
+                    return
+                else:
+                    time.sleep(options['interval'])
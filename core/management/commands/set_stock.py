@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.inventory import set_stock
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Set the stock of an item'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug')
+        parser.add_argument('quantity', type=int)
+        parser.add_argument('--shards', type=int,
+            help='Number of stock counter rows, defaults to STOCK_SHARDS')
+
+    def handle(self, *args, **options):
+        try:
+            item = Item.objects.get(slug=options['slug'])
+        except Item.DoesNotExist:
+            raise CommandError(f"Item '{options['slug']}' does not exist")
+
+        set_stock(item, options['quantity'], options['shards'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{item} has {options['quantity']} units in stock."))
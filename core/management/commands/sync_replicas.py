@@ -0,0 +1,38 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the default sqlite database over the sqlite replicas, to try '
+        'the replica routing locally. Real replicas are kept up to date by '
+        'the database server.'
+    )
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No DATABASE_REPLICAS are configured')
+
+        default = connections['default']
+        if default.vendor != 'sqlite':
+            raise CommandError('Only sqlite databases can be copied')
+
+        source = sqlite3.connect(default.settings_dict['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                replica = connections[alias]
+                if replica.vendor != 'sqlite':
+                    raise CommandError(f'{alias} is not a sqlite database')
+                replica.close()
+
+                target = sqlite3.connect(replica.settings_dict['NAME'])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(f'Copied default to {alias}.')
+        finally:
+            source.close()
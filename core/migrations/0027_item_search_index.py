@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Item = apps.get_model('core', 'Item')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts "
+            "USING fts5(title, description, tokenize='porter unicode61')"
+        )
+        cursor.executemany(
+            'INSERT INTO core_item_fts (rowid, title, description) '
+            'VALUES (%s, %s, %s)',
+            list(Item.objects.values_list('pk', 'title', 'description'))
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS core_item_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_auto_20200129_0841'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_item_created_id_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='category',
+            field=models.CharField(choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], db_index=True, max_length=2),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, db_index=True, max_length=24, null=True),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(db_index=True, max_length=15),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='core_order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'default'], name='core_address_default_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+
+
+def compute_totals(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+
+    for order in Order.objects.select_related('coupon').prefetch_related('items__item'):
+        subtotal = 0
+        for order_item in order.items.all():
+            price = order_item.item.discount_price or order_item.item.price
+            subtotal += order_item.quantity * int(round(price * 100))
+
+        total = subtotal
+        if order.coupon:
+            total -= int(round(order.coupon.amount * 100))
+
+        Order.objects.filter(pk=order.pk).update(subtotal_cents=subtotal,
+            total_cents=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='subtotal_cents',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_cents',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(compute_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def compute_hashes(apps, schema_editor):
+    Address = apps.get_model('core', 'Address')
+
+    for address in Address.objects.iterator():
+        normalized = '|'.join(
+            ' '.join(str(value or '').lower().split())
+            for value in (address.street_address, address.apartment_address,
+                address.country, address.zip)
+        )
+        content_hash = hashlib.sha256(normalized.encode()).hexdigest()
+        Address.objects.filter(pk=address.pk).update(content_hash=content_hash)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='content_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(compute_hashes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'content_hash'], name='core_address_hash_idx'),
+        ),
+    ]
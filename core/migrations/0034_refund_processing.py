@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_address_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refund',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('R', 'Refunded'), ('F', 'Failed')], default='P', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='stripe_refund_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='refund',
+            index=models.Index(fields=['accepted', 'status'], name='core_refund_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_order_start_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue_cents', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='CategorySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], max_length=2, unique=True)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue_cents', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Category sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='ItemSales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue_cents', models.BigIntegerField(default=0)),
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sales', to='core.Item')),
+            ],
+            options={
+                'verbose_name_plural': 'Item sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='CouponUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('discount_cents', models.BigIntegerField(default=0)),
+                ('revenue_cents', models.BigIntegerField(default=0)),
+                ('coupon', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='usage', to='core.Coupon')),
+            ],
+            options={
+                'verbose_name_plural': 'Coupon usage',
+            },
+        ),
+    ]
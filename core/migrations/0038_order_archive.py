@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0037_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['ordered', 'updated_at'], name='core_order_updated_idx'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('ref_code', models.CharField(blank=True, db_index=True, max_length=24, null=True)),
+                ('start_date', models.DateTimeField()),
+                ('ordered_date', models.DateTimeField()),
+                ('paid_at', models.DateTimeField(blank=True, null=True)),
+                ('being_delivered', models.BooleanField(default=False)),
+                ('received', models.BooleanField(default=False)),
+                ('subtotal_cents', models.IntegerField(default=0)),
+                ('total_cents', models.IntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('billing_address', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Address')),
+                ('coupon', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Coupon')),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Payment')),
+                ('shipping_address', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Address')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrderLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=100)),
+                ('category', models.CharField(choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], max_length=2)),
+                ('quantity', models.PositiveIntegerField()),
+                ('line_cents', models.IntegerField()),
+                ('item', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Item')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='core.ArchivedOrder')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_cartsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='thumbnail_source',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='thumbnail_widths',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
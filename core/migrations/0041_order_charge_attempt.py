@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0040_item_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='charge_attempt',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0041_order_charge_attempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='line_cents',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
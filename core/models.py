@@ -1,9 +1,20 @@
+import hashlib
+
+from django.conf import settings
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import F, Sum, Count, Value, IntegerField, Prefetch
+from django.db.models.functions import Cast, Coalesce, NullIf, Round
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth import get_user_model
 from django.shortcuts import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
 
+from .search import item_saved_receiver, item_deleted_receiver
+from .caching import catalog_changed_receiver
+from .thumbnails import get_thumbnail_urls, item_image_receiver
+from .coupons import coupons_changed_receiver
+
 
 User = get_user_model()
 
@@ -31,13 +42,19 @@ class Item(models.Model):
     title = models.CharField(max_length=100)
     price = models.FloatField()
     discount_price = models.FloatField(blank=True, null=True)
-    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2,
+        db_index=True)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
     slug = models.SlugField()
     description = models.TextField()
     image = models.ImageField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # derivatives made by core.thumbnails, so rendering needs no storage
+    # lookups: the image they were made from and their widths
+    thumbnail_source = models.CharField(max_length=100, blank=True)
+    thumbnail_widths = models.CharField(max_length=50, blank=True)
+
     def __str__(self):
         return self.title
 
@@ -49,9 +66,29 @@ class Item(models.Model):
 
     def get_remove_from_cart_url(self):
         return reverse('core:remove_from_cart', kwargs={'slug': self.slug})
+
+    def get_thumbnail_widths(self):
+        # the original is used until the derivatives of this image are done
+        if not self.thumbnail_widths or self.thumbnail_source != self.image.name:
+            return []
+        return [int(width) for width in self.thumbnail_widths.split(',')]
+
+    def get_image_srcset(self):
+        urls = get_thumbnail_urls(self.image.name, self.get_thumbnail_widths())
+        return ', '.join(f'{url} {width}w' for width, url in urls)
+
+    def get_webp_image_srcset(self):
+        urls = get_thumbnail_urls(self.image.name, self.get_thumbnail_widths(),
+            '.webp')
+        return ', '.join(f'{url} {width}w' for width, url in urls)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # keyset pagination of the item list
+            models.Index(fields=['-created_at', '-id'],
+                name='core_item_created_id_idx'),
+        ]
 
 
 
@@ -60,6 +97,8 @@ class OrderItem(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     ordered = models.BooleanField(default=False)
+    # what the line was paid, set by core.orders.finalize_order
+    line_cents = models.IntegerField(blank=True, null=True)
 
     def __str__(self):
         return f"{self.quantity} of '{self.item.title}'"
@@ -79,6 +118,41 @@ class OrderItem(models.Model):
             return self.get_total_discount_item_price()
         return self.get_total_item_price()
 
+    def get_line_cents(self):
+        """
+        What the line was paid, or costs at the current prices while it
+        is not paid, rounded like Order.get_line_totals.
+        """
+        if self.line_cents is not None:
+            return self.line_cents
+        return self.quantity * to_cents(self.item.discount_price or self.item.price)
+
+
+
+def to_cents(amount):
+    return int(round((amount or 0) * 100))
+
+
+def get_unit_cents_expression(prefix=''):
+    """
+    Unit price in cents of the item at prefix, computed by the database.
+    The discount price is used when it is set and not zero.
+    """
+    unit_price = Coalesce(
+        NullIf(f'{prefix}discount_price', Value(0.0)),
+        f'{prefix}price'
+    )
+    return Cast(Round(unit_price * 100), IntegerField())
+
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_items(self):
+        # everything the order templates render, in two queries
+        return self.select_related('coupon').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('item'))
+        )
+
 
 
 class Order(models.Model):
@@ -86,6 +160,8 @@ class Order(models.Model):
     items = models.ManyToManyField(OrderItem)
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
+    # last change of the cart, see update_totals
+    updated_at = models.DateTimeField(auto_now=True)
     ordered = models.BooleanField(default=False)
     
     shipping_address = models.ForeignKey('Address',
@@ -102,22 +178,112 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
-    ref_code = models.CharField(max_length=24, blank=True, null=True)
+    ref_code = models.CharField(max_length=24, blank=True, null=True,
+        db_index=True)
+
+    # denormalized totals in cents, see update_totals
+    subtotal_cents = models.IntegerField(default=0)
+    total_cents = models.IntegerField(default=0)
+
+    # part of the idempotency key of the charge, a new attempt after a
+    # decline gets a new key, see core.orders.next_charge_attempt
+    charge_attempt = models.PositiveIntegerField(default=0)
+
+    objects = OrderQuerySet.as_manager()
 
     def __str__(self):
         return self.user.username
 
-    def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
+    class Meta:
+        indexes = [
+            # the active cart lookup
+            models.Index(fields=['user', 'ordered'],
+                name='core_order_user_ordered_idx'),
+            # keyset iteration of the order export
+            models.Index(fields=['start_date', 'id'],
+                name='core_order_start_idx'),
+            # the abandoned cart reaper and the order archival
+            models.Index(fields=['ordered', 'updated_at'],
+                name='core_order_updated_idx'),
+        ]
+
+    def get_line_totals(self):
+        """
+        Subtotal in cents and number of lines, in one query. The sum of
+        quantity * unit price is computed by the database, the discount
+        price is used when it is set and not zero.
+        """
+        unit_cents = get_unit_cents_expression('item__')
+        result = self.items.aggregate(
+            subtotal=Sum(F('quantity') * unit_cents, output_field=IntegerField()),
+            lines=Count('pk')
+        )
+        return result['subtotal'] or 0, result['lines']
+
+    def get_subtotal_cents(self):
+        return self.get_line_totals()[0]
+
+    def get_total_cents(self):
+        total = self.get_subtotal_cents()
 
         # subtract coupon amount from total order price
-        if self.coupon:
-            total -= self.coupon.amount
+        if self.coupon_id:
+            total -= to_cents(self.coupon.amount)
 
         return total
 
+    def update_totals(self):
+        """
+        Recompute the denormalized totals, called whenever the cart or its
+        coupon changes. Returns the number of lines of the order.
+        """
+        self.subtotal_cents, lines = self.get_line_totals()
+        self.total_cents = self.subtotal_cents
+        if self.coupon_id:
+            self.total_cents -= to_cents(self.coupon.amount)
+
+        self.updated_at = timezone.now()
+        Order.objects.filter(pk=self.pk).update(
+            subtotal_cents=self.subtotal_cents,
+            total_cents=self.total_cents,
+            updated_at=self.updated_at
+        )
+        return lines
+
+    def refresh_totals(self):
+        """
+        Recompute the totals before they are shown, item prices and the
+        coupon amount may have changed since the cart did. Only written
+        when they differ, and without counting as cart activity.
+        """
+        subtotal_cents = self.get_subtotal_cents()
+        total_cents = subtotal_cents
+        if self.coupon_id:
+            total_cents -= to_cents(self.coupon.amount)
+
+        if (subtotal_cents, total_cents) != (self.subtotal_cents, self.total_cents):
+            self.subtotal_cents = subtotal_cents
+            self.total_cents = total_cents
+            Order.objects.filter(pk=self.pk).update(
+                subtotal_cents=subtotal_cents,
+                total_cents=total_cents
+            )
+
+    def get_total(self):
+        if settings.ORDER_DENORMALIZED_TOTALS:
+            return self.total_cents / 100
+        return self.get_total_cents() / 100
+
+
+
+def get_address_hash(street_address, apartment_address, country, zip):
+    # case and whitespace differences do not make a new address
+    normalized = '|'.join(
+        ' '.join(str(value or '').lower().split())
+        for value in (street_address, apartment_address, country, zip)
+    )
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
 
 
 class Address(models.Model):
@@ -128,17 +294,31 @@ class Address(models.Model):
     zip = models.CharField(max_length=100)
     address_type = models.CharField(max_length=1, choices=ADDRESS_CHOICES)
     default = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64, editable=False)
 
     def __str__(self):
         return self.user.username
+
+    def save(self, *args, **kwargs):
+        self.content_hash = get_address_hash(self.street_address,
+            self.apartment_address, self.country, self.zip)
+        super().save(*args, **kwargs)
     
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            # the default shipping/billing address lookup
+            models.Index(fields=['user', 'address_type', 'default'],
+                name='core_address_default_idx'),
+            # de-duplication of the checkout addresses
+            models.Index(fields=['user', 'address_type', 'content_hash'],
+                name='core_address_hash_idx'),
+        ]
 
 
 
 class Payment(models.Model):
-    stripe_charge_id = models.CharField(max_length=50)
+    stripe_charge_id = models.CharField(max_length=50, db_index=True)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     amount = models.FloatField()
     timestamp = models.DateTimeField(auto_now_add=True)
@@ -149,7 +329,7 @@ class Payment(models.Model):
 
 
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
+    code = models.CharField(max_length=15, db_index=True)
     amount = models.FloatField()
 
     def __str__(self):
@@ -157,15 +337,38 @@ class Coupon(models.Model):
 
 
 
+REFUND_STATUS_CHOICES = (
+    ('P', 'Pending'),
+    ('R', 'Refunded'),
+    ('F', 'Failed'),
+)
+
+
+
 class Refund(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     reason = models.TextField()
     accepted = models.BooleanField(default=False)
     email = models.EmailField(default=False)
 
+    # outcome of core.refunds.process_refunds
+    status = models.CharField(max_length=1, choices=REFUND_STATUS_CHOICES,
+        default='P')
+    stripe_refund_id = models.CharField(max_length=50, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
     def __str__(self):
         return f'{self.pk}'
 
+    class Meta:
+        indexes = [
+            # the batches of the refund pipeline
+            models.Index(fields=['accepted', 'status'],
+                name='core_refund_pending_idx'),
+        ]
+
 
 
 class UserProfile(models.Model):
@@ -178,8 +381,256 @@ class UserProfile(models.Model):
 
 
 
+class StockShard(models.Model):
+    """
+    One stripe of the stock counter of an item. The stock is spread over
+    several rows so concurrent buyers of the same item update different
+    rows instead of queueing on one, see core.inventory.
+    """
+    item = models.ForeignKey(Item, related_name='stock_shards',
+        on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    available = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.item} #{self.shard}: {self.available}'
+
+    class Meta:
+        unique_together = ['item', 'shard']
+
+
+
+class StockReservation(models.Model):
+    order = models.ForeignKey(Order, related_name='reservations',
+        on_delete=models.CASCADE)
+    shard = models.ForeignKey(StockShard, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    committed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f'{self.quantity} of {self.shard.item} for order {self.order_id}'
+
+
+
+class OutboxMessage(models.Model):
+    """
+    Work to do after a transaction commits (receipts, stats), written in
+    the same transaction and processed by the drain_outbox command.
+    """
+    topic = models.CharField(max_length=50)
+    payload = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'{self.topic} #{self.pk}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'id'],
+                name='core_outbox_pending_idx'),
+        ]
+
+
+
+TASK_STATUS_CHOICES = (
+    ('Q', 'Queued'),
+    ('R', 'Running'),
+    ('D', 'Done'),
+    ('X', 'Dead'),
+)
+
+
+
+class Task(models.Model):
+    """
+    A call of a function registered with core.tasks.task, run by the
+    run_tasks command. Tasks failing max_attempts times are kept as dead.
+    """
+    name = models.CharField(max_length=200)
+    arguments = models.TextField()
+    status = models.CharField(max_length=1, choices=TASK_STATUS_CHOICES,
+        default='Q')
+    run_at = models.DateTimeField()
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.name} #{self.pk}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'],
+                name='core_task_due_idx'),
+        ]
+
+
+
+# sales rollups, maintained by core.rollups
+
+
+class DailySales(models.Model):
+    date = models.DateField(unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue_cents = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.date}'
+
+    def get_revenue(self):
+        return self.revenue_cents / 100
+
+    class Meta:
+        verbose_name_plural = 'Daily sales'
+
+
+
+class ItemSales(models.Model):
+    item = models.OneToOneField(Item, on_delete=models.CASCADE,
+        related_name='sales')
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue_cents = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.item}'
+
+    def get_revenue(self):
+        return self.revenue_cents / 100
+
+    class Meta:
+        verbose_name_plural = 'Item sales'
+
+
+
+class CategorySales(models.Model):
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2,
+        unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue_cents = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.get_category_display()
+
+    def get_revenue(self):
+        return self.revenue_cents / 100
+
+    class Meta:
+        verbose_name_plural = 'Category sales'
+
+
+
+class CouponUsage(models.Model):
+    coupon = models.OneToOneField(Coupon, on_delete=models.CASCADE,
+        related_name='usage')
+    orders = models.PositiveIntegerField(default=0)
+    discount_cents = models.BigIntegerField(default=0)
+    revenue_cents = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.coupon}'
+
+    def get_discount(self):
+        return self.discount_cents / 100
+
+    def get_revenue(self):
+        return self.revenue_cents / 100
+
+    class Meta:
+        verbose_name_plural = 'Coupon usage'
+
+
+
+class ArchivedOrder(models.Model):
+    """
+    A completed order moved out of the order tables by core.archive,
+    keeping what order history, exports and the rollups need. The id is
+    the id the order had.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    ref_code = models.CharField(max_length=24, blank=True, null=True,
+        db_index=True)
+    start_date = models.DateTimeField()
+    ordered_date = models.DateTimeField()
+    paid_at = models.DateTimeField(blank=True, null=True)
+    shipping_address = models.ForeignKey('Address', related_name='+',
+        on_delete=models.SET_NULL, blank=True, null=True)
+    billing_address = models.ForeignKey('Address', related_name='+',
+        on_delete=models.SET_NULL, blank=True, null=True)
+    payment = models.ForeignKey(Payment, related_name='+',
+        on_delete=models.SET_NULL, blank=True, null=True)
+    coupon = models.ForeignKey(Coupon, related_name='+',
+        on_delete=models.SET_NULL, blank=True, null=True)
+    being_delivered = models.BooleanField(default=False)
+    received = models.BooleanField(default=False)
+    subtotal_cents = models.IntegerField(default=0)
+    total_cents = models.IntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.ref_code or self.pk}'
+
+
+
+class ArchivedOrderLine(models.Model):
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE,
+        related_name='lines')
+    item = models.ForeignKey(Item, related_name='+',
+        on_delete=models.SET_NULL, blank=True, null=True)
+    title = models.CharField(max_length=100)
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
+    quantity = models.PositiveIntegerField()
+    line_cents = models.IntegerField()
+
+    def __str__(self):
+        return f"{self.quantity} of '{self.title}'"
+
+
+
+class CartSnapshot(models.Model):
+    """
+    Durable copy of a cart kept by core.cart.CacheCartStore, written
+    behind the cached cart and read when the cache lost it.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+        related_name='cart_snapshot')
+    data = models.TextField()
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.user_id} v{self.version}'
+
+
+
 def userprofile_receiver(sender, instance, created, *args, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
 
 post_save.connect(userprofile_receiver, sender=User)
+
+# keep the search index in sync with the catalog
+post_save.connect(item_saved_receiver, sender=Item)
+post_delete.connect(item_deleted_receiver, sender=Item)
+
+# invalidate the cached item listings
+post_save.connect(catalog_changed_receiver, sender=Item)
+post_delete.connect(catalog_changed_receiver, sender=Item)
+
+# resized and webp variants of the item image
+post_save.connect(item_image_receiver, sender=Item)
+
+# rebuild the coupon filter and drop the cached coupon lookups
+post_save.connect(coupons_changed_receiver, sender=Coupon)
+post_delete.connect(coupons_changed_receiver, sender=Coupon)
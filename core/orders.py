@@ -0,0 +1,152 @@
+import logging
+import random
+import string
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+import stripe
+
+from . import cart, outbox
+from .caching import set_cart_item_count
+from .inventory import commit_order
+from .models import (
+    Order,
+    Item,
+    Payment,
+    Address,
+    get_address_hash,
+    get_unit_cents_expression,
+)
+from .payments import get_payment_provider
+from .tasks import task
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_ref_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=24))
+
+
+def get_default_address(user, address_type):
+    return Address.objects.filter(user=user, address_type=address_type,
+        default=True).first()
+
+
+def get_or_create_address(user, address_type, street_address,
+        apartment_address, country, zip, default=False):
+    """
+    Reuse the address of user with the same normalized content instead
+    of storing it again on every checkout.
+    """
+    content_hash = get_address_hash(street_address, apartment_address,
+        country, zip)
+    address = Address.objects.filter(user=user, address_type=address_type,
+        content_hash=content_hash).first()
+
+    if address is None:
+        address = Address.objects.create(
+            user=user,
+            street_address=street_address,
+            apartment_address=apartment_address,
+            country=country,
+            zip=zip,
+            address_type=address_type,
+            default=default
+        )
+    elif default and not address.default:
+        address.default = True
+        Address.objects.filter(pk=address.pk).update(default=True)
+
+    if default:
+        # only one default address per type
+        Address.objects.filter(user=user, address_type=address_type,
+            default=True).exclude(pk=address.pk).update(default=False)
+
+    return address
+
+
+def finalize_order(order, charge, amount):
+    """
+    Record a successful charge and close the order in one transaction.
+    Safe to call again for the same charge: an order that is already
+    paid is returned untouched.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=order.pk)
+        if order.ordered:
+            return order
+
+        payment = Payment.objects.create(
+            stripe_charge_id=charge['id'],
+            user=order.user,
+            amount=amount / 100
+        )
+
+        order.ordered = True
+        order.payment = payment
+        order.ref_code = create_ref_code()
+        order.save(update_fields=['ordered', 'payment', 'ref_code'])
+        # the price paid stays with the lines, whatever happens to the
+        # item prices afterwards
+        unit_cents = Item.objects.filter(pk=OuterRef('item_id')).annotate(
+            cents=get_unit_cents_expression()).values('cents')[:1]
+        order.items.update(ordered=True,
+            line_cents=F('quantity') * Subquery(unit_cents))
+        commit_order(order)
+
+        # receipts and other follow-up work run outside the request
+        outbox.enqueue('order_paid', order_id=order.pk, payment_id=payment.pk)
+
+    return order
+
+
+def next_charge_attempt(order):
+    """
+    Start a new charge attempt after a decline, its idempotency key is not
+    the one stripe replays the decline for.
+    """
+    Order.objects.filter(pk=order.pk).update(
+        charge_attempt=F('charge_attempt') + 1)
+    order.charge_attempt += 1
+
+
+@task
+def reconcile_charge(order_id, amount, idempotency_key, customer=None,
+        source=None):
+    """
+    Settle a charge the request stopped waiting for. The same idempotency
+    key replays the charge when it landed and makes it when it did not,
+    so the customer is charged once either way.
+    """
+    order = Order.objects.select_related('user').get(pk=order_id)
+    if order.ordered:
+        return
+
+    provider = get_payment_provider()
+    try:
+        charge = provider.charge(amount, customer=customer, source=source,
+            idempotency_key=idempotency_key)
+    except stripe.error.CardError:
+        logger.warning('Charge of order %s was declined', order_id)
+        next_charge_attempt(order)
+        return
+
+    finalize_order(order, charge, amount)
+    cart.clear(order.user)
+    set_cart_item_count(order.user, 0)
+
+
+def reconcile_later(order, amount, **charge_kwargs):
+    """
+    Queue reconcile_charge for a charge that timed out, once the call
+    still in flight had time to finish.
+    """
+    run_at = timezone.now() + timedelta(
+        seconds=settings.PAYMENT_RECONCILE_DELAY)
+    return reconcile_charge.schedule(run_at, order.pk, amount,
+        **charge_kwargs)
@@ -0,0 +1,96 @@
+import json
+import logging
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxMessage, Order
+from . import rollups
+
+
+logger = logging.getLogger(__name__)
+
+handlers = {}
+
+
+def register(topic):
+    def decorator(func):
+        handlers.setdefault(topic, []).append(func)
+        return func
+    return decorator
+
+
+def enqueue(topic, **payload):
+    """
+    Must be called inside the transaction whose outcome the message
+    describes, the message is committed or rolled back with it.
+    """
+    return OutboxMessage.objects.create(topic=topic,
+        payload=json.dumps(payload))
+
+
+def process_message(message):
+    payload = json.loads(message.payload)
+    for handler in handlers.get(message.topic, []):
+        handler(**payload)
+
+
+def drain(batch_size=100):
+    """
+    Process one batch of pending messages, returns how many were handled.
+    Failed messages are retried on the next drain until they reach
+    OUTBOX_MAX_ATTEMPTS. Every message is claimed before its handlers
+    run, so concurrent drains never process the same message twice.
+    """
+    messages = list(OutboxMessage.objects.filter(
+        processed_at__isnull=True,
+        attempts__lt=settings.OUTBOX_MAX_ATTEMPTS
+    ).order_by('id')[:batch_size])
+
+    handled = 0
+    for message in messages:
+        try:
+            with transaction.atomic():
+                # the row stays locked until the handlers committed, a
+                # concurrent drain waits and then finds it processed
+                claimed = OutboxMessage.objects.filter(pk=message.pk,
+                    processed_at__isnull=True).update(
+                        processed_at=timezone.now(),
+                        attempts=F('attempts') + 1)
+                if not claimed:
+                    continue
+                process_message(message)
+        except Exception as e:
+            logger.exception('Outbox message %s failed', message.pk)
+            # the claim was rolled back with the handlers
+            OutboxMessage.objects.filter(pk=message.pk,
+                processed_at__isnull=True).update(
+                    attempts=F('attempts') + 1,
+                    last_error=repr(e))
+        handled += 1
+
+    return handled
+
+
+
+@register('order_paid')
+def send_receipt(order_id, **kwargs):
+    order = Order.objects.select_related('user').get(pk=order_id)
+    if not order.user.email:
+        return
+
+    send_mail(
+        'Your order was successful!',
+        f'Thank you for your order. Your reference code is {order.ref_code}, '
+        f'you were charged ${order.total_cents / 100:.2f}.',
+        None,
+        [order.user.email],
+    )
+
+
+@register('order_paid')
+def update_sales_rollups(order_id, **kwargs):
+    rollups.record_order(order_id)
@@ -0,0 +1,155 @@
+import base64
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+
+def encode_cursor(obj, direction):
+    data = {
+        'c': obj.created_at.isoformat(),
+        'i': obj.pk,
+        'd': direction,
+    }
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        created_at = parse_datetime(data['c'])
+        pk = int(data['i'])
+        direction = data['d']
+    except (ValueError, TypeError, KeyError):
+        raise Http404('Invalid cursor')
+
+    if created_at is None or direction not in ('n', 'p'):
+        raise Http404('Invalid cursor')
+    return created_at, pk, direction
+
+
+
+class CursorPage:
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        if self.has_next():
+            return encode_cursor(self.object_list[-1], 'n')
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous():
+            return encode_cursor(self.object_list[0], 'p')
+
+
+
+class CursorPaginator:
+    """
+    Keyset paginator over (created_at, id), newest first.
+    Pages are fetched with a range condition on the (created_at, id) index
+    instead of OFFSET, so deep pages cost the same as the first one,
+    and no COUNT(*) is ever run.
+    """
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def page(self, cursor=None):
+        queryset = self.queryset
+
+        if not cursor:
+            rows = list(queryset.order_by('-created_at', '-pk')[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            return CursorPage(rows[:self.per_page], has_next, False)
+
+        created_at, pk, direction = decode_cursor(cursor)
+
+        if direction == 'n':
+            # items older than the last item of the previous page
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, pk__lt=pk)
+            ).order_by('-created_at', '-pk')
+            rows = list(queryset[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            return CursorPage(rows[:self.per_page], has_next, True)
+
+        # items newer than the first item of the next page, read in
+        # ascending order and reversed back
+        queryset = queryset.filter(
+            Q(created_at__gt=created_at) |
+            Q(created_at=created_at, pk__gt=pk)
+        ).order_by('created_at', 'pk')
+        rows = list(queryset[:self.per_page + 1])
+        has_previous = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        rows.reverse()
+        return CursorPage(rows, True, has_previous)
+
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for big admin changelists. Without filters the row count is
+    estimated from the database statistics instead of a COUNT(*) over the
+    whole table, filtered lists are still counted exactly.
+    """
+    exact_count_below = 10000
+
+    def get_estimate(self):
+        model = self.object_list.model
+        table = model._meta.db_table
+        connection = connections[self.object_list.db]
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                    [table])
+            elif connection.vendor == 'mysql':
+                cursor.execute(
+                    'SELECT table_rows FROM information_schema.tables '
+                    'WHERE table_schema = DATABASE() AND table_name = %s',
+                    [table])
+            elif connection.vendor == 'sqlite':
+                # the largest rowid is read from the end of the b-tree
+                cursor.execute(
+                    f'SELECT MAX(_ROWID_) FROM {connection.ops.quote_name(table)}')
+            else:
+                return None
+            row = cursor.fetchone()
+        return row[0] if row and row[0] is not None else None
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = self.get_estimate()
+            if estimate is not None and estimate >= self.exact_count_below:
+                return estimate
+        return super().count
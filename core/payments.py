@@ -0,0 +1,255 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+import stripe
+
+
+logger = logging.getLogger(__name__)
+
+stripe.api_key = settings.API_SECRET_KEY
+if settings.STRIPE_API_BASE:
+    # e.g. a local stripe-mock for tests and load tests
+    stripe.api_base = settings.STRIPE_API_BASE
+
+
+# stripe calls made while rendering pages run here, so a slow stripe
+# only costs the page the lookup timeout
+lookup_executor = ThreadPoolExecutor(max_workers=settings.STRIPE_LOOKUP_WORKERS,
+    thread_name_prefix='stripe-lookup')
+
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for reset_timeout seconds after
+    failure_threshold consecutive failures. The state lives in the cache
+    so every process shares it.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.failures_key = f'breaker:{name}:failures'
+        self.opened_key = f'breaker:{name}:opened'
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def is_open(self):
+        return cache.get(self.opened_key) is not None
+
+    def record_success(self):
+        cache.delete(self.failures_key)
+
+    def record_failure(self):
+        if cache.add(self.failures_key, 1, self.reset_timeout):
+            failures = 1
+        else:
+            failures = cache.incr(self.failures_key)
+
+        if failures >= self.failure_threshold:
+            cache.set(self.opened_key, time.time(), self.reset_timeout)
+            cache.delete(self.failures_key)
+
+
+card_lookup_breaker = CircuitBreaker('stripe-cards',
+    settings.STRIPE_BREAKER_THRESHOLD, settings.STRIPE_BREAKER_RESET)
+
+
+def get_card_cache_key(customer_id):
+    return f'stripe:cards:{customer_id}'
+
+
+def invalidate_cards(customer_id):
+    cache.delete(get_card_cache_key(customer_id))
+
+
+def fetch_default_card(customer_id):
+    cards = stripe.Customer.list_sources(
+        customer_id,
+        limit=3,
+        object='card'
+    )
+
+    card_list = cards['data']
+    if len(card_list) > 0:
+        card = card_list[0]
+        # only what payment.html shows
+        return {
+            'last4': card['last4'],
+            'exp_month': card['exp_month'],
+            'exp_year': card['exp_year'],
+        }
+    return {}
+
+
+def get_default_card(customer_id):
+    """
+    Default card of a stripe customer, cached for STRIPE_CARD_CACHE_TIMEOUT.
+    Returns None when stripe is unavailable or the customer has no card.
+    """
+    key = get_card_cache_key(customer_id)
+    card = cache.get(key)
+    if card is not None:
+        return card or None
+
+    if card_lookup_breaker.is_open():
+        return None
+
+    future = lookup_executor.submit(fetch_default_card, customer_id)
+    try:
+        card = future.result(timeout=settings.STRIPE_LOOKUP_TIMEOUT)
+    except TimeoutError:
+        logger.warning('Stripe card lookup timed out for %s', customer_id)
+        card_lookup_breaker.record_failure()
+        return None
+    except stripe.error.StripeError:
+        logger.exception('Stripe card lookup failed for %s', customer_id)
+        card_lookup_breaker.record_failure()
+        return None
+
+    card_lookup_breaker.record_success()
+    cache.set(key, card, settings.STRIPE_CARD_CACHE_TIMEOUT)
+    return card or None
+
+
+
+class PaymentBusy(Exception):
+    """All provider slots of this process are taken."""
+
+
+class PaymentTimeout(Exception):
+    """The provider did not answer within PAYMENT_PROVIDER_TIMEOUT."""
+
+
+
+class StripeProvider:
+    def create_customer(self, email, source):
+        return stripe.Customer.create(email=email, source=source)
+
+    def create_source(self, customer_id, source):
+        return stripe.Customer.create_source(customer_id, source=source)
+
+    def charge(self, amount, customer=None, source=None,
+            idempotency_key=None):
+        if customer:
+            return stripe.Charge.create(amount=amount, currency='usd',
+                customer=customer, idempotency_key=idempotency_key)
+        return stripe.Charge.create(amount=amount, currency='usd',
+            source=source, idempotency_key=idempotency_key)
+
+    def refund(self, charge_id, idempotency_key=None):
+        return stripe.Refund.create(charge=charge_id,
+            idempotency_key=idempotency_key)
+
+
+
+class FakeProvider:
+    """
+    Local stand-in for stripe, for development and load tests.
+    Every call sleeps FAKE_PAYMENT_LATENCY seconds, the token
+    'tok_chargeDeclined' is declined like on stripe.
+    """
+
+    def __init__(self):
+        self.charges = {}
+        self.lock = threading.Lock()
+
+    def _wait(self):
+        time.sleep(settings.FAKE_PAYMENT_LATENCY)
+
+    def create_customer(self, email, source):
+        self._wait()
+        return {'id': f'cus_fake_{uuid.uuid4().hex[:14]}'}
+
+    def create_source(self, customer_id, source):
+        self._wait()
+        return {'id': f'card_fake_{uuid.uuid4().hex[:14]}'}
+
+    def _replay(self, result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def charge(self, amount, customer=None, source=None,
+            idempotency_key=None):
+        self._wait()
+        with self.lock:
+            # replay the first result of a key, declines included, like
+            # stripe does
+            if idempotency_key in self.charges:
+                return self._replay(self.charges[idempotency_key])
+
+        if source == 'tok_chargeDeclined':
+            message = 'Your card was declined.'
+            result = stripe.error.CardError(message, None, 'card_declined',
+                json_body={'error': {'message': message,
+                    'code': 'card_declined'}})
+        else:
+            result = {'id': f'ch_fake_{uuid.uuid4().hex[:14]}',
+                'amount': amount}
+        if idempotency_key:
+            with self.lock:
+                result = self.charges.setdefault(idempotency_key, result)
+        return self._replay(result)
+
+    def refund(self, charge_id, idempotency_key=None):
+        self._wait()
+        refund = {'id': f're_fake_{uuid.uuid4().hex[:14]}', 'charge': charge_id}
+        if idempotency_key:
+            with self.lock:
+                refund = self.charges.setdefault(idempotency_key, refund)
+        return refund
+
+
+
+def get_charge_idempotency_key(order, amount):
+    """
+    The same order, attempt and amount give the same key, so a retry or a
+    double submit replays the first charge instead of making a new one.
+    A decline is replayed as well, paying again after one needs the next
+    attempt of the order.
+    """
+    raw = f'{order.pk}:{order.charge_attempt}:{amount}'
+    return 'order-' + hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+
+_provider = None
+
+
+def get_payment_provider():
+    global _provider
+    if _provider is None:
+        _provider = import_string(settings.PAYMENT_PROVIDER)()
+    return _provider
+
+
+# provider calls of the payment flow run in their own bounded pool, a
+# request waits at most PAYMENT_PROVIDER_TIMEOUT and requests beyond
+# PAYMENT_MAX_CONCURRENCY are turned away at once. The pool is sized from
+# WEB_THREADS, so a slow provider cannot tie up every request thread
+provider_executor = ThreadPoolExecutor(
+    max_workers=settings.PAYMENT_MAX_CONCURRENCY,
+    thread_name_prefix='payments')
+provider_slots = threading.BoundedSemaphore(settings.PAYMENT_MAX_CONCURRENCY)
+
+
+def call_provider(method, *args, **kwargs):
+    if not provider_slots.acquire(blocking=False):
+        raise PaymentBusy()
+
+    # the slot is held until the call really finishes, even when the
+    # request stopped waiting for it
+    future = provider_executor.submit(method, *args, **kwargs)
+    future.add_done_callback(lambda f: provider_slots.release())
+
+    try:
+        return future.result(timeout=settings.PAYMENT_PROVIDER_TIMEOUT)
+    except TimeoutError:
+        raise PaymentTimeout()
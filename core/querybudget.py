@@ -0,0 +1,187 @@
+import logging
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+IN_LIST_RE = re.compile(r'IN \((%s, )*%s\)')
+
+
+def query_budget(view, queries):
+    """
+    Declare how many queries a view may run per request, used in urls.py:
+    path('', query_budget(views.ItemListView.as_view(), 8), name=...)
+    A dict gives a budget per method, e.g. {'GET': 6, 'POST': 20}.
+    """
+    view.query_budget = queries
+    return view
+
+
+def get_query_budget(func, method):
+    budget = getattr(func, 'query_budget', None)
+    if isinstance(budget, dict):
+        return budget.get(method)
+    return budget
+
+
+def get_query_shape(sql):
+    # parameters are already placeholders, only IN lists vary in length
+    return IN_LIST_RE.sub('IN (...)', sql)
+
+
+def get_query_origin():
+    """
+    Where a query comes from: the innermost template node being rendered
+    and the innermost frame of the project code.
+    """
+    template = None
+    code = None
+    frame = sys._getframe(2)
+
+    while frame is not None and (template is None or code is None):
+        filename = frame.f_code.co_filename
+        if template is None and frame.f_code.co_name == 'render_annotated':
+            node = frame.f_locals.get('self')
+            origin = getattr(node, 'origin', None)
+            token = getattr(node, 'token', None)
+            if origin is not None and token is not None:
+                template = f'{origin.template_name}:{token.lineno}'
+        elif code is None and filename.startswith(settings.BASE_DIR) and \
+                'site-packages' not in filename and \
+                not filename.endswith('querybudget.py'):
+            code = f'{filename[len(settings.BASE_DIR) + 1:]}:{frame.f_lineno}'
+        frame = frame.f_back
+
+    return template or code or 'unknown'
+
+
+
+class QueryReport:
+    def __init__(self, url_name, budget):
+        self.url_name = url_name
+        self.budget = budget
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'time': time.perf_counter() - start,
+                'origin': get_query_origin(),
+            })
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(query['time'] for query in self.queries)
+
+    def get_repeated_queries(self):
+        """Query shapes run more than QUERY_BUDGET_REPEAT_LIMIT times (N+1)."""
+        shapes = Counter(get_query_shape(query['sql']) for query in self.queries)
+        repeated = []
+        for shape, count in shapes.items():
+            if count > settings.QUERY_BUDGET_REPEAT_LIMIT:
+                origins = Counter(query['origin'] for query in self.queries
+                    if get_query_shape(query['sql']) == shape)
+                repeated.append((shape, count, origins))
+        return repeated
+
+    def is_over_budget(self):
+        return self.budget is not None and self.count > self.budget
+
+    def get_problems(self):
+        problems = []
+        if self.is_over_budget():
+            problems.append(f'{self.url_name}: {self.count} queries, '
+                f'budget is {self.budget}')
+        for shape, count, origins in self.get_repeated_queries():
+            places = ', '.join(f'{origin} ({n}x)' for origin, n in origins.most_common())
+            problems.append(f'{self.url_name}: repeated {count}x from {places}: {shape}')
+        return problems
+
+    def format(self):
+        lines = [f'{self.url_name}: {self.count} queries in {self.time * 1000:.1f}ms']
+        for query in self.queries:
+            lines.append(f"  {query['time'] * 1000:6.1f}ms  {query['origin']}  {query['sql']}")
+        return '\n'.join(lines)
+
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts and times the queries of every request and checks them against
+    the budget of the view (see query_budget) and for N+1 patterns.
+    Problems are logged, or raised when QUERY_BUDGET_RAISE is set, and the
+    report is attached to the response as response.query_report.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_BUDGET_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        report = QueryReport(None, None)
+        request.query_report = report
+
+        # every database counts, reads may go to a replica
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(report))
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        if match is not None:
+            report.url_name = match.view_name
+            report.budget = get_query_budget(match.func, request.method)
+
+        response.query_report = report
+        response['X-Query-Count'] = str(report.count)
+        response['X-Query-Time'] = f'{report.time * 1000:.1f}ms'
+
+        problems = report.get_problems()
+        if problems:
+            if settings.QUERY_BUDGET_RAISE:
+                raise QueryBudgetExceeded('\n'.join(problems) + '\n' + report.format())
+            for problem in problems:
+                logger.warning(problem)
+
+        return response
+
+
+
+class QueryBudgetTestMixin:
+    """
+    Test case mixin, fails the test when a response went over the query
+    budget of its view or repeated a query shape.
+    """
+
+    def assertWithinQueryBudget(self, response):
+        report = getattr(response, 'query_report', None)
+        if report is None:
+            raise ImproperlyConfigured('QueryBudgetMiddleware is not installed')
+
+        if report.budget is None:
+            self.fail(f'{report.url_name} has no query budget')
+        problems = report.get_problems()
+        if problems:
+            self.fail('\n'.join(problems) + '\n' + report.format())
@@ -0,0 +1,107 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import stripe
+
+from .models import Refund, Order
+from .payments import get_payment_provider
+from .tasks import task
+
+
+logger = logging.getLogger(__name__)
+
+# worth another try, anything else is final
+TRANSIENT_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.RateLimitError,
+)
+
+
+def refund_charge(provider, refund):
+    """
+    Runs in a worker thread, returns (provider refund id, attempts).
+    The idempotency key makes a retried call return the first refund.
+    """
+    payment = refund.order.payment
+    if payment is None:
+        raise ValueError(f'Order {refund.order_id} has no payment')
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result = provider.refund(payment.stripe_charge_id,
+                idempotency_key=f'refund-{refund.pk}')
+            return result['id'], attempt
+        except TRANSIENT_ERRORS:
+            if attempt >= settings.REFUND_MAX_ATTEMPTS:
+                raise
+            time.sleep(settings.REFUND_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def record_outcome(refund, future):
+    now = timezone.now()
+    try:
+        refund_id, attempts = future.result()
+    except Exception as e:
+        logger.warning('Refund %s failed: %r', refund.pk, e)
+        Refund.objects.filter(pk=refund.pk).update(status='F',
+            attempts=refund.attempts + 1, last_error=repr(e),
+            processed_at=now)
+        return False
+
+    with transaction.atomic():
+        Refund.objects.filter(pk=refund.pk).update(status='R',
+            stripe_refund_id=refund_id, attempts=refund.attempts + attempts,
+            last_error='', processed_at=now)
+        Order.objects.filter(pk=refund.order_id).update(
+            refund_requested=False, refund_granted=True)
+    return True
+
+
+def process_refunds(refunds=None, batch_size=None, workers=None):
+    """
+    Refund the charges of the accepted, pending refunds in batches, with
+    up to REFUND_WORKERS provider calls in flight. Returns the number of
+    (refunded, failed) refunds.
+    """
+    batch_size = batch_size or settings.REFUND_BATCH_SIZE
+    workers = workers or settings.REFUND_WORKERS
+    provider = get_payment_provider()
+
+    if refunds is None:
+        refunds = Refund.objects.all()
+    pending = refunds.filter(accepted=True, status='P') \
+        .select_related('order__payment').order_by('pk')
+
+    refunded = failed = 0
+    with ThreadPoolExecutor(max_workers=workers,
+            thread_name_prefix='refunds') as executor:
+        while True:
+            # every refund of a batch leaves the pending state
+            batch = list(pending[:batch_size])
+            if not batch:
+                break
+
+            futures = {
+                executor.submit(refund_charge, provider, refund): refund
+                for refund in batch
+            }
+            for future in as_completed(futures):
+                if record_outcome(futures[future], future):
+                    refunded += 1
+                else:
+                    failed += 1
+
+    return refunded, failed
+
+
+@task
+def process_refunds_task(refund_ids):
+    """Refund accepted requests outside the admin request."""
+    return process_refunds(Refund.objects.filter(pk__in=refund_ids))
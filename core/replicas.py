@@ -0,0 +1,113 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+PIN_COOKIE = 'primary_until'
+
+state = threading.local()
+
+
+def get_request_scope():
+    # set by ReplicaPinMiddleware while it handles a request of this thread
+    return getattr(state, 'scope', None)
+
+
+def use_replicas():
+    """
+    Only requests read from replicas, and only until they wrote. Commands
+    and task workers always read from default, so they see their writes.
+    """
+    scope = get_request_scope()
+    return scope is not None and not scope.pinned and not scope.wrote
+
+
+@contextmanager
+def use_primary():
+    """Reads inside the block go to default, e.g. what is cached for long."""
+    scope = get_request_scope()
+    if scope is None:
+        yield
+        return
+
+    pinned = scope.pinned
+    scope.pinned = True
+    try:
+        yield
+    finally:
+        scope.pinned = pinned
+
+
+
+class ReplicaRouter:
+    """
+    Reads of the REPLICA_MODELS made by requests go to a random replica,
+    everything else and every write goes to default. A client that wrote
+    recently is pinned to default (see ReplicaPinMiddleware), and so is
+    the rest of a request after its first write.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not use_replicas():
+            return 'default'
+        if model._meta.label_lower in settings.REPLICA_MODELS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        scope = get_request_scope()
+        if scope is not None:
+            scope.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as default
+        databases = {'default', *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema from default
+        return db not in settings.DATABASE_REPLICAS
+
+
+
+class ReplicaPinMiddleware:
+    """
+    Pins the client to default for REPLICA_PIN_SECONDS after a request
+    that wrote to the database, with a cookie holding the end of the pin.
+    Cart views mutate on GET, so writes are detected by the router, not
+    by the request method.
+    """
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        scope = SimpleNamespace(pinned=pinned_until > time.time(),
+            wrote=False)
+
+        state.scope = scope
+        try:
+            response = self.get_response(request)
+        finally:
+            # nothing of the request is left to the next work of the thread
+            state.scope = None
+
+        if scope.wrote:
+            seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(PIN_COOKIE, str(time.time() + seconds),
+                max_age=seconds, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,128 @@
+import itertools
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import (
+    Order,
+    DailySales,
+    ItemSales,
+    CategorySales,
+    CouponUsage,
+)
+
+
+def get_sales(paid_at, total_cents, subtotal_cents, coupon_id, lines):
+    """
+    What one paid order adds to the rollups, as
+    {(model, lookup field, key): {field: amount}}. lines are
+    (item_id, category, quantity, line_cents) tuples.
+    """
+    sales = defaultdict(lambda: defaultdict(int))
+
+    day = sales[DailySales, 'date', timezone.localdate(paid_at)]
+    day['orders'] += 1
+    day['units'] += sum(line[2] for line in lines)
+    day['revenue_cents'] += total_cents
+
+    for item_id, category, quantity, line_cents in lines:
+        keys = [(CategorySales, 'category', category)]
+        # archived lines of deleted items have no item
+        if item_id is not None:
+            keys.append((ItemSales, 'item_id', item_id))
+        for key in keys:
+            row = sales[key]
+            row['units'] += quantity
+            row['revenue_cents'] += line_cents
+            # an order with two lines of one category counts once
+            row['orders'] = 1
+
+    if coupon_id:
+        usage = sales[CouponUsage, 'coupon_id', coupon_id]
+        usage['orders'] += 1
+        usage['discount_cents'] += subtotal_cents - total_cents
+        usage['revenue_cents'] += total_cents
+
+    return sales
+
+
+def get_order_sales(order):
+    """The order needs its payment and items with their item loaded."""
+    lines = [
+        (order_item.item_id, order_item.item.category, order_item.quantity,
+            order_item.get_line_cents())
+        for order_item in order.items.all()
+    ]
+    paid_at = order.payment.timestamp if order.payment_id else order.ordered_date
+    return get_sales(paid_at, order.total_cents, order.subtotal_cents,
+        order.coupon_id, lines)
+
+
+def get_archived_order_sales(archived_order):
+    """The archived order needs its lines loaded."""
+    lines = [
+        (line.item_id, line.category, line.quantity, line.line_cents)
+        for line in archived_order.lines.all()
+    ]
+    return get_sales(archived_order.paid_at or archived_order.ordered_date,
+        archived_order.total_cents, archived_order.subtotal_cents,
+        archived_order.coupon_id, lines)
+
+
+def increment(model, field, key, amounts):
+    lookup = {field: key}
+    updates = {name: F(name) + amount for name, amount in amounts.items()}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **amounts)
+    except IntegrityError:
+        # created by a concurrent order in the meantime
+        model.objects.filter(**lookup).update(**updates)
+
+
+def record_order(order_id):
+    """
+    Add a paid order to the rollups, called once per order by the
+    order_paid outbox handler in the transaction that marks the message
+    as processed.
+    """
+    order = Order.objects.select_related('payment').prefetch_related(
+        'items__item').get(pk=order_id)
+    # always in the same order, so concurrent orders do not deadlock
+    sales = get_order_sales(order)
+    for (model, field, key), amounts in sorted(sales.items(),
+            key=lambda entry: (entry[0][0].__name__, str(entry[0][2]))):
+        increment(model, field, key, amounts)
+
+
+def rebuild(orders, archived_orders=()):
+    """
+    Recompute all rollups from the paid and the archived orders given,
+    returns the number of orders counted. The rollups are replaced in one
+    transaction.
+    """
+    totals = defaultdict(lambda: defaultdict(int))
+    count = 0
+    all_sales = itertools.chain(
+        (get_order_sales(order) for order in orders),
+        (get_archived_order_sales(order) for order in archived_orders),
+    )
+    for sales in all_sales:
+        for key, amounts in sales.items():
+            for name, amount in amounts.items():
+                totals[key][name] += amount
+        count += 1
+
+    rows = defaultdict(list)
+    for (model, field, key), amounts in totals.items():
+        rows[model].append(model(**{field: key}, **amounts))
+
+    with transaction.atomic():
+        for model in (DailySales, ItemSales, CategorySales, CouponUsage):
+            model.objects.all().delete()
+            model.objects.bulk_create(rows[model], batch_size=500)
+    return count
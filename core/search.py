@@ -0,0 +1,148 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, When, Q, IntegerField
+from django.utils.module_loading import import_string
+
+
+# split the user query into plain words, everything else is dropped so
+# that the search string can never be parsed as fts5 query syntax
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def get_search_terms(q):
+    return [word.lower() for word in WORD_RE.findall(q or '')]
+
+
+class BaseSearchBackend:
+    """
+    Interface of the item search backends.
+    Backends receive the already filtered item queryset (e.g. by category)
+    and return it narrowed down to the matches, best matches first.
+    """
+
+    def index_items(self, items):
+        pass
+
+    def remove_item(self, pk):
+        pass
+
+    def clear(self):
+        pass
+
+    def rebuild(self, items, batch_size=500):
+        self.clear()
+        batch = []
+        count = 0
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                self.index_items(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.index_items(batch)
+            count += len(batch)
+        return count
+
+    def search(self, queryset, q):
+        raise NotImplementedError
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Fallback backend for databases without a full-text index.
+    Every word must appear in the title or in the description.
+    """
+
+    def search(self, queryset, q):
+        for term in get_search_terms(q):
+            queryset = queryset.filter(
+                Q(title__icontains=term) | Q(description__icontains=term))
+        return queryset
+
+
+class SqliteFTSBackend(BaseSearchBackend):
+    """
+    Inverted index stored in the sqlite fts5 table created by the
+    0027_item_search_index migration. The porter tokenizer gives us
+    stemming ("shirts" matches "shirt"), bm25 gives us the ranking.
+    """
+    table = 'core_item_fts'
+    title_weight = 10.0
+    description_weight = 1.0
+
+    def index_items(self, items):
+        rows = [(item.pk, item.title, item.description) for item in items]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'DELETE FROM {self.table} WHERE rowid = %s',
+                [(row[0],) for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {self.table} (rowid, title, description) '
+                'VALUES (%s, %s, %s)',
+                rows)
+
+    def remove_item(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [pk])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def get_match_expression(self, q):
+        # every word is quoted and used as a prefix, words are AND-ed
+        return ' '.join(f'"{term}"*' for term in get_search_terms(q))
+
+    def get_ranked_ids(self, q):
+        expression = self.get_match_expression(q)
+        if not expression:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {self.table} '
+                f'WHERE {self.table} MATCH %s '
+                f'ORDER BY bm25({self.table}, %s, %s) '
+                'LIMIT %s',
+                [expression, self.title_weight, self.description_weight,
+                    settings.SEARCH_MAX_RESULTS])
+            return [row[0] for row in cursor.fetchall()]
+
+    def search(self, queryset, q):
+        ids = self.get_ranked_ids(q)
+        if not ids:
+            return queryset.none()
+
+        # keep the bm25 order of the index
+        rank = Case(
+            *[When(pk=pk, then=position) for position, pk in enumerate(ids)],
+            output_field=IntegerField()
+        )
+        return queryset.filter(pk__in=ids).order_by(rank)
+
+
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.SEARCH_BACKEND)()
+    return _backend
+
+
+def search_items(queryset, q):
+    return get_search_backend().search(queryset, q)
+
+
+def item_saved_receiver(sender, instance, *args, **kwargs):
+    get_search_backend().index_items([instance])
+
+
+def item_deleted_receiver(sender, instance, *args, **kwargs):
+    get_search_backend().remove_item(instance.pk)
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+
+class TaskFunction:
+    def __init__(self, func, name, max_attempts):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        return enqueue(self, args, kwargs)
+
+    def schedule(self, run_at, *args, **kwargs):
+        return enqueue(self, args, kwargs, run_at=run_at)
+
+
+def task(func=None, max_attempts=None):
+    """
+    Register a function as a task, it is queued with func.delay(...) or
+    func.schedule(run_at, ...). Arguments must be json serializable.
+    """
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        task_function = TaskFunction(func, name,
+            max_attempts or settings.TASK_MAX_ATTEMPTS)
+        registry[name] = task_function
+        return task_function
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def enqueue(task_function, args=(), kwargs=None, run_at=None):
+    """
+    Queued in the current transaction, a rolled back transaction leaves
+    no task behind.
+    """
+    from .models import Task
+
+    return Task.objects.create(
+        name=task_function.name,
+        arguments=json.dumps({'args': list(args), 'kwargs': kwargs or {}}),
+        run_at=run_at or timezone.now(),
+        max_attempts=task_function.max_attempts,
+    )
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def requeue_stale():
+    """Tasks of a worker that died while running them are queued again."""
+    from .models import Task
+
+    stale = timezone.now() - timedelta(seconds=settings.TASK_LOCK_TIMEOUT)
+    return Task.objects.filter(status='R', locked_at__lt=stale).update(
+        status='Q', locked_by='', locked_at=None)
+
+
+def claim(limit):
+    """
+    Lock up to limit due tasks for this worker. The conditional update
+    makes sure two workers never run the same task.
+    """
+    from .models import Task
+
+    worker = get_worker_name()
+    now = timezone.now()
+    ids = list(Task.objects.filter(status='Q', run_at__lte=now)
+        .order_by('run_at').values_list('pk', flat=True)[:limit])
+    if not ids:
+        return []
+
+    Task.objects.filter(pk__in=ids, status='Q').update(status='R',
+        locked_by=worker, locked_at=now)
+    return list(Task.objects.filter(pk__in=ids, status='R', locked_by=worker))
+
+
+def run(task_row):
+    from .models import Task
+
+    try:
+        task_function = registry.get(task_row.name)
+        if task_function is None:
+            # importing the module registers its tasks
+            task_function = import_string(task_row.name)
+
+        arguments = json.loads(task_row.arguments)
+        task_function(*arguments['args'], **arguments['kwargs'])
+    except Exception as e:
+        logger.exception('Task %s failed', task_row)
+        attempts = task_row.attempts + 1
+        if attempts >= task_row.max_attempts:
+            # dead letter, kept for inspection and manual retry
+            status, run_at = 'X', task_row.run_at
+        else:
+            status = 'Q'
+            run_at = timezone.now() + timedelta(
+                seconds=settings.TASK_RETRY_DELAY * 2 ** (attempts - 1))
+        Task.objects.filter(pk=task_row.pk).update(status=status,
+            attempts=attempts, run_at=run_at, last_error=repr(e),
+            locked_by='', locked_at=None)
+    else:
+        Task.objects.filter(pk=task_row.pk).update(status='D',
+            attempts=task_row.attempts + 1, locked_by='', locked_at=None)
+    finally:
+        # worker threads must not keep connections open between tasks
+        connection.close()
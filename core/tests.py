@@ -1,3 +1,1810 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from email.mime.text import MIMEText
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.hashers import make_password
+from django.contrib.messages import get_messages
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction, OperationalError
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+import stripe
+
+from .models import (
+    User,
+    Item,
+    OrderItem,
+    Order,
+    Address,
+    Coupon,
+    DailySales,
+    ItemSales,
+    CategorySales,
+    CouponUsage,
+    ArchivedOrder,
+    ArchivedOrderLine,
+    CartSnapshot,
+    Task,
+    OutboxMessage,
+    Payment,
+    StockReservation,
+    Refund,
+)
+from . import cart, coupons, outbox, rollups, tasks
+from .archive import (
+    reap_carts,
+    reap_orphan_lines,
+    archive_orders,
+    iter_archived_orders,
+)
+from .caching import (
+    get_cart_item_count,
+    get_cart_count_key,
+    set_cart_item_count,
+    get_catalog_version,
+    get_listing_cache_stats,
+)
+from .exports import iter_orders
+from .management.commands.export_orders import parse_date
+from .mail import send_email
+from .inventory import (
+    OutOfStock,
+    get_available,
+    release_expired,
+    release_order,
+    reserve,
+    reserve_order,
+    set_stock,
+)
+from .orders import finalize_order, reconcile_charge
+from .pagination import CursorPaginator, encode_cursor
+from .payments import (
+    FakeProvider,
+    card_lookup_breaker,
+    get_card_cache_key,
+    get_charge_idempotency_key,
+    get_default_card,
+)
+from .querybudget import QueryBudgetTestMixin
+from .refunds import process_refunds
+from .admin import make_refund_accepted
+from .search import search_items
+from .replicas import (
+    PIN_COOKIE,
+    ReplicaPinMiddleware,
+    ReplicaRouter,
+    use_primary,
+)
+
+
+
+class QueryRecorder:
+    """
+    connection.execute_wrapper callable that keeps the raw sql and params
+    of every query, so they can be explained afterwards.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many:
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+
+def get_query_plan(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+# the only index walks the views are expected to plan, every other table
+# access has to be a SEARCH
+EXPECTED_SCANS = {
+    # listing pages walk the ordering index and stop after one page
+    'SCAN core_item USING INDEX core_item_created_id_idx',
+    # the page-number paginator counts the catalog on the smallest index
+    'SCAN core_item USING COVERING INDEX core_item_category_709eb803',
+    # the coupon filter is built from every code
+    'SCAN core_coupon USING COVERING INDEX core_coupon_code_f623b39c',
+}
+
+
+def is_full_table_scan(detail):
+    if not detail.startswith('SCAN'):
+        return False
+    # a MATCH against the fts index
+    if detail.startswith('SCAN core_item_fts VIRTUAL TABLE INDEX 0:M'):
+        return False
+    return detail not in EXPECTED_SCANS
+
+
+
+class SeededTestCase(TestCase):
+    """
+    A small catalog, two customers with default addresses, a paid order
+    and a coupon.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer', 'buyer@example.com',
+            'password')
+        other = User.objects.create_user('other', 'other@example.com',
+            'password')
+
+        categories = ['S', 'SW', 'OW']
+        cls.items = [
+            Item.objects.create(
+                title=f'Item {i}',
+                price=10 + i,
+                discount_price=5 + i if i % 2 else None,
+                category=categories[i % 3],
+                label='P',
+                slug=f'item-{i}',
+                description=f'Cotton shirt number {i}',
+                image='sample.jpg',
+            )
+            for i in range(30)
+        ]
+
+        for user in (cls.user, other):
+            Address.objects.create(user=user, street_address='Main st',
+                apartment_address='1', country='US', zip='1000',
+                address_type='S', default=True)
+            Address.objects.create(user=user, street_address='Main st',
+                apartment_address='1', country='US', zip='1000',
+                address_type='B', default=True)
+
+        # a completed order for the refund lookup
+        done = Order.objects.create(user=other, ordered_date=timezone.now(),
+            ordered=True, ref_code='a' * 24)
+        done.items.add(OrderItem.objects.create(user=other,
+            item=cls.items[1], ordered=True))
+
+        Coupon.objects.create(code='SAVE5', amount=5)
+
+    def setUp(self):
+        cache.clear()
+        # the filter of this process was built for an earlier test's cache
+        coupons._local_filter = (None, None)
+        self.client.force_login(self.user)
+
+    def fill_cart(self):
+        for item in self.items[:3]:
+            self.client.get(reverse('core:add_to_cart',
+                kwargs={'slug': item.slug}))
+
+
+
+class QueryPlanTestCase(SeededTestCase):
+    """
+    Runs the views of core/urls.py against a seeded database and fails
+    when any query they issue is planned as a full table scan.
+    """
+
+    def assertNoFullTableScans(self, method, url, data=None):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 500)
+
+        for sql, params in recorder.queries:
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            for detail in get_query_plan(sql, params):
+                self.assertFalse(is_full_table_scan(detail),
+                    f'{method.upper()} {url}: {detail}\n{sql}')
+        return response
+
+    def test_product_list(self):
+        url = reverse('core:product_list')
+        self.assertNoFullTableScans('get', url)
+        self.assertNoFullTableScans('get', url, {'page': 2})
+        self.assertNoFullTableScans('get', url, {'category': 'sw'})
+        self.assertNoFullTableScans('get', url, {'q': 'cotton shirts'})
+        self.assertNoFullTableScans('get', url, {'cursor': ''})
+
+    def test_product(self):
+        self.assertNoFullTableScans('get', self.items[0].get_absolute_url())
+
+    def test_cart_views(self):
+        item = self.items[0]
+        self.assertNoFullTableScans('get', item.get_add_to_cart_url())
+        self.assertNoFullTableScans('get', item.get_add_to_cart_url())
+        self.assertNoFullTableScans('get', reverse(
+            'core:remove_single_item_from_cart', kwargs={'slug': item.slug}))
+        self.assertNoFullTableScans('get', item.get_remove_from_cart_url())
+
+    def test_cart_api(self):
+        kwargs = {'slug': self.items[0].slug}
+        self.assertNoFullTableScans('post',
+            reverse('core:api_add_to_cart', kwargs=kwargs))
+        self.assertNoFullTableScans('post',
+            reverse('core:api_add_to_cart', kwargs=kwargs))
+        self.assertNoFullTableScans('post',
+            reverse('core:api_remove_single_item_from_cart', kwargs=kwargs))
+        self.assertNoFullTableScans('post',
+            reverse('core:api_remove_from_cart', kwargs=kwargs))
+
+    def test_order_summary(self):
+        self.fill_cart()
+        self.assertNoFullTableScans('get', reverse('core:order_summary'))
+
+    def test_checkout(self):
+        self.fill_cart()
+        url = reverse('core:checkout')
+        self.assertNoFullTableScans('get', url)
+        self.assertNoFullTableScans('post', url, {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+
+    def test_add_coupon(self):
+        self.fill_cart()
+        self.assertNoFullTableScans('post', reverse('core:add_coupon'),
+            {'code': 'SAVE5'})
+
+    def test_payment(self):
+        self.fill_cart()
+        self.client.post(reverse('core:checkout'), {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+        url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+        self.assertNoFullTableScans('get', url)
+
+        with mock.patch('stripe.Charge.create', return_value={'id': 'ch_test'}):
+            self.assertNoFullTableScans('post', url, {'stripeToken': 'tok_test'})
+
+    def test_request_refund(self):
+        url = reverse('core:request_refund')
+        self.assertNoFullTableScans('get', url)
+        self.assertNoFullTableScans('post', url, {
+            'ref_code': 'a' * 24,
+            'message': 'Wrong size',
+            'email': 'other@example.com',
+        })
+
+
+
+class QueryBudgetTestCase(QueryBudgetTestMixin, SeededTestCase):
+    """
+    Every view of core/urls.py stays within the query budget declared
+    there and does not repeat a query per row (N+1).
+    """
+
+    def get(self, name, data=None, **kwargs):
+        response = self.client.get(reverse(name, kwargs=kwargs), data or {})
+        self.assertWithinQueryBudget(response)
+        return response
+
+    def post(self, name, data=None, **kwargs):
+        response = self.client.post(reverse(name, kwargs=kwargs), data or {})
+        self.assertWithinQueryBudget(response)
+        return response
+
+    def checkout(self):
+        return self.post('core:checkout', {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+
+    def test_catalog(self):
+        self.get('core:product_list')
+        self.get('core:product_list', {'category': 'S', 'page': 2})
+        self.get('core:product_list', {'q': 'cotton'})
+        self.get('core:product', slug=self.items[0].slug)
+
+    def test_cart(self):
+        slug = self.items[0].slug
+        self.get('core:add_to_cart', slug=slug)
+        self.get('core:add_to_cart', slug=slug)
+        self.get('core:remove_single_item_from_cart', slug=slug)
+        self.get('core:remove_from_cart', slug=slug)
+        self.post('core:api_add_to_cart', slug=slug)
+        self.post('core:api_remove_single_item_from_cart', slug=slug)
+        self.post('core:api_remove_from_cart', slug=slug)
+
+    def test_checkout(self):
+        # enough lines to expose per line queries
+        for item in self.items[:10]:
+            self.client.get(item.get_add_to_cart_url())
+
+        self.get('core:order_summary')
+        self.get('core:checkout')
+        self.checkout()
+        self.post('core:add_coupon', {'code': 'SAVE5'})
+        self.get('core:payment', payment_option='stripe')
+
+        with mock.patch('stripe.Charge.create', return_value={'id': 'ch_test'}):
+            self.post('core:payment', {'stripeToken': 'tok_test'},
+                payment_option='stripe')
+
+    def test_request_refund(self):
+        self.get('core:request_refund')
+        self.post('core:request_refund', {
+            'ref_code': 'a' * 24,
+            'message': 'Wrong size',
+            'email': 'other@example.com',
+        })
+
+
+
+class SalesRollupTestCase(SeededTestCase):
+    def get_rollups(self):
+        return {
+            model.__name__: sorted(
+                str({key: value for key, value in row.items() if key != 'id'})
+                for row in model.objects.values()
+            )
+            for model in (DailySales, ItemSales, CategorySales, CouponUsage)
+        }
+
+    def rebuild(self):
+        return rollups.rebuild(iter_orders(Order.objects.filter(ordered=True)))
+
+    def test_incremental_matches_rebuild(self):
+        self.rebuild()
+
+        self.fill_cart()
+        order = Order.objects.get(user=self.user, ordered=False)
+        order.coupon = Coupon.objects.get(code='SAVE5')
+        order.save(update_fields=['coupon'])
+        order.update_totals()
+        finalize_order(order, {'id': 'ch_test'}, order.total_cents)
+        outbox.drain()
+
+        incremental = self.get_rollups()
+        self.assertEqual(self.rebuild(), 2)
+        self.assertEqual(incremental, self.get_rollups())
+
+        usage = CouponUsage.objects.get()
+        self.assertEqual(usage.orders, 1)
+        self.assertEqual(usage.discount_cents, 500)
+
+    def pay_order(self):
+        self.fill_cart()
+        order = Order.objects.get(user=self.user, ordered=False)
+        order.update_totals()
+        return finalize_order(order, {'id': 'ch_test'}, order.total_cents)
+
+    def test_repeated_drains_count_once(self):
+        self.rebuild()
+        self.pay_order()
+        outbox.drain()
+        outbox.drain()
+
+        incremental = self.get_rollups()
+        self.rebuild()
+        self.assertEqual(incremental, self.get_rollups())
+
+    def test_retried_message_counts_once(self):
+        self.rebuild()
+        self.pay_order()
+
+        # the rollups of the failed attempt are rolled back with it
+        flaky = mock.Mock(side_effect=[ValueError('flaky'), None])
+        handlers = outbox.handlers['order_paid'] + [flaky]
+        with mock.patch.dict(outbox.handlers, {'order_paid': handlers}):
+            outbox.drain()
+            self.assertEqual(OutboxMessage.objects.get(topic='order_paid',
+                processed_at__isnull=True).attempts, 1)
+            outbox.drain()
+        self.assertEqual(flaky.call_count, 2)
+
+        incremental = self.get_rollups()
+        self.rebuild()
+        self.assertEqual(incremental, self.get_rollups())
+
+    def test_archived_orders_are_rolled_up(self):
+        self.rebuild()
+        before = self.get_rollups()
+
+        self.assertEqual(archive_orders(timezone.now()), 1)
+        self.assertFalse(Order.objects.filter(ordered=True).exists())
+
+        rollups.rebuild(iter_orders(Order.objects.filter(ordered=True)),
+            iter_archived_orders())
+        self.assertEqual(before, self.get_rollups())
+        self.assertEqual(ArchivedOrder.objects.get().ref_code, 'a' * 24)
+
+
+
+class ArchiveTestCase(SeededTestCase):
+    def test_reap_carts(self):
+        self.fill_cart()
+        self.assertEqual(reap_carts(timezone.now() - timedelta(days=1)), 0)
+        self.assertEqual(reap_carts(timezone.now()), 1)
+
+        self.assertFalse(Order.objects.filter(ordered=False).exists())
+        self.assertFalse(OrderItem.objects.filter(ordered=False).exists())
+        self.assertEqual(get_cart_item_count(self.user), 0)
+
+    def test_reap_orphan_lines(self):
+        self.fill_cart()
+        orphan = OrderItem.objects.create(user=self.user, item=self.items[5])
+
+        self.assertEqual(reap_orphan_lines(), 1)
+        self.assertFalse(OrderItem.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(OrderItem.objects.filter(user=self.user).count(), 3)
+        # paid lines are kept
+        self.assertTrue(OrderItem.objects.filter(ordered=True).exists())
+
+    def test_archive_keeps_the_paid_prices(self):
+        self.fill_cart()
+        order = Order.objects.get(user=self.user, ordered=False)
+        order.update_totals()
+        finalize_order(order, {'id': 'ch_archive'}, order.total_cents)
+        self.assertEqual(sorted(order.items.values_list('line_cents', flat=True)),
+            [600, 1000, 1200])
+
+        Item.objects.filter(pk__in=[item.pk for item in self.items[:3]]) \
+            .update(price=99, discount_price=None)
+        archive_orders(timezone.now())
+
+        lines = ArchivedOrderLine.objects.filter(order_id=order.pk)
+        self.assertEqual(sorted(lines.values_list('line_cents', flat=True)),
+            [600, 1000, 1200])
+
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTestCase(TestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def get_read_databases(self, request):
+        seen = {}
+
+        def view(request):
+            seen['item'] = self.router.db_for_read(Item)
+            seen['order'] = self.router.db_for_read(Order)
+            self.router.db_for_write(Order)
+            seen['item_after_write'] = self.router.db_for_read(Item)
+            return HttpResponse()
+
+        response = ReplicaPinMiddleware(view)(request)
+        return seen, response
+
+    def test_catalog_reads_go_to_the_replica(self):
+        seen, response = self.get_read_databases(self.factory.get('/'))
+        self.assertEqual(seen['item'], 'replica')
+        self.assertEqual(seen['order'], 'default')
+        self.assertEqual(seen['item_after_write'], 'default')
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+    def test_pinned_after_a_write(self):
+        request = self.factory.get('/')
+        request.COOKIES[PIN_COOKIE] = str(time.time() + 5)
+        seen, response = self.get_read_databases(request)
+        self.assertEqual(seen['item'], 'default')
+
+        request = self.factory.get('/')
+        request.COOKIES[PIN_COOKIE] = str(time.time() - 1)
+        seen, response = self.get_read_databases(request)
+        self.assertEqual(seen['item'], 'replica')
+
+    def test_reads_outside_requests_use_default(self):
+        # e.g. a command or a task worker thread, before and after requests
+        self.assertEqual(self.router.db_for_read(Item), 'default')
+        self.get_read_databases(self.factory.get('/'))
+        self.router.db_for_write(Order)
+        self.assertEqual(self.router.db_for_read(Item), 'default')
+
+        # a write outside a request does not pin the next request
+        seen, response = self.get_read_databases(self.factory.get('/'))
+        self.assertEqual(seen['item'], 'replica')
+
+    def test_use_primary(self):
+        seen = {}
+
+        def view(request):
+            with use_primary():
+                seen['inside'] = self.router.db_for_read(Item)
+            seen['after'] = self.router.db_for_read(Item)
+            return HttpResponse()
+
+        response = ReplicaPinMiddleware(view)(self.factory.get('/'))
+        self.assertEqual(seen, {'inside': 'default', 'after': 'replica'})
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_listings_render_from_default(self):
+        cache.clear()
+        item = Item.objects.create(title='Shirt', price=10, category='S',
+            label='P', slug='shirt', description='Cotton shirt',
+            image='sample.jpg')
+
+        # the replica is chosen, the query still runs on the test database
+        with mock.patch('core.replicas.random.choice',
+                return_value='default') as choose_replica:
+            self.client.get(reverse('core:product_list'))
+            self.client.get(reverse('core:product_list'), {'q': 'shirt'})
+            choose_replica.assert_not_called()
+
+            self.client.get(item.get_absolute_url())
+            choose_replica.assert_called_with(['replica'])
+
+
+
+@override_settings(CART_STORE='core.cart.CacheCartStore')
+class CacheCartStoreTestCase(SeededTestCase):
+    def test_cart_lives_in_the_cache(self):
+        self.fill_cart()
+        self.client.get(reverse('core:add_to_cart',
+            kwargs={'slug': self.items[0].slug}))
+
+        self.assertFalse(Order.objects.filter(user=self.user,
+            ordered=False).exists())
+        self.assertEqual(get_cart_item_count(self.user), 3)
+        response = self.client.get(reverse('core:order_summary'))
+        self.assertContains(response, self.items[2].title)
+
+    def test_snapshot_survives_the_cache(self):
+        self.fill_cart()
+        cart.flush_cart(self.user.pk)
+        self.assertEqual(CartSnapshot.objects.get(user=self.user).version, 3)
+
+        cache.clear()
+        self.assertEqual(cart.count_items(self.user), 3)
+
+    def test_order_is_created_at_checkout(self):
+        self.fill_cart()
+        cart.remove_single_item(self.user, self.items[1])
+
+        self.client.get(reverse('core:checkout'))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            sorted(order.items.values_list('item_id', flat=True)),
+            sorted([self.items[0].pk, self.items[2].pk]))
+        self.assertEqual(order.total_cents, cart.get_cart(self.user).total_cents)
+
+        # later changes are copied at the next checkout
+        cart.add_item(self.user, self.items[5])
+        order = cart.get_order(self.user)
+        self.assertEqual(order.items.count(), 3)
+
+    def test_materialize_never_duplicates_lines(self):
+        self.fill_cart()
+        cart.add_item(self.user, self.items[0])
+        store = cart.get_cart_store()
+        store._materialize(self.user, force=True)
+        store._materialize(self.user, force=True)
+
+        order = cart.get_order(self.user)
+        self.assertEqual(
+            sorted(order.items.values_list('item_id', 'quantity')),
+            sorted([(self.items[0].pk, 2), (self.items[1].pk, 1),
+                (self.items[2].pk, 1)]))
+
+    def test_not_in_cart_carries_the_totals(self):
+        self.fill_cart()
+        response = self.client.post(reverse('core:api_remove_from_cart',
+            kwargs={'slug': self.items[5].slug}))
+        data = response.json()
+        self.assertEqual(data['status'], 'not_in_cart')
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(data['total'], 28)
+
+    @override_settings(CART_LOCK_TIMEOUT=0.05)
+    def test_lock_gives_up(self):
+        self.fill_cart()
+        # held by a request that is stuck
+        cache.set(f'cart:lock:{self.user.pk}', 'stuck', 60)
+
+        with self.assertRaises(cart.CartBusy):
+            cart.add_item(self.user, self.items[0])
+        response = self.client.post(reverse('core:api_add_to_cart',
+            kwargs={'slug': self.items[0].slug}))
+        self.assertEqual(response.status_code, 409)
+
+        # a paid cart is cleared anyway
+        cart.clear(self.user)
+        self.assertEqual(cart.count_items(self.user), 0)
+
+
+
+class CartConcurrencyTestCase(TransactionTestCase):
+    """
+    Hammers one cart from many threads, as a user double clicking or
+    shopping from several tabs would.
+    """
+    threads = 8
+    repeats = 5
+    # sqlite reports lock contention instead of waiting on it, each call
+    # is retried for up to this many seconds before the test gives up
+    lock_wait = 10
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com',
+            'password')
+        self.item = Item.objects.create(title='Shirt', price=10,
+            category='S', label='P', slug='shirt', description='Shirt',
+            image='sample.jpg')
+
+        # on a file test database the connections of the worker threads
+        # give up on a lock quickly instead of sitting out sqlite's default
+        # 5 second timeout, the in-memory one fails right away
+        options = mock.patch.dict(connection.settings_dict['OPTIONS'],
+            {'timeout': 0.05})
+        options.start()
+        self.addCleanup(options.stop)
+
+    def run_concurrently(self, func):
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker():
+            barrier.wait()
+            try:
+                for _ in range(self.repeats):
+                    deadline = time.monotonic() + self.lock_wait
+                    attempt = 0
+                    while True:
+                        try:
+                            func(self.user, self.item)
+                            break
+                        except OperationalError as e:
+                            if time.monotonic() > deadline:
+                                raise AssertionError(f'{func.__name__} was '
+                                    f'locked out for {self.lock_wait}s: {e}')
+                            # back off so the holder of the lock can finish
+                            time.sleep(random.uniform(0,
+                                min(0.001 * 2 ** attempt, 0.05)))
+                            attempt += 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_adds(self):
+        self.run_concurrently(cart.add_item)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        order_item = order.items.get()
+        self.assertEqual(order_item.quantity, self.threads * self.repeats)
+        self.assertEqual(order.total_cents,
+            self.threads * self.repeats * 1000)
+
+    def test_concurrent_removes(self):
+        for _ in range(self.threads * self.repeats + 1):
+            cart.add_item(self.user, self.item)
+
+        self.run_concurrently(cart.remove_single_item)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, 1)
+
+
+
+class SearchTestCase(TestCase):
+    """Runs against the sqlite fts5 index kept up to date by the signals."""
+
+    def create_item(self, title, description, category='S'):
+        return Item.objects.create(title=title, price=10, category=category,
+            label='P', slug=title.lower().replace(' ', '-'),
+            description=description, image='sample.jpg')
+
+    def search(self, q, queryset=None):
+        queryset = Item.objects.all() if queryset is None else queryset
+        return list(search_items(queryset, q))
+
+    def test_title_matches_rank_first(self):
+        in_description = self.create_item('Plain jacket', 'Worn over a linen shirt')
+        in_title = self.create_item('Linen shirt', 'Light summer wear')
+        self.assertEqual(self.search('linen shirt'), [in_title, in_description])
+
+    def test_stemming(self):
+        item = self.create_item('Running shoes', 'For long runs')
+        self.assertEqual(self.search('shoe'), [item])
+        self.assertEqual(self.search('runs'), [item])
+
+    def test_category_and_query(self):
+        shirt = self.create_item('Cotton shirt', 'Soft cotton', category='S')
+        self.create_item('Cotton hoodie', 'Soft cotton', category='SW')
+        self.assertEqual(
+            self.search('cotton', Item.objects.filter(category='S')), [shirt])
+
+    def test_index_follows_saves_and_deletes(self):
+        item = self.create_item('Wool scarf', 'Warm')
+        self.assertEqual(self.search('scarf'), [item])
+
+        item.title = 'Wool hat'
+        item.save()
+        self.assertEqual(self.search('scarf'), [])
+        self.assertEqual(self.search('hat'), [item])
+
+        item.delete()
+        self.assertEqual(self.search('hat'), [])
+
+    def test_query_syntax_is_not_parsed(self):
+        self.create_item('Denim jacket', 'Blue')
+        self.assertEqual(self.search('"denim" OR NEAR('), [])
+
+
+
+class PaginationTestCase(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.newest_first = list(Item.objects.order_by('-created_at', '-pk'))
+
+    def test_cursor_navigation(self):
+        paginator = CursorPaginator(Item.objects.all(), 12)
+
+        first = paginator.page()
+        self.assertEqual(list(first), self.newest_first[:12])
+        self.assertTrue(first.has_next())
+        self.assertFalse(first.has_previous())
+
+        second = paginator.page(first.next_cursor)
+        self.assertEqual(list(second), self.newest_first[12:24])
+        self.assertTrue(second.has_previous())
+
+        last = paginator.page(second.next_cursor)
+        self.assertEqual(list(last), self.newest_first[24:])
+        self.assertFalse(last.has_next())
+
+        back = paginator.page(last.previous_cursor)
+        self.assertEqual(list(back), self.newest_first[12:24])
+        self.assertEqual(list(paginator.page(back.previous_cursor)),
+            self.newest_first[:12])
+
+    def test_cursor_view(self):
+        response = self.client.get(reverse('core:product_list'), {'cursor': ''})
+        self.assertContains(response, self.newest_first[0].title)
+
+        cursor = encode_cursor(self.newest_first[19], 'n')
+        response = self.client.get(reverse('core:product_list'),
+            {'cursor': cursor})
+        self.assertContains(response, self.newest_first[20].get_absolute_url())
+        self.assertNotContains(response,
+            f'href="{self.newest_first[0].get_absolute_url()}"')
+
+    def test_invalid_pages_are_not_found(self):
+        url = reverse('core:product_list')
+        for data in ({'cursor': 'garbage'}, {'cursor': encode_cursor(
+                self.items[0], 'n')[:-4]}, {'page': 99}, {'page': 'last-ish'}):
+            self.assertEqual(self.client.get(url, data).status_code, 404, data)
+
+
+
+class CartCountTestCase(TransactionTestCase):
+    """The navbar badge is written by the cart mutations, on commit."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com',
+            'password')
+        self.items = [
+            Item.objects.create(title=f'Shirt {i}', price=10, category='S',
+                label='P', slug=f'shirt-{i}', description='Shirt',
+                image='sample.jpg')
+            for i in range(2)
+        ]
+
+    def cached_count(self):
+        return cache.get(get_cart_count_key(self.user.pk))
+
+    def test_mutations_update_the_cached_count(self):
+        first, second = self.items
+        cart.add_item(self.user, first)
+        self.assertEqual(self.cached_count(), 1)
+        cart.add_item(self.user, first)
+        cart.add_item(self.user, second)
+        self.assertEqual(self.cached_count(), 2)
+
+        cart.remove_single_item(self.user, first)
+        self.assertEqual(self.cached_count(), 2)
+        cart.remove_item(self.user, second)
+        self.assertEqual(self.cached_count(), 1)
+        cart.remove_single_item(self.user, first)
+        self.assertEqual(self.cached_count(), 0)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_item_count(self.user), 0)
+
+
+
+class CartCountPaymentTestCase(SeededTestCase):
+    def test_payment_empties_the_cached_count(self):
+        self.fill_cart()
+        self.client.post(reverse('core:checkout'), {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+        set_cart_item_count(self.user, 3)
+
+        with mock.patch('stripe.Charge.create', return_value={'id': 'ch_count'}):
+            self.client.post(reverse('core:payment',
+                kwargs={'payment_option': 'stripe'}), {'stripeToken': 'tok_test'})
+
+        self.assertTrue(Order.objects.filter(user=self.user, ordered=True).exists())
+        self.assertEqual(cache.get(get_cart_count_key(self.user.pk)), 0)
+
+
+
+@override_settings(LISTING_STATS_SAMPLE_RATE=1)
+class ListingCacheTestCase(TransactionTestCase):
+    """
+    A TransactionTestCase, the catalog version is bumped when the
+    transaction that changed an item commits.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.item = Item.objects.create(title='Linen shirt', price=10,
+            category='S', label='P', slug='linen-shirt',
+            description='Shirt', image='sample.jpg')
+
+    def get_listing(self):
+        return self.client.get(reverse('core:product_list'))
+
+    def test_hit_and_miss(self):
+        self.assertContains(self.get_listing(), 'Linen shirt')
+        self.assertContains(self.get_listing(), 'Linen shirt')
+        self.assertEqual(get_listing_cache_stats()['misses'], 1)
+        self.assertEqual(get_listing_cache_stats()['hits'], 1)
+
+    def test_saves_and_deletes_invalidate(self):
+        self.get_listing()
+
+        self.item.title = 'Wool shirt'
+        self.item.save()
+        self.assertContains(self.get_listing(), 'Wool shirt')
+
+        self.item.delete()
+        self.assertNotContains(self.get_listing(), 'Wool shirt')
+        self.assertEqual(get_listing_cache_stats()['misses'], 3)
+
+    def test_version_is_bumped_on_commit(self):
+        version = get_catalog_version()
+        with transaction.atomic():
+            self.item.title = 'Wool shirt'
+            self.item.save()
+            self.assertEqual(get_catalog_version(), version)
+        self.assertEqual(get_catalog_version(), version + 1)
+
+
+
+class ThumbnailTestCase(TestCase):
+    def test_srcset_needs_no_storage_lookups(self):
+        item = Item(title='Shirt', price=10, category='S', label='P',
+            slug='shirt', description='Shirt', image='products/shirt.jpg',
+            thumbnail_source='products/shirt.jpg', thumbnail_widths='320,640')
+
+        with mock.patch('django.core.files.storage.default_storage.exists',
+                side_effect=AssertionError('storage was asked')):
+            srcset = item.get_webp_image_srcset()
+        self.assertIn('products/shirt_320w.webp 320w', srcset)
+        self.assertIn('products/shirt_640w.webp 640w', srcset)
+
+        # derivatives of the previous image are not used
+        item.image = 'products/other.jpg'
+        self.assertEqual(item.get_image_srcset(), '')
+
+    def test_unchanged_image_is_not_resized_again(self):
+        with mock.patch('core.thumbnails.generate_thumbnails_task.delay') \
+                as delay:
+            item = Item.objects.create(title='Shirt', price=10,
+                category='S', label='P', slug='shirt', description='Shirt',
+                image='products/shirt.jpg')
+            delay.assert_called_once_with('products/shirt.jpg')
+
+            Item.objects.filter(pk=item.pk).update(
+                thumbnail_source='products/shirt.jpg',
+                thumbnail_widths='320,640')
+            item.refresh_from_db()
+            item.price = 12
+            item.save()
+            delay.assert_called_once()
+
+            item.image = 'products/other.jpg'
+            item.save()
+            delay.assert_called_with('products/other.jpg')
+
+
+
+class OrderTotalsTestCase(SeededTestCase):
+    """The denormalized totals follow price and coupon changes."""
+
+    def setUp(self):
+        super().setUp()
+        self.fill_cart()
+
+    def checkout(self):
+        self.client.post(reverse('core:checkout'), {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+
+    def test_price_change(self):
+        # 10 + 6 + 12 in the cart, the first item gets more expensive
+        Item.objects.filter(pk=self.items[0].pk).update(price=999)
+
+        response = self.client.get(reverse('core:order_summary'))
+        self.assertEqual(response.context['object'].get_total(), 1017)
+
+        response = self.client.get(reverse('core:checkout'))
+        self.assertEqual(response.context['order'].get_total(), 1017)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.total_cents, 101700)
+        self.assertEqual(order.total_cents, order.get_total_cents())
+
+    def test_coupon_change(self):
+        self.checkout()
+        self.client.post(reverse('core:add_coupon'), {'code': 'SAVE5'})
+        Coupon.objects.filter(code='SAVE5').update(amount=10)
+
+        response = self.client.get(reverse('core:payment',
+            kwargs={'payment_option': 'stripe'}))
+        self.assertEqual(response.context['order'].get_total(), 18)
+
+    def test_charged_amount_is_the_shown_amount(self):
+        self.checkout()
+        Item.objects.filter(pk=self.items[0].pk).update(price=999)
+        response = self.client.get(reverse('core:payment',
+            kwargs={'payment_option': 'stripe'}))
+        shown = response.context['order'].total_cents
+
+        with mock.patch('stripe.Charge.create',
+                return_value={'id': 'ch_totals'}) as create:
+            self.client.post(reverse('core:payment',
+                kwargs={'payment_option': 'stripe'}), {'stripeToken': 'tok_test'})
+        self.assertEqual(create.call_args[1]['amount'], shown)
+
+
+
+class CartQueriesTestCase(SeededTestCase):
+    def count_queries(self, func, *args):
+        with CaptureQueriesContext(connection) as queries:
+            result = func(*args)
+        return result, len(queries)
+
+    def test_round_trips(self):
+        item = self.items[0]
+        result, count = self.count_queries(cart.add_item, self.user, item)
+        self.assertEqual(result.status, 'added')
+        # lock, create the cart, insert the line, totals, plus savepoints
+        self.assertLessEqual(count, 10)
+
+        result, count = self.count_queries(cart.add_item, self.user, item)
+        self.assertEqual(result.status, 'updated')
+        self.assertEqual(result.order_item.quantity, 2)
+        self.assertLessEqual(count, 7)
+
+    def test_removed_lines_leave_no_order_items(self):
+        item = self.items[0]
+        cart.add_item(self.user, item)
+        cart.remove_item(self.user, item)
+        self.assertFalse(OrderItem.objects.filter(user=self.user).exists())
+
+        cart.add_item(self.user, item)
+        cart.remove_single_item(self.user, item)
+        self.assertFalse(OrderItem.objects.filter(user=self.user).exists())
+
+        result = cart.add_item(self.user, item)
+        self.assertEqual(result.order_item.quantity, 1)
+        self.assertEqual(result.count, 1)
+
+
+
+class CartApiTestCase(SeededTestCase):
+    def post(self, name, item):
+        return self.client.post(reverse(name, kwargs={'slug': item.slug}))
+
+    def test_response(self):
+        item = self.items[0]
+        data = self.post('core:api_add_to_cart', item).json()
+        self.assertEqual(data, {
+            'status': 'added',
+            'line': {'slug': item.slug, 'title': item.title, 'quantity': 1,
+                'final_price': 10},
+            'count': 1,
+            'subtotal': 10,
+            'total': 10,
+        })
+
+        data = self.post('core:api_add_to_cart', item).json()
+        self.assertEqual(data['status'], 'updated')
+        self.assertEqual(data['line']['quantity'], 2)
+        self.assertEqual(data['total'], 20)
+
+        data = self.post('core:api_remove_single_item_from_cart', item).json()
+        self.assertEqual(data['line']['quantity'], 1)
+
+        data = self.post('core:api_remove_from_cart', item).json()
+        self.assertEqual(data['status'], 'removed')
+        self.assertIsNone(data['line'])
+        self.assertEqual(data['count'], 0)
+
+    def test_anonymous(self):
+        self.client.logout()
+        response = self.post('core:api_add_to_cart', self.items[0])
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(),
+            {'error': 'Authentication required.'})
+
+    def test_get_is_not_allowed(self):
+        response = self.client.get(reverse('core:api_add_to_cart',
+            kwargs={'slug': self.items[0].slug}))
+        self.assertEqual(response.status_code, 405)
+
+    def test_busy_cart(self):
+        with mock.patch.object(cart.DatabaseCartStore, 'add_item',
+                side_effect=cart.CartBusy):
+            response = self.post('core:api_add_to_cart', self.items[0])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(),
+            {'error': 'The cart is being updated.'})
+
+    def test_csrf_cookie_for_the_summary_page(self):
+        self.fill_cart()
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        response = client.get(reverse('core:order_summary'))
+        token = response.cookies['csrftoken'].value
+
+        url = reverse('core:api_add_to_cart',
+            kwargs={'slug': self.items[0].slug})
+        self.assertEqual(client.post(url).status_code, 403)
+        response = client.post(url, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+
+
+class SavedCardTestCase(SeededTestCase):
+    cards = {'data': [{'last4': '4242', 'exp_month': 12, 'exp_year': 2030}]}
+
+    def setUp(self):
+        super().setUp()
+        self.user.userprofile.stripe_customer_id = 'cus_saved'
+        self.user.userprofile.one_click_purchasing = True
+        self.user.userprofile.save()
+
+    def test_card_is_cached(self):
+        with mock.patch('stripe.Customer.list_sources',
+                return_value=self.cards) as list_sources:
+            card = get_default_card('cus_saved')
+            self.assertEqual(get_default_card('cus_saved'), card)
+        self.assertEqual(card['last4'], '4242')
+        self.assertEqual(list_sources.call_count, 1)
+
+    def test_adding_a_card_invalidates_the_cache(self):
+        self.fill_cart()
+        self.client.post(reverse('core:checkout'), {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+        with mock.patch('stripe.Customer.list_sources', return_value=self.cards):
+            response = self.client.get(reverse('core:payment',
+                kwargs={'payment_option': 'stripe'}))
+        self.assertEqual(response.context['card']['last4'], '4242')
+        self.assertIsNotNone(cache.get(get_card_cache_key('cus_saved')))
+
+        with mock.patch('stripe.Customer.create_source',
+                return_value={'id': 'card_new'}) as create_source, \
+                mock.patch('stripe.Charge.create', return_value={'id': 'ch_card'}):
+            self.client.post(reverse('core:payment',
+                kwargs={'payment_option': 'stripe'}),
+                {'stripeToken': 'tok_test', 'save': 'on'})
+        self.assertEqual(create_source.call_count, 1)
+        self.assertIsNone(cache.get(get_card_cache_key('cus_saved')))
+
+    def test_breaker_opens_and_closes(self):
+        threshold = card_lookup_breaker.failure_threshold
+        with mock.patch('stripe.Customer.list_sources',
+                side_effect=stripe.error.APIConnectionError('down')) as list_sources:
+            for i in range(threshold):
+                self.assertIsNone(get_default_card('cus_saved'))
+            self.assertTrue(card_lookup_breaker.is_open())
+
+            # stripe is not called while the breaker is open
+            self.assertIsNone(get_default_card('cus_saved'))
+        self.assertEqual(list_sources.call_count, threshold)
+
+        # the reset timeout elapsed
+        cache.delete(card_lookup_breaker.opened_key)
+        with mock.patch('stripe.Customer.list_sources', return_value=self.cards):
+            self.assertEqual(get_default_card('cus_saved')['last4'], '4242')
+        self.assertFalse(card_lookup_breaker.is_open())
+        self.assertIsNone(cache.get(card_lookup_breaker.failures_key))
+
+
+
+@override_settings(FAKE_PAYMENT_LATENCY=0.6, PAYMENT_PROVIDER_TIMEOUT=0.2)
+class PaymentTimeoutTestCase(SeededTestCase):
+    def test_timed_out_charge_is_settled_once(self):
+        provider = FakeProvider()
+        self.fill_cart()
+        self.client.post(reverse('core:checkout'), {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+
+        with mock.patch('core.payments._provider', provider):
+            response = self.client.post(reverse('core:payment',
+                kwargs={'payment_option': 'stripe'}), {'stripeToken': 'tok_test'})
+            # after the messages of the cart changes
+            message = list(get_messages(response.wsgi_request))[-1]
+            self.assertIn('do not pay again', str(message))
+
+            order = Order.objects.get(user=self.user, ordered=False)
+            task_row = Task.objects.get(name='core.orders.reconcile_charge')
+
+            # the charge in flight lands, then the worker runs the task
+            time.sleep(0.6)
+            arguments = json.loads(task_row.arguments)
+            reconcile_charge(*arguments['args'], **arguments['kwargs'])
+
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        charge, = provider.charges.values()
+        self.assertEqual(order.payment.stripe_charge_id, charge['id'])
+
+
+
+@override_settings(FAKE_PAYMENT_LATENCY=0)
+class DeclinedChargeTestCase(SeededTestCase):
+    def test_retry_after_decline(self):
+        provider = FakeProvider()
+        self.fill_cart()
+        self.client.post(reverse('core:checkout'), {
+            'use_default_shipping': 'on',
+            'use_default_billing': 'on',
+            'payment_option': 'S',
+        })
+        url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+        order = Order.objects.get(user=self.user, ordered=False)
+        declined_key = get_charge_idempotency_key(order, 2800)
+
+        with mock.patch('core.payments._provider', provider):
+            response = self.client.post(url,
+                {'stripeToken': 'tok_chargeDeclined'})
+            message = list(get_messages(response.wsgi_request))[-1]
+            self.assertEqual(str(message), 'Your card was declined.')
+
+            # the key of the declined attempt keeps replaying the decline
+            with self.assertRaises(stripe.error.CardError):
+                provider.charge(2800, source='tok_visa',
+                    idempotency_key=declined_key)
+
+            self.client.post(url, {'stripeToken': 'tok_visa'})
+
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.charge_attempt, 1)
+        self.assertEqual(len(provider.charges), 2)
+        self.assertEqual(order.payment.stripe_charge_id,
+            provider.charges[get_charge_idempotency_key(order, 2800)]['id'])
+
+
+
+class FinalizeOrderTestCase(SeededTestCase):
+    def test_finalize_order_is_idempotent(self):
+        self.fill_cart()
+        order = Order.objects.get(user=self.user, ordered=False)
+        charge = {'id': 'ch_once'}
+
+        first = finalize_order(order, charge, 2800)
+        second = finalize_order(order, charge, 2800)
+
+        self.assertTrue(second.ordered)
+        self.assertEqual(second.ref_code, first.ref_code)
+        self.assertEqual(Payment.objects.filter(stripe_charge_id='ch_once').count(), 1)
+        self.assertEqual(OutboxMessage.objects.filter(topic='order_paid').count(), 1)
+
+
+
+class OutboxTestCase(TestCase):
+    def test_failed_message_is_retried(self):
+        handler = mock.Mock(side_effect=[ValueError('flaky'), None])
+        message = outbox.enqueue('test', value=1)
+
+        with mock.patch.dict(outbox.handlers, {'test': [handler]}):
+            self.assertEqual(outbox.drain(), 1)
+            message.refresh_from_db()
+            self.assertIsNone(message.processed_at)
+            self.assertEqual(message.attempts, 1)
+            self.assertIn('flaky', message.last_error)
+
+            self.assertEqual(outbox.drain(), 1)
+            message.refresh_from_db()
+            self.assertIsNotNone(message.processed_at)
+            self.assertEqual(message.attempts, 2)
+
+            # processed messages are not handled again
+            self.assertEqual(outbox.drain(), 0)
+        handler.assert_called_with(value=1)
+        self.assertEqual(handler.call_count, 2)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_message_is_dead_lettered(self):
+        handler = mock.Mock(side_effect=ValueError('broken'))
+        message = outbox.enqueue('test', value=1)
+
+        with mock.patch.dict(outbox.handlers, {'test': [handler]}):
+            outbox.drain()
+            outbox.drain()
+            self.assertEqual(outbox.drain(), 0)
+
+        message.refresh_from_db()
+        self.assertIsNone(message.processed_at)
+        self.assertEqual(message.attempts, 2)
+        self.assertEqual(handler.call_count, 2)
+
+
+
+class StockTestCase(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.item = self.items[0]
+        set_stock(self.item, 10, shards=4)
+        self.order = Order.objects.create(user=self.user,
+            ordered_date=timezone.now())
+
+    def add_line(self, quantity):
+        self.order.items.add(OrderItem.objects.create(user=self.user,
+            item=self.item, quantity=quantity))
+
+    def test_reserve_and_release(self):
+        self.add_line(3)
+        reserve_order(self.order)
+        self.assertEqual(get_available(self.item), 7)
+
+        # reserving again replaces the earlier reservation
+        reserve_order(self.order)
+        self.assertEqual(get_available(self.item), 7)
+
+        release_order(self.order)
+        self.assertEqual(get_available(self.item), 10)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_reserve_across_shards(self):
+        # no shard holds more than 3 units
+        self.add_line(8)
+        reserve_order(self.order)
+        self.assertEqual(get_available(self.item), 2)
+        self.assertGreater(StockReservation.objects.count(), 1)
+
+    def test_out_of_stock_keeps_nothing_reserved(self):
+        self.add_line(11)
+        with self.assertRaises(OutOfStock):
+            reserve_order(self.order)
+        self.assertEqual(get_available(self.item), 10)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_expired_reservations_are_released(self):
+        past = timezone.now() - timedelta(minutes=1)
+        reserve(self.order, self.item, 2, past)
+        reserve(self.order, self.item, 1, timezone.now() + timedelta(hours=1))
+        paid = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        reserve(paid, self.item, 1, past)
+        StockReservation.objects.filter(order=paid).update(committed=True)
+
+        self.assertEqual(release_expired(), 1)
+        self.assertEqual(get_available(self.item), 8)
+
+    def test_set_stock_keeps_reservations(self):
+        self.add_line(3)
+        reserve_order(self.order)
+        set_stock(self.item, 20, shards=2)
+
+        self.assertEqual(get_available(self.item), 20)
+        self.assertEqual(StockReservation.objects.filter(
+            order=self.order).aggregate(Sum('quantity'))['quantity__sum'], 3)
+
+        release_order(self.order)
+        self.assertEqual(get_available(self.item), 23)
+
+
+
+class CheckoutAddressTestCase(SeededTestCase):
+    def checkout(self, street_address):
+        return self.client.post(reverse('core:checkout'), {
+            'shipping_address': street_address,
+            'shipping_address2': '',
+            'shipping_country': 'US',
+            'shipping_zip': '2000',
+            'same_billing_address': 'on',
+            'payment_option': 'S',
+        })
+
+    def test_repeat_checkout_reuses_the_address(self):
+        self.fill_cart()
+        self.checkout('12 Elm st')
+        addresses = Address.objects.filter(user=self.user)
+        count = addresses.count()
+        order = Order.objects.get(user=self.user, ordered=False)
+
+        # case and whitespace do not make a new address
+        self.checkout('  12  ELM st ')
+        self.assertEqual(addresses.count(), count)
+        repeat = Order.objects.get(pk=order.pk)
+        self.assertEqual(repeat.shipping_address_id, order.shipping_address_id)
+        self.assertEqual(repeat.billing_address_id, order.billing_address_id)
+        self.assertEqual(repeat.shipping_address.street_address, '12 Elm st')
+
+
+
+class CouponFilterTestCase(TransactionTestCase):
+    """
+    A TransactionTestCase, the coupon version is bumped when the
+    transaction that changed a coupon commits.
+    """
+
+    def setUp(self):
+        cache.clear()
+        coupons._local_filter = (None, None)
+
+    def test_new_coupon_is_found(self):
+        self.assertIsNone(coupons.lookup_coupon('NEW10'))
+        Coupon.objects.create(code='NEW10', amount=10)
+        self.assertEqual(coupons.lookup_coupon('NEW10').amount, 10)
+
+    def test_deleted_coupon_is_not_found(self):
+        coupon = Coupon.objects.create(code='OLD10', amount=10)
+        self.assertIsNotNone(coupons.lookup_coupon('OLD10'))
+        coupon.delete()
+        self.assertIsNone(coupons.lookup_coupon('OLD10'))
+
+    def test_version_is_bumped_on_commit(self):
+        version = coupons.get_coupon_version()
+        with transaction.atomic():
+            Coupon.objects.create(code='NEW10', amount=10)
+            self.assertEqual(coupons.get_coupon_version(), version)
+        self.assertEqual(coupons.get_coupon_version(), version + 1)
+
+
+
+@override_settings(COUPON_ATTEMPT_LIMIT=3)
+class CouponThrottleTestCase(SeededTestCase):
+    def add_coupon(self, code):
+        response = self.client.post(reverse('core:add_coupon'),
+            {'code': code}, follow=True)
+        return [str(message) for message in response.context['messages']]
+
+    def test_failed_attempts_are_throttled(self):
+        self.fill_cart()
+        for code in ('WRONG1', 'WRONG2', 'WRONG3'):
+            self.assertIn('This coupon does not exist.', self.add_coupon(code))
+
+        # even a valid code is refused until the window passed
+        self.assertIn('Too many attempts. Please try again later.',
+            self.add_coupon('SAVE5'))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertIsNone(order.coupon_id)
+
+        cache.clear()
+        self.assertIn('Successfully added coupon.', self.add_coupon('SAVE5'))
+
+
+
+@override_settings(REFUND_RETRY_DELAY=0, REFUND_MAX_ATTEMPTS=3)
+class RefundTestCase(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        payment = Payment.objects.create(stripe_charge_id='ch_refund',
+            user=self.user, amount=10)
+        self.order = Order.objects.create(user=self.user,
+            ordered_date=timezone.now(), ordered=True, payment=payment,
+            refund_requested=True)
+        self.refund = Refund.objects.create(order=self.order,
+            reason='Wrong size', email='buyer@example.com', accepted=True)
+        self.provider = mock.Mock()
+
+    def process(self):
+        with mock.patch('core.refunds.get_payment_provider',
+                return_value=self.provider):
+            result = process_refunds()
+        self.refund.refresh_from_db()
+        self.order.refresh_from_db()
+        return result
+
+    def test_transient_errors_are_retried(self):
+        self.provider.refund.side_effect = [
+            stripe.error.APIConnectionError('down'),
+            {'id': 're_retried'},
+        ]
+        self.assertEqual(self.process(), (1, 0))
+
+        self.assertEqual(self.refund.status, 'R')
+        self.assertEqual(self.refund.stripe_refund_id, 're_retried')
+        self.assertEqual(self.refund.attempts, 2)
+        self.assertTrue(self.order.refund_granted)
+
+        # every attempt sends the same key, the provider refunds once
+        key = f'refund-{self.refund.pk}'
+        self.assertEqual(self.provider.refund.call_args_list, [
+            mock.call('ch_refund', idempotency_key=key),
+            mock.call('ch_refund', idempotency_key=key),
+        ])
+
+    def test_refund_fails_after_max_attempts(self):
+        self.provider.refund.side_effect = stripe.error.APIConnectionError('down')
+        self.assertEqual(self.process(), (0, 1))
+
+        self.assertEqual(self.provider.refund.call_count, 3)
+        self.assertEqual(self.refund.status, 'F')
+        self.assertIn('down', self.refund.last_error)
+        self.assertFalse(self.order.refund_granted)
+
+        # failed refunds are not picked up again
+        self.assertEqual(self.process(), (0, 0))
+
+    def test_final_errors_are_not_retried(self):
+        self.provider.refund.side_effect = stripe.error.InvalidRequestError(
+            'Charge already refunded', 'charge')
+        self.assertEqual(self.process(), (0, 1))
+        self.assertEqual(self.provider.refund.call_count, 1)
+        self.assertEqual(self.refund.status, 'F')
+
+    def test_admin_action_queues_the_refunds(self):
+        Refund.objects.filter(pk=self.refund.pk).update(accepted=False)
+        modeladmin = mock.Mock()
+        make_refund_accepted(modeladmin, None,
+            Order.objects.filter(pk=self.order.pk))
+
+        self.provider.refund.assert_not_called()
+        self.refund.refresh_from_db()
+        self.assertTrue(self.refund.accepted)
+        self.assertEqual(self.refund.status, 'P')
+        task_row = Task.objects.get(name='core.refunds.process_refunds_task')
+        self.assertEqual(json.loads(task_row.arguments)['args'],
+            [[self.refund.pk]])
+
+
+
+@override_settings(
+    TASK_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class QueuedEmailTestCase(TestCase):
+    def queue(self, message):
+        message.connection = mail.get_connection('core.mail.QueuedEmailBackend')
+        return message.send()
+
+    def test_attachments_and_alternatives_are_sent(self):
+        message = mail.EmailMultiAlternatives('Invoice', 'See attached.',
+            'shop@example.com', ['buyer@example.com'])
+        message.attach_alternative('<p>See attached.</p>', 'text/html')
+        message.attach('invoice.pdf', b'%PDF-1.4\x00\xff', 'application/pdf')
+        message.attach('notes.txt', 'Thank you', 'text/plain')
+        self.assertEqual(self.queue(message), 1)
+        self.assertEqual(mail.outbox, [])
+
+        task_row = Task.objects.get(name='core.mail.send_email')
+        arguments = json.loads(task_row.arguments)
+        send_email(*arguments['args'], **arguments['kwargs'])
+
+        sent, = mail.outbox
+        self.assertEqual(sent.subject, 'Invoice')
+        self.assertEqual(sent.alternatives, [('<p>See attached.</p>', 'text/html')])
+        self.assertEqual(sent.attachments, [
+            ('invoice.pdf', b'%PDF-1.4\x00\xff', 'application/pdf'),
+            ('notes.txt', 'Thank you', 'text/plain'),
+        ])
+
+    def test_mime_attachments_are_rejected(self):
+        message = mail.EmailMessage('Invoice', 'See attached.',
+            'shop@example.com', ['buyer@example.com'])
+        message.attach(MIMEText('Thank you'))
+        with self.assertRaises(ValueError):
+            self.queue(message)
+        self.assertFalse(Task.objects.exists())
+
+
+
+@tasks.task(max_attempts=3)
+def failing_task(value):
+    raise ValueError(f'failed {value}')
+
+
+@tasks.task
+def passing_task(value):
+    return value
+
+
+
+@override_settings(TASK_RETRY_DELAY=10, TASK_LOCK_TIMEOUT=60)
+class TaskQueueTestCase(TestCase):
+    def run_due(self):
+        # run() closes the connection of worker threads, not the test's
+        with mock.patch('core.tasks.connection'):
+            for task_row in tasks.claim(10):
+                tasks.run(task_row)
+
+    def test_task_runs_once(self):
+        task_row = passing_task.delay('a')
+        claimed = tasks.claim(10)
+        self.assertEqual([row.pk for row in claimed], [task_row.pk])
+        # a claimed task is not handed to another worker
+        self.assertEqual(tasks.claim(10), [])
+
+        with mock.patch('core.tasks.connection'):
+            tasks.run(claimed[0])
+        task_row.refresh_from_db()
+        self.assertEqual(task_row.status, 'D')
+        self.assertEqual(task_row.attempts, 1)
+
+    def test_failures_back_off_then_die(self):
+        task_row = failing_task.delay('a')
+        for attempts, delay in ((1, 10), (2, 20)):
+            start = timezone.now()
+            self.run_due()
+            task_row.refresh_from_db()
+            self.assertEqual(task_row.status, 'Q')
+            self.assertEqual(task_row.attempts, attempts)
+            self.assertIn('failed a', task_row.last_error)
+            self.assertGreaterEqual(task_row.run_at,
+                start + timedelta(seconds=delay))
+            self.assertLess(task_row.run_at,
+                timezone.now() + timedelta(seconds=delay + 5))
+
+            # not due before the delay passed
+            self.assertEqual(tasks.claim(10), [])
+            Task.objects.filter(pk=task_row.pk).update(run_at=timezone.now())
+
+        self.run_due()
+        task_row.refresh_from_db()
+        self.assertEqual(task_row.status, 'X')
+        self.assertEqual(task_row.attempts, 3)
+        self.assertEqual(task_row.locked_by, '')
+
+        # dead tasks are kept but never run again
+        Task.objects.filter(pk=task_row.pk).update(run_at=timezone.now())
+        self.assertEqual(tasks.claim(10), [])
+
+    def test_stale_tasks_are_requeued(self):
+        now = timezone.now()
+        stale = Task.objects.create(name='core.tests.passing_task',
+            arguments='{"args": ["a"], "kwargs": {}}', run_at=now,
+            status='R', locked_by='dead-worker',
+            locked_at=now - timedelta(seconds=120))
+        running = Task.objects.create(name='core.tests.passing_task',
+            arguments='{"args": ["b"], "kwargs": {}}', run_at=now,
+            status='R', locked_by='live-worker', locked_at=now)
+
+        self.assertEqual(tasks.requeue_stale(), 1)
+        stale.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual(stale.status, 'Q')
+        self.assertEqual(stale.locked_by, '')
+        self.assertIsNone(stale.locked_at)
+        self.assertEqual(running.status, 'R')
+
+        self.run_due()
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'D')
+
+
+
+class ImportUsersTestCase(TestCase):
+    def import_users(self, content, suffix):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_users', path, stdout=stdout, stderr=stderr)
+        return stderr.getvalue()
+
+    def test_jsonl_reports_bad_lines(self):
+        password = make_password('secret')
+        errors = self.import_users('\n'.join([
+            '{"username": "alice", "password": "%s", "addresses": '
+            '[{"address_type": "S", "street_address": "1 Road", '
+            '"country": "US", "zip": "1", "default": true}]}' % password,
+            '{"email": "nobody@example.com"}',
+            '{"username": "bob", "password": "plaintext"}',
+            '{"username": "carol"',
+            '{"username": "dave", "addresses": [{"street_address": "x"}]}',
+        ]), '.jsonl')
+
+        self.assertIn('line 2: username is missing', errors)
+        self.assertIn('line 3: password is not a Django password hash', errors)
+        self.assertIn('line 4: invalid json', errors)
+        self.assertIn('line 5: address_type must be S or B', errors)
+
+        self.assertEqual(list(User.objects.values_list('username', flat=True)),
+            ['alice'])
+        alice = User.objects.get(username='alice')
+        self.assertTrue(alice.check_password('secret'))
+        self.assertTrue(Address.objects.filter(user=alice, default=True).exists())
+
+    def test_csv_reports_bad_lines(self):
+        errors = self.import_users(
+            'username,password,email\n'
+            'alice,,alice@example.com\n'
+            ',,nobody@example.com\n'
+            'bob,plaintext,bob@example.com\n',
+            '.csv')
+
+        self.assertIn('line 3: username is missing', errors)
+        self.assertIn('line 4: password is not a Django password hash', errors)
+        alice = User.objects.get(username='alice')
+        self.assertFalse(alice.has_usable_password())
+        self.assertFalse(User.objects.filter(username='bob').exists())
+
+    def test_lengths_and_types(self):
+        address = '"addresses": [{"address_type": "S", "street_address": ' \
+            '"1 Road", "country": %s, "zip": "1"}]'
+        errors = self.import_users('\n'.join([
+            '{"username": "alice", "email": "alice@example.com", %s}'
+                % (address % '"US"'),
+            '{"username": "bob", "password": 12345}',
+            '{"username": "carol", "email": "%s@example.com"}' % ('c' * 260),
+            '{"username": "dave", "first_name": ["Dave"]}',
+            '{"username": "erin", %s}' % (address % '"USA"'),
+            '{"username": "frank", "addresses": {"street_address": "x"}}',
+            '{"username": "grace", "last_name": "Hopper"}',
+        ]), '.jsonl')
+
+        self.assertIn('line 2: password is not a Django password hash', errors)
+        self.assertIn('line 3: email is longer than 254 characters', errors)
+        self.assertIn('line 4: first_name is not a string', errors)
+        self.assertIn('line 5: country is longer than 2 characters', errors)
+        self.assertIn('line 6: addresses is not a list', errors)
+
+        # the bad lines do not fail the batch of the good ones
+        self.assertEqual(
+            sorted(User.objects.values_list('username', flat=True)),
+            ['alice', 'grace'])
+
+
+
+class OrderAdminTestCase(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create_superuser('admin',
+            'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        self.url = reverse('admin:core_order_changelist')
+
+    def add_orders(self, count):
+        shipping = Address.objects.filter(user=self.user, address_type='S').first()
+        billing = Address.objects.filter(user=self.user, address_type='B').first()
+        coupon = Coupon.objects.get(code='SAVE5')
+        for i in range(count):
+            payment = Payment.objects.create(stripe_charge_id=f'ch_{i}',
+                user=self.user, amount=10)
+            Order.objects.create(user=self.user, ordered_date=timezone.now(),
+                ordered=True, shipping_address=shipping, billing_address=billing,
+                payment=payment, coupon=coupon)
+
+    def count_queries(self, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, data or {})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.add_orders(2)
+        few = self.count_queries()
+        self.add_orders(20)
+        self.assertEqual(self.count_queries(), few)
+        self.assertLessEqual(few, 10)
+
+    def test_search_uses_indexes(self):
+        self.add_orders(2)
+        for term, lookup in (('a' * 24, '"ref_code" ='),
+                ('buy', '"username" >=')):
+            recorder = QueryRecorder()
+            with connection.execute_wrapper(recorder):
+                response = self.client.get(self.url, {'q': term})
+            self.assertEqual(response.status_code, 200)
+
+            searches = [(sql, params) for sql, params in recorder.queries
+                if lookup in sql]
+            self.assertTrue(searches, term)
+            for sql, params in searches:
+                self.assertNotIn('LIKE', sql)
+                for detail in get_query_plan(sql, params):
+                    self.assertFalse(is_full_table_scan(detail),
+                        f'{term}: {detail}\n{sql}')
+
+
+
+class ExportOrdersTestCase(SeededTestCase):
+    def export(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('export_orders', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_csv(self):
+        output, errors = self.export('--format', 'csv', '--ordered')
+        row, = csv.DictReader(StringIO(output))
+        self.assertEqual(row['ref_code'], 'a' * 24)
+        self.assertEqual(row['username'], 'other')
+        self.assertEqual(row['item_slug'], 'item-1')
+        self.assertEqual(row['quantity'], '1')
+
+        order = Order.objects.get(ref_code='a' * 24)
+        self.assertIn(f'--after-id {order.pk}', errors)
+
+    def test_ndjson_resumes(self):
+        for i in range(3):
+            Order.objects.create(user=self.user, ordered_date=timezone.now())
+        ids = list(Order.objects.order_by('start_date', 'id')
+            .values_list('pk', flat=True))
+
+        output, errors = self.export('--format', 'ndjson', '--chunk-size', '2')
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([record['order_id'] for record in records], ids)
+        self.assertEqual(records[0]['items'][0]['slug'], 'item-1')
+
+        # resume after the second order
+        second = records[1]
+        output, errors = self.export('--format', 'ndjson',
+            '--since', second['start_date'], '--after-id', str(second['order_id']))
+        self.assertEqual([json.loads(line)['order_id']
+            for line in output.splitlines()], ids[2:])
+
+    def test_archived_orders_are_exported(self):
+        self.fill_cart()
+        order = Order.objects.get(user=self.user, ordered=False)
+        order.update_totals()
+        finalize_order(order, {'id': 'ch_export'}, order.total_cents)
+        self.assertEqual(archive_orders(timezone.now()), 2)
+
+        # a live order started after the archived ones
+        live = Order.objects.create(user=self.user,
+            ordered_date=timezone.now())
+
+        output, errors = self.export('--format', 'ndjson')
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([record['order_id'] for record in records],
+            list(ArchivedOrder.objects.order_by('start_date', 'id')
+                .values_list('pk', flat=True)) + [live.pk])
+        archived = records[1]
+        self.assertEqual(archived['payment']['stripe_charge_id'], 'ch_export')
+        self.assertEqual(archived['total'], 28)
+        self.assertEqual(sorted(item['slug'] for item in archived['items']),
+            ['item-0', 'item-1', 'item-2'])
+
+        # resumed in the middle of the archived orders
+        output, errors = self.export('--format', 'csv', '--since',
+            archived['start_date'], '--after-id', str(archived['order_id']))
+        self.assertEqual([row['order_id']
+            for row in csv.DictReader(StringIO(output))], [str(live.pk)])
+
+    def test_dates_are_aware(self):
+        self.assertTrue(timezone.is_aware(parse_date('2020-01-01')))
+        self.assertTrue(timezone.is_aware(parse_date('2020-01-01T10:00:00')))
+        self.assertEqual(parse_date('2020-01-01T10:00:00+02:00').hour, 10)
+
+        output, errors = self.export('--format', 'ndjson',
+            '--until', '2000-01-01')
+        self.assertEqual(output, '')
+        self.assertEqual(errors, '')
@@ -0,0 +1,97 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .caching import bump_catalog_version
+from .tasks import task
+
+
+def get_thumbnail_name(name, width, ext=None):
+    """
+    Stable name of a derivative, stored next to the original:
+    products/shirt.jpg -> products/shirt_320w.jpg / products/shirt_320w.webp
+    """
+    stem, original_ext = os.path.splitext(name)
+    return f'{stem}_{width}w{ext or original_ext}'
+
+
+def get_thumbnail_urls(name, widths, ext=None):
+    # widths recorded by generate_thumbnails_task, storage is not asked
+    return [
+        (width, default_storage.url(get_thumbnail_name(name, width, ext)))
+        for width in widths
+    ]
+
+
+def save_image(image, name, format):
+    if default_storage.exists(name):
+        default_storage.delete(name)
+
+    buffer = BytesIO()
+    if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(buffer, format=format, quality=settings.THUMBNAIL_QUALITY)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def generate_thumbnails(name):
+    """
+    Create the missing derivatives of an image, returns the widths it has
+    derivatives for, smallest first.
+    """
+    widths = [
+        width for width in settings.THUMBNAIL_WIDTHS
+        if default_storage.exists(get_thumbnail_name(name, width, '.webp'))
+    ]
+    missing = [width for width in settings.THUMBNAIL_WIDTHS
+        if width not in widths]
+    if not missing:
+        return sorted(widths)
+
+    with default_storage.open(name) as f:
+        original = Image.open(f)
+        original.load()
+
+    format = original.format or 'JPEG'
+    for width in missing:
+        # never upscale
+        if width >= original.width:
+            continue
+
+        height = round(original.height * width / original.width)
+        image = original.resize((width, height), Image.LANCZOS)
+        save_image(image, get_thumbnail_name(name, width), format)
+        save_image(image, get_thumbnail_name(name, width, '.webp'), 'WEBP')
+        widths.append(width)
+    return sorted(widths)
+
+
+@task
+def generate_thumbnails_task(name):
+    # failures are retried by the task worker
+    from .models import Item
+
+    widths = ','.join(str(width) for width in generate_thumbnails(name))
+
+    # an update, so item_image_receiver does not run again
+    updated = Item.objects.filter(image=name).exclude(thumbnail_source=name,
+        thumbnail_widths=widths).update(thumbnail_source=name,
+            thumbnail_widths=widths)
+
+    # cached listings were rendered with the original image
+    if updated:
+        bump_catalog_version()
+
+
+def item_image_receiver(sender, instance, *args, **kwargs):
+    if not instance.image:
+        return
+    # saves that leave the image alone find its derivatives recorded
+    if instance.thumbnail_source == instance.image.name and \
+            instance.thumbnail_widths:
+        return
+    generate_thumbnails_task.delay(instance.image.name)
@@ -1,44 +1,70 @@
 from django.urls import path
 from . import views
+from .querybudget import query_budget
 
 
 app_name = 'core'
 
+# the second argument of query_budget is the number of queries a request
+# may run, or a dict of them per method, enforced by
+# core.querybudget.QueryBudgetMiddleware and the tests. Budgets are the
+# measured count plus a small margin, keep them tight. Pages with the
+# navbar are measured with a cold cart count cache, and pages that show
+# totals with a price change to write.
+
 urlpatterns = [
     # item list
-    path('', views.ItemListView.as_view(), name='product_list'),
+    path('', query_budget(views.ItemListView.as_view(), 5),
+        name='product_list'),
 
     # item detail
-    path('product/<slug>/', views.ItemDetailView.as_view(), name='product'),
+    path('product/<slug>/', query_budget(views.ItemDetailView.as_view(), 4),
+        name='product'),
 
     # add item to cart
-    path('add-to-cart/<slug>/', views.add_to_cart, name='add_to_cart'),
+    path('add-to-cart/<slug>/', query_budget(views.add_to_cart, 14),
+        name='add_to_cart'),
 
     # remove item from cart
-    path('remove-from-cart/<slug>/', views.remove_from_cart,
+    path('remove-from-cart/<slug>/',
+        query_budget(views.remove_from_cart, 13),
         name='remove_from_cart'),
 
     # order summary
-    path('order-summary/', views.OrderSummaryView.as_view(),
+    path('order-summary/', query_budget(views.OrderSummaryView.as_view(), 7),
         name='order_summary'),
 
     # remove single item from cart
     path('remove-single-item-from-cart/<slug>/',
-        views.remove_single_item_from_cart,
+        query_budget(views.remove_single_item_from_cart, 13),
         name='remove_single_item_from_cart'),
 
     # checkout
-    path('checkout/', views.CheckoutView.as_view(), name='checkout'),
+    path('checkout/',
+        query_budget(views.CheckoutView.as_view(), {'GET': 8, 'POST': 18}),
+        name='checkout'),
 
     # payment
-    path('payment/<payment_option>/', views.PaymentView.as_view(),
+    path('payment/<payment_option>/',
+        query_budget(views.PaymentView.as_view(), {'GET': 9, 'POST': 23}),
         name='payment'),
 
     # add coupon
-    path('add_coupon/', views.AddCoupon.as_view(), name='add_coupon'),
+    path('add_coupon/', query_budget(views.AddCoupon.as_view(), 9),
+        name='add_coupon'),
+
 
+    # cart json api
+    path('api/cart/add/<slug>/', query_budget(views.api_add_to_cart, 14),
+        name='api_add_to_cart'),
+    path('api/cart/remove/<slug>/',
+        query_budget(views.api_remove_from_cart, 13),
+        name='api_remove_from_cart'),
+    path('api/cart/remove-single/<slug>/',
+        query_budget(views.api_remove_single_item_from_cart, 13),
+        name='api_remove_single_item_from_cart'),
 
     # request refund
-    path('request-refund/', views.RequestRefundView.as_view(),
+    path('request-refund/', query_budget(views.RequestRefundView.as_view(), 8),
         name='request_refund'),
 ]
@@ -1,23 +1,52 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.views.generic import ListView, DetailView, View
-from django.utils import timezone
+from django.views.decorators.http import require_POST
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.utils.decorators import method_decorator
+from django.http import JsonResponse
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.conf import settings
-from django.db.models import Q
+from django.db import transaction
 
 
 from .models import (
     Order,
-    OrderItem,
     Item,
-    Address,
-    Payment,
-    Coupon,
     Refund,
     UserProfile,
 )
+from .search import search_items
+from .pagination import CursorPaginator
+from .caching import (
+    get_listing_cache_key,
+    get_cached_listing,
+    set_cached_listing,
+    set_cart_item_count,
+)
+from . import cart
+from .replicas import use_primary
+from .payments import (
+    get_default_card,
+    invalidate_cards,
+    get_payment_provider,
+    call_provider,
+    PaymentBusy,
+    PaymentTimeout,
+    get_charge_idempotency_key,
+)
+from .orders import (
+    finalize_order,
+    get_default_address,
+    get_or_create_address,
+    next_charge_attempt,
+    reconcile_later,
+)
+from .inventory import reserve_order, OutOfStock
+from .coupons import lookup_coupon, is_throttled, record_failed_attempt
 from .forms import (
     CheckoutForm,
     CouponForm,
@@ -26,14 +55,6 @@ from .forms import (
 )
 
 import stripe
-stripe.api_key = settings.API_SECRET_KEY
-
-import string
-import random
-
-
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=24))
 
 
 
@@ -52,11 +73,57 @@ class ItemListView(ListView):
             queryset = queryset.filter(category=category.upper())
 
         if q:
-            query = (Q(title__icontains=q) | Q(description__icontains=q))
-            queryset = queryset.filter(query)
+            # ranked full-text search, see core.search
+            queryset = search_items(queryset, q)
 
         return queryset
 
+    def use_cursor_pagination(self):
+        # search results are ordered by rank, not by (created_at, id)
+        if self.request.GET.get('q'):
+            return False
+        return settings.CATALOG_CURSOR_PAGINATION or \
+            'cursor' in self.request.GET
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_cursor_pagination():
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = CursorPaginator(queryset, page_size)
+        page = paginator.page(self.request.GET.get('cursor'))
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cursor_pagination'] = self.use_cursor_pagination()
+        return context
+
+    def get(self, request, *args, **kwargs):
+        if self.use_cursor_pagination():
+            page = 'cursor:' + request.GET.get('cursor', '')
+        else:
+            page = request.GET.get('page', '1')
+
+        key = get_listing_cache_key(request.GET.get('category'),
+            request.GET.get('q'), page)
+        listing = get_cached_listing(key)
+
+        if listing is None:
+            # cached for long under the current catalog version, so it is
+            # rendered from default: a replica that lags behind would miss
+            # the change that bumped the version, and search ranks the ids
+            # of the fts index on default. The uncached item pages read
+            # the replicas
+            with use_primary():
+                self.object_list = self.get_queryset()
+                context = self.get_context_data()
+                listing = render_to_string('item_list.html', context, request)
+            set_cached_listing(key, listing)
+
+        return render(request, self.template_name, {
+            'listing': mark_safe(listing),
+        })
+
 
 
 class ItemDetailView(DetailView):
@@ -67,106 +134,120 @@ class ItemDetailView(DetailView):
 
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(item=item,
-        user=request.user,
-        ordered=False)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item quantity was updated.")
-            return redirect('core:order_summary')
-        else:
-            messages.info(request, "This item was added to your cart.")
-            order_item.quantity = 1
-            order_item.save()
-            order.items.add(order_item)
-            return redirect('core:order_summary')
+    try:
+        result = cart.add_item(request.user, item)
+    except cart.CartBusy:
+        messages.warning(request, "Your cart is being updated. Please try again.")
+        return redirect('core:order_summary')
+
+    if result.status == 'updated':
+        messages.info(request, "This item quantity was updated.")
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user,
-            ordered_date=ordered_date)
-        order.items.add(order_item)
         messages.info(request, "This item was added to your cart.")
-        return redirect('core:order_summary')
+    return redirect('core:order_summary')
 
 
 
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-
-    if order_qs.exists():
-        order = order_qs[0]
-
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            order.items.remove(order_item)
-            messages.info(request, "This item was removed from your cart.")
-            return redirect('core:product', slug=slug)
-        else:
-            messages.info(request, "This item was not in your cart.")
-            return redirect('core:product', slug=slug)
+    try:
+        result = cart.remove_item(request.user, item)
+    except cart.CartBusy:
+        messages.warning(request, "Your cart is being updated. Please try again.")
+        return redirect('core:product', slug=slug)
+
+    if result.status == 'removed':
+        messages.info(request, "This item was removed from your cart.")
+    elif result.status == 'not_in_cart':
+        messages.info(request, "This item was not in your cart.")
     else:
         messages.info(request, "You do not have an active order.")
-        return redirect('core:product', slug=slug)
+    return redirect('core:product', slug=slug)
 
 
 
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-
-    if order_qs.exists():
-        order = order_qs[0]
-
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            if order_item.quantity == 1:
-                order.items.remove(order_item)
-                messages.info(request, "This item was removed from your cart.")
-                return redirect('core:order_summary')
-            elif order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-                messages.info(request, "This item quantity was updated.")
-                return redirect('core:order_summary')
-            else:
-                messages.info(request, "Operation failed.")
-                return redirect('core:order_summary')
-        else:
-            messages.info(request, "This item was not in your cart.")
-            return redirect('core:product', slug=slug)
+    try:
+        result = cart.remove_single_item(request.user, item)
+    except cart.CartBusy:
+        messages.warning(request, "Your cart is being updated. Please try again.")
+        return redirect('core:product', slug=slug)
+
+    if result.status == 'removed':
+        messages.info(request, "This item was removed from your cart.")
+        return redirect('core:order_summary')
+    elif result.status == 'updated':
+        messages.info(request, "This item quantity was updated.")
+        return redirect('core:order_summary')
+    elif result.status == 'not_in_cart':
+        messages.info(request, "This item was not in your cart.")
+        return redirect('core:product', slug=slug)
     else:
         messages.info(request, "You do not have an active order.")
         return redirect('core:product', slug=slug)
 
 
 
+def cart_update_response(result):
+    order_item = result.order_item
+    line = None
+    if order_item is not None and result.status != 'removed':
+        line = {
+            'slug': order_item.item.slug,
+            'title': order_item.item.title,
+            'quantity': order_item.quantity,
+            'final_price': order_item.get_final_price(),
+        }
+
+    order = result.order
+    return JsonResponse({
+        'status': result.status,
+        'line': line,
+        'count': result.count,
+        'subtotal': order.subtotal_cents / 100 if order else 0,
+        'total': order.total_cents / 100 if order else 0,
+    })
+
+
+def cart_api_view(mutation):
+    """
+    JSON version of a cart view, the response carries the updated line,
+    cart count and totals so the page can be updated in place.
+    """
+    @require_POST
+    def view(request, slug):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required.'},
+                status=401)
+
+        item = get_object_or_404(Item, slug=slug)
+        try:
+            result = mutation(request.user, item)
+        except cart.CartBusy:
+            return JsonResponse({'error': 'The cart is being updated.'},
+                status=409)
+        return cart_update_response(result)
+    return view
+
+
+api_add_to_cart = cart_api_view(cart.add_item)
+api_remove_from_cart = cart_api_view(cart.remove_item)
+api_remove_single_item_from_cart = cart_api_view(cart.remove_single_item)
+
+
+
 class OrderSummaryView(LoginRequiredMixin, View):
     template_name = 'order_summary.html'
 
+    # the quantity buttons post to the cart api with this cookie
+    @method_decorator(ensure_csrf_cookie)
     def get(self, request, *args, **kwargs):
-        try:
-            order = Order.objects.get(user=request.user, ordered=False)
-            return render(request, 'order_summary.html', {'object': order})
-        except ObjectDoesNotExist:
+        order = cart.get_cart(request.user)
+        if order is None:
             messages.error(request, "You do not have an active order")
             return redirect('/')
+        return render(request, 'order_summary.html', {'object': order})
 
 
 
@@ -174,7 +255,9 @@ class CheckoutView(View):
     def get(self, request, *args, **kwargs):
         try:
             form = CheckoutForm()
-            order = Order.objects.get(user=request.user, ordered=False)
+            order = cart.get_order(request.user, with_items=True)
+            # the prices may have changed since the cart was filled
+            order.refresh_totals()
             coupon_form = CouponForm()
 
             context = {
@@ -184,23 +267,15 @@ class CheckoutView(View):
                 'DISPLAY_COUPON_FORM': True,
             }
 
-            shipping_address_qs = Address.objects.filter(
-                user=request.user,
-                address_type='S',
-                default=True
-            )
-            if shipping_address_qs.exists():
+            default_shipping_address = get_default_address(request.user, 'S')
+            if default_shipping_address:
                 context.update({
-                    'default_shipping_address': shipping_address_qs[0]
+                    'default_shipping_address': default_shipping_address
                 })
 
-            billing_address_qs = Address.objects.filter(
-                user=request.user,
-                address_type='B',
-                default=True
-            )
-            if billing_address_qs.exists():
-                context.update({'default_billing_address': billing_address_qs[0]})
+            default_billing_address = get_default_address(request.user, 'B')
+            if default_billing_address:
+                context.update({'default_billing_address': default_billing_address})
 
             return render(request, 'checkout.html', context)
         except ObjectDoesNotExist:
@@ -212,137 +287,111 @@ class CheckoutView(View):
         form = CheckoutForm(request.POST or None)
 
         try:
-            order = Order.objects.get(user=request.user, ordered=False)
-
-            if form.is_valid():
-                cd = form.cleaned_data
-
-                # process shipping fields
-                use_default_shipping = cd.get('use_default_shipping')
-
-                if use_default_shipping:
-                    address_qs = Address.objects.filter(
-                        user=request.user,
-                        address_type='S',
-                        default=True
-                    )
-
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(request,
-                            "No default shipping address available")
-                        return redirect("core:checkout")
-                else:
-                    shipping_address1 = cd.get('shipping_address')
-                    shipping_address2 = cd.get('shipping_address2')
-                    shipping_country = cd.get('shipping_country')
-                    shipping_zip = cd.get('shipping_zip')
-
-                    # check if fields are not empty
-                    if all([shipping_address1, shipping_country, shipping_zip]):
-                        shipping_address = Address.objects.create(
-                            user=request.user,
-                            street_address=shipping_address1,
-                            apartment_address=shipping_address2,
-                            country=shipping_country,
-                            zip=shipping_zip,
-                            address_type='S'
-                        )
-
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        set_default_shipping = cd.get('set_default_shipping')
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-
-                    else:
-                        messages.info(request,
-                            "Please fill in the required shipping address fields")
-
-                # process billing fields
-                use_default_billing = cd.get('use_default_billing')
-                same_billing_address = cd.get('same_billing_address')
+            order = cart.get_order(request.user)
+        except ObjectDoesNotExist:
+            messages.warning(request, "You do not have an active order")
+            return redirect("core:order_summary")
+
+        if not form.is_valid():
+            messages.warning(request, 'Invalid form data')
+            return redirect('core:checkout')
+
+        cd = form.cleaned_data
+
+        # process shipping fields
+        if cd.get('use_default_shipping'):
+            shipping_address = get_default_address(request.user, 'S')
+            if shipping_address is None:
+                messages.info(request,
+                    "No default shipping address available")
+                return redirect("core:checkout")
+            shipping_fields = None
+        else:
+            shipping_fields = [
+                cd.get('shipping_address'),
+                cd.get('shipping_address2'),
+                cd.get('shipping_country'),
+                cd.get('shipping_zip'),
+            ]
+
+            # check if fields are not empty
+            if not all([shipping_fields[0], shipping_fields[2],
+                    shipping_fields[3]]):
+                messages.info(request,
+                    "Please fill in the required shipping address fields")
+                return redirect("core:checkout")
+
+        # process billing fields
+        same_billing_address = cd.get('same_billing_address')
+
+        if same_billing_address:
+            billing_fields = None
+        elif cd.get('use_default_billing'):
+            billing_address = get_default_address(request.user, 'B')
+            if billing_address is None:
+                messages.info(request,
+                    "No default billing address available")
+                return redirect("core:checkout")
+            billing_fields = None
+        else:
+            billing_fields = [
+                cd.get('billing_address'),
+                cd.get('billing_address2'),
+                cd.get('billing_country'),
+                cd.get('billing_zip'),
+            ]
+
+            if not all([billing_fields[0], billing_fields[2],
+                    billing_fields[3]]):
+                messages.info(request,
+                    "Please fill in the required billing address fields")
+                return redirect("core:checkout")
+
+        # all checkout writes in one transaction, with a single order save
+        try:
+            with transaction.atomic():
+                if shipping_fields:
+                    shipping_address = get_or_create_address(request.user,
+                        'S', *shipping_fields,
+                        default=cd.get('set_default_shipping'))
 
                 if same_billing_address:
-                    billing_address = shipping_address
-                    billing_address.pk = None
-                    billing_address.save()
-                    billing_address.address_type = 'B'
-                    billing_address.save()
-                    order.billing_address = billing_address
-                    order.save()
-                elif use_default_billing:                    
-                    address_qs = Address.objects.filter(
-                        user=request.user,
-                        address_type='B',
-                        default=True
-                    )
-
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(request,
-                            "No default billing address available")
-                        return redirect("core:checkout")
-                else:
-                    billing_address1 = cd.get('billing_address')
-                    billing_address2 = cd.get('billing_address2')
-                    billing_country = cd.get('billing_country')
-                    billing_zip = cd.get('billing_zip')
-
-                    if all([billing_address1, billing_country, billing_zip]):
-
-                        billing_address = Address.objects.create(
-                            user=request.user,
-                            street_address=billing_address1,
-                            apartment_address=billing_address2,
-                            country=billing_country,
-                            zip=billing_zip,
-                            address_type='B'
-                        )
-
-                        order.billing_address = billing_address
-                        order.save()
-
-                        set_default_billing = cd.get('set_default_billing')
-
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
-
-                    else:
-                        messages.info(request,
-                            "Please fill in the required billing address fields")
+                    billing_address = get_or_create_address(request.user,
+                        'B', shipping_address.street_address,
+                        shipping_address.apartment_address,
+                        shipping_address.country, shipping_address.zip)
+                elif billing_fields:
+                    billing_address = get_or_create_address(request.user,
+                        'B', *billing_fields,
+                        default=cd.get('set_default_billing'))
+
+                order.shipping_address = shipping_address
+                order.billing_address = billing_address
+                order.save(update_fields=['shipping_address', 'billing_address'])
+
+                # hold the stock while the user pays
+                reserve_order(order)
+        except OutOfStock as e:
+            messages.warning(request, f'Sorry, "{e.item}" is out of stock.')
+            return redirect('core:order_summary')
 
-                        
-                payment_option = cd.get('payment_option')
+        payment_option = cd.get('payment_option')
 
-                if payment_option == 'S':
-                    return redirect('core:payment', payment_option='stripe')
-                elif payment_option == 'P':
-                    return redirect('core:payment', payment_option='paypal')
-                else:
-                    messages.warning(request, 'Invalid payment option selected')
-                    return redirect('core:checkout')
-            else:
-                messages.warning(request, 'Invalid form data')
-                return redirect('core:checkout')
-        except ObjectDoesNotExist:
-            messages.warning(request, "You do not have an active order")
-            return redirect("core:order-summary")
+        if payment_option == 'S':
+            return redirect('core:payment', payment_option='stripe')
+        elif payment_option == 'P':
+            return redirect('core:payment', payment_option='paypal')
+        else:
+            messages.warning(request, 'Invalid payment option selected')
+            return redirect('core:checkout')
 
 
 
 class PaymentView(View):
     def get(self, request, *args, **kwargs):
-        order = Order.objects.get(user=request.user, ordered=False)
+        order = cart.get_order(request.user, with_items=True)
+        # the amount shown is the amount post charges
+        order.refresh_totals()
 
         if order.billing_address:
             context = {
@@ -352,18 +401,12 @@ class PaymentView(View):
 
             userprofile = request.user.userprofile
             if userprofile.one_click_purchasing:
-                # fetch the users card list
-                cards = stripe.Customer.list_sources(
-                    userprofile.stripe_customer_id,
-                    limit=3,
-                    object='card'
-                )
-                
-                card_list = cards['data']
-                if len(card_list) > 0:
+                # the users default card, cached and bounded by a timeout
+                card = get_default_card(userprofile.stripe_customer_id)
+                if card:
                     # update the context with the default card
                     context.update({
-                        'card': card_list[0]
+                        'card': card
                     })
 
             return render(request, 'payment.html', context)
@@ -373,7 +416,13 @@ class PaymentView(View):
 
 
     def post(self, request, *args, **kwargs):
-        order = Order.objects.get(user=request.user, ordered=False)
+        try:
+            order = cart.get_order(request.user)
+        except ObjectDoesNotExist:
+            # e.g. a double submit whose first request already paid
+            messages.info(request, "You do not have an active order")
+            return redirect('core:product_list')
+
         form = PaymentForm(request.POST)
         userprofile = UserProfile.objects.get(user=request.user)
 
@@ -382,64 +431,89 @@ class PaymentView(View):
             save = request.POST.get('save')
             use_default = request.POST.get('use_default')
 
-            if save:
-                # allow to fetch cards
-                if not userprofile.stripe_customer_id:
-                    customer = stripe.Customer.create(
-                        email=request.user.email,
-                        source=token
-                    )
-
-                    userprofile.stripe_customer_id = customer['id']
-                    userprofile.one_click_purchasing = True
-                    userprofile.save()
-                else:
-                    stripe.Customer.create_source(
-                        userprofile.stripe_customer_id,
-                        source=token
-                    )
+            provider = get_payment_provider()
+
+            # recompute from the current prices before charging
+            order.update_totals()
+            amount = order.total_cents
 
-            amount = int(order.get_total() * 100) # cents
+            # renew the reservation, it may have expired or the cart changed
+            try:
+                reserve_order(order)
+            except OutOfStock as e:
+                messages.warning(request, f'Sorry, "{e.item}" is out of stock. You were not charged.')
+                return redirect('core:order_summary')
 
+            # set once the charge is sent, a timeout after that may still
+            # have charged the card
+            charge_kwargs = None
             try:
+                if save:
+                    # allow to fetch cards
+                    if not userprofile.stripe_customer_id:
+                        customer = call_provider(provider.create_customer,
+                            email=request.user.email,
+                            source=token
+                        )
+
+                        userprofile.stripe_customer_id = customer['id']
+                        userprofile.one_click_purchasing = True
+                        userprofile.save()
+                        invalidate_cards(userprofile.stripe_customer_id)
+                    else:
+                        call_provider(provider.create_source,
+                            userprofile.stripe_customer_id,
+                            source=token
+                        )
+                        invalidate_cards(userprofile.stripe_customer_id)
 
-                # Use Stripe's library to make requests
+                idempotency_key = get_charge_idempotency_key(order, amount)
                 if use_default:
-                    charge = stripe.Charge.create(
-                        amount=amount, # cents
-                        currency='usd',
-                        customer=userprofile.stripe_customer_id
-                    )
+                    charge_kwargs = {
+                        'customer': userprofile.stripe_customer_id,
+                        'idempotency_key': idempotency_key,
+                    }
                 else:
-                    charge = stripe.Charge.create(
-                        amount=amount, # cents
-                        currency='usd',
-                        source=token
-                    )
-
-                # create the payment
-                payment = Payment.objects.create(
-                    stripe_charge_id=charge['id'],
-                    user=request.user,
-                    amount=order.get_total()
+                    charge_kwargs = {
+                        'source': token,
+                        'idempotency_key': idempotency_key,
+                    }
+                charge = call_provider(provider.charge,
+                    amount, # cents
+                    **charge_kwargs
                 )
 
-                order.ordered = True
-                order.payment = payment
-                order.ref_code = create_ref_code()
-                order.save()
+                # payment, order and order items in one transaction
+                finalize_order(order, charge, amount)
 
-                order_items = order.items.all()
-                order_items.update(ordered=True)
-                for item in order_items:
-                    item.save()
+                # the cart is empty now
+                cart.clear(request.user)
+                set_cart_item_count(request.user, 0)
 
                 messages.success(request, 'Your order was successful!')
                 return redirect('core:product_list')
 
+            except PaymentBusy:
+                # every provider slot of this process is taken
+                messages.warning(request, "We are processing many payments right now. You were not charged. Please try again.")
+                return redirect('core:product_list')
+
+            except PaymentTimeout:
+                if charge_kwargs is None:
+                    messages.warning(request, "The payment provider is not responding. You were not charged. Please try again.")
+                    return redirect('core:product_list')
+
+                # the charge may still land, the task worker settles it
+                # with the same idempotency key
+                reconcile_later(order, amount, **charge_kwargs)
+                messages.warning(request, "Your payment is taking longer than usual and is still being processed. Please do not pay again, you will receive a receipt by email once it is complete.")
+                return redirect('core:product_list')
+
             except stripe.error.CardError as e:
                 # Since it's a decline, stripe.error.CardError will be caught
                 messages.warning(request, e.error.message)
+                # the key replays the decline, paying again is a new attempt
+                next_charge_attempt(order)
                 return redirect('core:product_list')
 
             except stripe.error.RateLimitError as e:
@@ -474,12 +548,15 @@ class PaymentView(View):
 
 
 def get_coupon(request, code):
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except ObjectDoesNotExist:
+    if is_throttled(request):
+        messages.warning(request, "Too many attempts. Please try again later.")
+        return None
+
+    coupon = lookup_coupon(code)
+    if coupon is None:
+        record_failed_attempt(request)
         messages.info(request, "This coupon does not exist.")
-        return redirect('core:checkout')
+    return coupon
 
 
 
@@ -489,10 +566,14 @@ class AddCoupon(View):
         if form.is_valid():
             try:
                 code = form.cleaned_data.get('code')
-                order = Order.objects.get(user=request.user, ordered=False)
+                order = cart.get_order(request.user)
                 coupon = get_coupon(request, code)
+                if coupon is None:
+                    return redirect('core:checkout')
+
                 order.coupon = coupon
-                order.save()
+                order.save(update_fields=['coupon'])
+                order.update_totals()
                 messages.success(request, "Successfully added coupon.")
                 return redirect('core:checkout')
             except ObjectDoesNotExist:
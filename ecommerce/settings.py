@@ -61,6 +61,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.querybudget.QueryBudgetMiddleware',
+    'core.replicas.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -69,6 +71,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# query counting per request, budgets are declared in core/urls.py
+QUERY_BUDGET_ENABLED = DEBUG
+QUERY_BUDGET_RAISE = False
+QUERY_BUDGET_REPEAT_LIMIT = 5
+
 ROOT_URLCONF = 'ecommerce.urls'
 
 TEMPLATES = [
@@ -100,6 +107,35 @@ DATABASES = {
     }
 }
 
+# read replicas of default, catalog reads are sent to them by
+# core.replicas.ReplicaRouter. In settings.json, e.g. to try it locally
+# with a second sqlite file kept up to date by the sync_replicas command:
+# "DATABASE_REPLICAS": {"replica": {"ENGINE": "django.db.backends.sqlite3",
+#                                   "NAME": "replica.sqlite3"}}
+for alias, config in settings.get('DATABASE_REPLICAS', {}).items():
+    # tests read the replicas through the default test database
+    DATABASES[alias] = dict(config, TEST={'MIRROR': 'default'})
+DATABASE_REPLICAS = list(settings.get('DATABASE_REPLICAS', {}))
+
+DATABASE_ROUTERS = ['core.replicas.ReplicaRouter']
+
+# models read from the replicas, and how long a client reads everything
+# from default after writing, so it sees its own changes
+REPLICA_MODELS = ['core.item']
+REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# use a shared backend (memcached, redis) when running several processes,
+# otherwise each process keeps its own catalog version
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -147,6 +183,10 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "assets"),
 ]
 
+# Item image derivatives, generated by the task worker
+THUMBNAIL_WIDTHS = [320, 640, 1024]
+THUMBNAIL_QUALITY = 85
+
 
 
 AUTHENTICATION_BACKENDS = (
@@ -166,9 +206,121 @@ LOGIN_REDIRECT_URL = '/'
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 
+# Search
+# sqlite fts5 index, use 'core.search.DatabaseSearchBackend' on databases
+# without the index table
+SEARCH_BACKEND = 'core.search.SqliteFTSBackend'
+SEARCH_MAX_RESULTS = 1000
+
+
+# Catalog
+# keyset pagination for the item list, clients can also opt in per
+# request with ?cursor=
+CATALOG_CURSOR_PAGINATION = False
+
+# rendered item listings, invalidated by the catalog version
+LISTING_CACHE_TIMEOUT = 60 * 60
+# share of the listing lookups counted by listing_cache_stats
+LISTING_STATS_SAMPLE_RATE = 0.01
+
+# cart badge of the navbar, kept up to date by the cart views
+CART_COUNT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Cart
+# where active carts live: 'core.cart.DatabaseCartStore' keeps them as
+# unpaid orders, 'core.cart.CacheCartStore' keeps them in the cache (use a
+# shared backend) and creates the order at checkout
+CART_STORE = 'core.cart.DatabaseCartStore'
+CART_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# seconds a cached cart change may wait before it is written to the database
+CART_FLUSH_DELAY = 30
+CART_LOCK_TIMEOUT = 5
+
+
+# Orders
+# read order totals from the denormalized Order.total_cents instead of
+# aggregating the order items on every call
+ORDER_DENORMALIZED_TOTALS = True
+
+# Inventory
+# stock counter rows per item and how long checkout holds the units
+STOCK_SHARDS = 8
+STOCK_RESERVATION_TIMEOUT = 60 * 15
+
+
+# Archival
+# days after which untouched carts are deleted and paid orders are moved
+# to the archive tables, see the reap_carts and archive_orders commands
+CART_ABANDON_AFTER = 30
+ORDER_ARCHIVE_AFTER = 365
+
+
+# Coupons
+# bloom filter of the valid codes, cached lookups and failed attempts
+# allowed per user and per IP address within the window
+COUPON_FILTER_FALSE_POSITIVE_RATE = 0.01
+COUPON_CACHE_TIMEOUT = 60 * 60
+COUPON_ATTEMPT_LIMIT = 10
+COUPON_ATTEMPT_WINDOW = 60 * 15
+
+
 # Stripe
 API_SECRET_KEY = settings.get('STRIPE_SECRET_KEY')
 
+# point the stripe client at a local stub, e.g. stripe-mock
+STRIPE_API_BASE = settings.get('STRIPE_API_BASE')
+
+# saved card lookups of the payment page
+STRIPE_CARD_CACHE_TIMEOUT = 60 * 15
+STRIPE_LOOKUP_TIMEOUT = 2
+STRIPE_LOOKUP_WORKERS = 4
+STRIPE_BREAKER_THRESHOLD = 5
+STRIPE_BREAKER_RESET = 60
+
+# provider used by the payment flow, 'core.payments.FakeProvider' for
+# local load tests
+PAYMENT_PROVIDER = settings.get('PAYMENT_PROVIDER', 'core.payments.StripeProvider')
+FAKE_PAYMENT_LATENCY = 0.5
+
+# request threads of one web process, e.g. gunicorn --threads
+WEB_THREADS = settings.get('WEB_THREADS', 8)
+
+# provider calls in flight per process, at most half of the request
+# threads wait on the provider and the others keep serving pages
+PAYMENT_MAX_CONCURRENCY = max(1, WEB_THREADS // 2)
+# how long a request waits, about the p99 of a stripe charge. A charge
+# that takes longer is settled by the task worker instead
+PAYMENT_PROVIDER_TIMEOUT = 5
+# when the worker settles it, the stripe client gives up on the call in
+# flight after 80 seconds
+PAYMENT_RECONCILE_DELAY = 90
+
+# refund pipeline, see core.refunds
+REFUND_BATCH_SIZE = 100
+REFUND_WORKERS = 4
+REFUND_MAX_ATTEMPTS = 3
+REFUND_RETRY_DELAY = 1
+
 
 # Email
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+# messages are queued and sent by the task worker with TASK_EMAIL_BACKEND
+EMAIL_BACKEND = 'core.mail.QueuedEmailBackend'
+TASK_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+
+# Tasks
+# background tasks stored in the database, run by the run_tasks command
+TASK_MAX_ATTEMPTS = 3
+TASK_RETRY_DELAY = 10
+TASK_LOCK_TIMEOUT = 60 * 10
+
+
+# Outbox
+# messages failing this many times are left for inspection in the admin
+OUTBOX_MAX_ATTEMPTS = 5
+
+
+# Exports
+# orders loaded per query by the streaming order export
+EXPORT_CHUNK_SIZE = 500